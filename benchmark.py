@@ -0,0 +1,883 @@
+# Benchmarks do tp4 contra um PostgreSQL descartável (initdb/pg_ctl num diretório temporário)
+# python benchmark.py --lotes 100000
+# python benchmark.py --lotes 1000000 --somente leitura,dispensacao
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import glob
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import tp4
+
+PASTA_RESULTADOS = 'resultados_benchmark'
+# Variação no p50 acima disso em relação à execução anterior é marcada como regressão
+LIMIAR_REGRESSAO = 0.20
+
+# ==== PostgreSQL descartável
+def _binarios_postgres(pasta=None):
+    if pasta:
+        return pasta
+    initdb = shutil.which('initdb')
+    if initdb:
+        return os.path.dirname(initdb)
+    candidatos = glob.glob('/usr/lib/postgresql/*/bin') + glob.glob('/usr/pgsql-*/bin') + \
+        glob.glob('/opt/homebrew/opt/postgresql*/bin') + glob.glob('/usr/local/pgsql/bin')
+    candidatos = [c for c in candidatos if os.path.exists(os.path.join(c, 'initdb'))]
+    if not candidatos:
+        raise RuntimeError('initdb não encontrado; instale o PostgreSQL ou informe --bin-postgres.')
+    return max(candidatos, key=lambda c: [int(p) for p in c.split('/') if p.isdigit()] or [0])
+
+def _porta_livre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+class PostgresDescartavel:
+    # Cria um cluster novo num diretório temporário e apaga tudo ao sair.
+    # O PostgreSQL não roda como root: execute como um usuário comum.
+    def __init__(self, bin_postgres=None, fsync=True):
+        self.bin = _binarios_postgres(bin_postgres)
+        self.fsync = fsync
+        self.pasta = None
+        self.porta = None
+
+    def _executar(self, programa, *args):
+        subprocess.run([os.path.join(self.bin, programa), *args], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def __enter__(self):
+        self.pasta = tempfile.mkdtemp(prefix='tp4-bench-')
+        self.porta = _porta_livre()
+        dados = os.path.join(self.pasta, 'dados')
+        self._executar('initdb', '-D', dados, '-U', 'postgres', '--auth=trust', '-E', 'UTF8', '--no-locale')
+        opcoes = f"-p {self.porta} -k {self.pasta} -c listen_addresses='' -c shared_buffers=256MB"
+        if not self.fsync:
+            opcoes += ' -c fsync=off -c synchronous_commit=off'
+        self._executar('pg_ctl', '-D', dados, '-o', opcoes, '-l', os.path.join(self.pasta, 'log'), '-w', 'start')
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self._executar('pg_ctl', '-D', os.path.join(self.pasta, 'dados'), '-m', 'fast', '-w', 'stop')
+        finally:
+            shutil.rmtree(self.pasta, ignore_errors=True)
+
+    def configurar_tp4(self):
+        tp4.fechar_pool()
+        tp4.DB_CONFIG = {'user': 'postgres', 'host': self.pasta, 'port': self.porta}
+        tp4._inicializado = False
+        tp4.init()
+
+# ==== Dados sintéticos
+TIPOS_UNIDADE = ['UBS', 'Policlínica', 'UPA', 'Farmácia Popular', 'Centro de Saúde', 'Hospital Municipal']
+BAIRROS = ['Centro', 'Savassi', 'Pampulha', 'Barreiro', 'Venda Nova', 'Lourdes', 'Floresta', 'Santa Efigênia',
+           'Buritis', 'Sion', 'Gutierrez', 'Prado', 'Calafate', 'Padre Eustáquio', 'Caiçara', 'Cidade Nova']
+PRINCIPIOS = ['Amoxicilina', 'Dipirona Sódica', 'Paracetamol', 'Ibuprofeno', 'Losartana Potássica',
+              'Metformina', 'Omeprazol', 'Sinvastatina', 'Atenolol', 'Hidroclorotiazida', 'Captopril',
+              'Azitromicina', 'Cefalexina', 'Prednisona', 'Loratadina', 'Salbutamol', 'Enalapril',
+              'Glibenclamida', 'Fluoxetina', 'Sertralina', 'Clonazepam', 'Insulina NPH', 'Ácido Fólico',
+              'Sulfato Ferroso', 'Diclofenaco', 'Nimesulida', 'Levotiroxina', 'Anlodipino', 'Furosemida']
+FABRICANTES = ['EMS', 'Medley', 'Eurofarma', 'Neo Química', 'Aché', 'Sanofi', 'Teuto', 'Germed',
+               'Prati-Donaduzzi', 'Cristália', 'Biolab', 'Libbs', 'Hipolabor', 'Furp']
+FORMAS = ['Oral', 'Injetável', 'Tópica', 'Inalatória', 'Sublingual', 'Oftálmica']
+APRESENTACOES = ['Comprimido 500 mg', 'Cápsula 20 mg', 'Suspensão oral 250 mg/5 mL', 'Solução injetável 1 g',
+                 'Comprimido revestido 50 mg', 'Gotas 200 mg/mL', 'Creme 10 mg/g', 'Aerossol 100 mcg']
+SILABAS = ['ma', 'xi', 'lo', 'pra', 'ten', 'cor', 'fla', 'neo', 'vi', 'tal', 'zol', 'dor', 'fen', 'mox', 'cil']
+
+def _base36(numero, tamanho):
+    digitos = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    texto = ''
+    while numero:
+        numero, resto = divmod(numero, 36)
+        texto = digitos[resto] + texto
+    return texto.rjust(tamanho, '0')
+
+class DadosSinteticos:
+    def __init__(self, lotes, semente=42):
+        self.lotes = lotes
+        self.semente = semente
+        self.n_unidades = max(10, lotes // 5000)
+        self.n_medicamentos = max(100, min(500_000, lotes // 20))
+        self.cods_unidade = list(range(1, self.n_unidades + 1))
+        self.cods_anvisa = [f'{i:013d}' for i in range(1, self.n_medicamentos + 1)]
+        # Amostra de lotes existentes usada pelos benchmarks de leitura e escrita
+        self.amostra_lotes = []
+
+    def unidades(self):
+        rnd = random.Random(self.semente)
+        for cod in self.cods_unidade:
+            yield (cod, f'{rnd.choice(TIPOS_UNIDADE)} {cod:05d}', f'31{rnd.randrange(10**8, 10**9)}',
+                   rnd.choice(TIPOS_UNIDADE), f'Rua {rnd.choice(SILABAS).title()}{rnd.choice(SILABAS)}',
+                   rnd.randrange(1, 3000), rnd.choice(BAIRROS), f'{rnd.randrange(30000000, 31999999)}')
+
+    def medicamentos(self):
+        rnd = random.Random(self.semente + 1)
+        for cod in self.cods_anvisa:
+            nome = ''.join(rnd.choice(SILABAS) for _ in range(rnd.randrange(2, 4))).title()
+            yield (cod, f'{nome} {rnd.choice(["", "Plus", "Retard", "Forte", "Max"])}'.strip(),
+                   rnd.choice(FABRICANTES), rnd.choice(APRESENTACOES), rnd.choice(FORMAS), rnd.choice(PRINCIPIOS))
+
+    def estoque(self):
+        rnd = random.Random(self.semente + 2)
+        hoje = datetime.date.today()
+        intervalo = max(1, self.lotes // 10_000)
+        for i in range(self.lotes):
+            linha = (_base36(i, 7), rnd.choice(self.cods_anvisa), rnd.choice(self.cods_unidade),
+                     hoje + datetime.timedelta(days=rnd.randrange(-60, 720)), rnd.randrange(0, 500))
+            if i % intervalo == 0:
+                self.amostra_lotes.append(linha)
+            yield linha
+
+def carregar(dados):
+    resultados = {}
+    for nome, importar, origem in (
+            ('unidadesaude', tp4.import_unidades, dados.unidades()),
+            ('medicamento', tp4.import_medicamentos, dados.medicamentos()),
+            ('medicamentoestocado', tp4.import_estoque_medicamentos, dados.estoque())):
+        result = importar(origem)
+        if result['status'] != 'success':
+            raise RuntimeError(f'Falha carregando {nome}: {result["message"]}')
+        print(f"  {nome}: {result['linhas_importadas']} linhas, {result['linhas_por_segundo']:.0f} linhas/s")
+        resultados[f'importacao_{nome}'] = {'linhas': result['linhas_importadas'],
+                                            'linhas_por_segundo': result['linhas_por_segundo']}
+    with tp4.conexao() as conn:
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute('VACUUM ANALYZE')
+        conn.autocommit = False
+    tp4.atualizar_relatorios(concorrente=False)
+    return resultados
+
+# ==== Medição
+def resumo(tempos, operacoes_por_chamada=1):
+    ordenados = sorted(tempos)
+    total = sum(ordenados)
+    return {
+        'n': len(ordenados),
+        'media_ms': total / len(ordenados) * 1000,
+        'p50_ms': ordenados[len(ordenados) // 2] * 1000,
+        'p99_ms': ordenados[min(len(ordenados) - 1, int(len(ordenados) * 0.99))] * 1000,
+        'min_ms': ordenados[0] * 1000,
+        'max_ms': ordenados[-1] * 1000,
+        'ops_por_segundo': len(ordenados) * operacoes_por_chamada / total if total else 0.0,
+    }
+
+def sucesso(resultado, operacao=''):
+    # As funções de escrita devolvem {'status': 'error'} em vez de levantar; sem esta checagem
+    # o benchmark mediria o caminho de erro e publicaria o tempo como se fosse o normal
+    if isinstance(resultado, dict) and resultado.get('status') == 'error':
+        raise AssertionError(f'Falha em {operacao or "operação medida"}: {resultado.get("message")}')
+    return resultado
+
+def medir(funcao, repeticoes, argumentos=None):
+    tempos = []
+    for i in range(repeticoes):
+        args = argumentos(i) if argumentos else ()
+        inicio = time.perf_counter()
+        resultado = funcao(*args)
+        tempos.append(time.perf_counter() - inicio)
+        sucesso(resultado, getattr(funcao, '__name__', ''))
+    return resumo(tempos)
+
+def medir_memoria(funcao):
+    tracemalloc.start()
+    inicio = time.perf_counter()
+    resultado = funcao()
+    duracao = time.perf_counter() - inicio
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    linhas = len(resultado)
+    return {
+        'linhas': linhas,
+        'total_s': duracao,
+        'por_linha_us': duracao / linhas * 1e6 if linhas else 0.0,
+        'pico_memoria_mb': pico / 2**20,
+    }
+
+@contextlib.contextmanager
+def respostas(*valores):
+    # Alimenta os input() de um fluxo do menu e descarta o que ele imprime
+    fila = iter(valores)
+    tp4.input = lambda _='': next(fila)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        del tp4.input
+
+# ==== Benchmarks
+BENCHMARKS = []
+
+def benchmark(nome):
+    def registrar(funcao):
+        BENCHMARKS.append((nome, funcao))
+        return funcao
+    return registrar
+
+@benchmark('importacao')
+def bench_importacao(ctx):
+    # O tempo de import do módulo não deve depender do banco nem de bibliotecas pesadas
+    comando = 'import time; t = time.perf_counter(); import tp4; print(time.perf_counter() - t)'
+    tempos = []
+    for _ in range(5):
+        saida = subprocess.run([sys.executable, '-c', comando], check=True, capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(tp4.__file__)))
+        tempos.append(float(saida.stdout.strip().splitlines()[-1]))
+    return {'import_tp4': resumo(tempos)}
+
+@benchmark('crud')
+def bench_crud(ctx):
+    rnd = random.Random(1)
+    dados, n = ctx['dados'], ctx['repeticoes']
+    lote = lambda i: dados.amostra_lotes[i % len(dados.amostra_lotes)]
+    resultados = {
+        'get_medicamento': medir(tp4.get_medicamento, n, lambda i: (rnd.choice(dados.cods_anvisa),)),
+        'get_unidade': medir(tp4.get_unidade, n, lambda i: (rnd.choice(dados.cods_unidade),)),
+        'get_medicamentos_pagina': medir(tp4.get_medicamentos_pagina, n, lambda i: (rnd.choice(dados.cods_anvisa),)),
+        'get_unidades_pagina': medir(tp4.get_unidades_pagina, n),
+        'get_estoque_medicamentos_pagina': medir(
+            tp4.get_estoque_medicamentos_pagina, n, lambda i: (rnd.choice(dados.cods_unidade),)),
+        'get_estoque_medicamento': medir(
+            tp4.get_estoque_medicamento, n, lambda i: (lote(i)[2], lote(i)[0], lote(i)[1])),
+        'get_estoque_medicamentos': medir(
+            tp4.get_estoque_medicamentos, max(1, n // 10), lambda i: (rnd.choice(dados.cods_unidade),)),
+        'get_unidades': medir(tp4.get_unidades, max(1, n // 10)),
+        'get_medicamentos': medir(tp4.get_medicamentos, max(1, n // 100)),
+    }
+
+    unidades = [tp4.UnidadeSaude(dados.n_unidades + 1 + i, f'Bench {i}', '3133333333', 'UBS', 'Rua A', '1', 'Centro', '30000000')
+                for i in range(n)]
+    resultados['post_unidade'] = medir(tp4.post_unidade, n, lambda i: (unidades[i],))
+    for unidade in unidades:
+        unidade.nome += ' atualizada'
+    resultados['update_unidade'] = medir(tp4.update_unidade, n, lambda i: (unidades[i],))
+    resultados['delete_unidade'] = medir(tp4.delete_unidade, n, lambda i: (unidades[i].cod,))
+
+    novos = [tp4.Medicamento(f'8{i:012d}', f'Bench {i}', 'EMS', 'Comprimido', 'Oral', 'Paracetamol') for i in range(n)]
+    resultados['post_medicamento'] = medir(tp4.post_medicamento, n, lambda i: (novos[i],))
+    for med in novos:
+        med.nome_comercial += ' atualizado'
+    resultados['update_medicamento'] = medir(tp4.update_medicamento, n, lambda i: (novos[i],))
+    resultados['delete_medicamento'] = medir(tp4.delete_medicamento, n, lambda i: (novos[i].cod_anvisa,))
+
+    cod_unidade = dados.cods_unidade[0]
+    itens = [tp4.EstoqueMedicamento(_base36(10**9 + i, 7), rnd.choice(dados.cods_anvisa), cod_unidade,
+                                    datetime.date.today() + datetime.timedelta(days=365), 100) for i in range(n)]
+    resultados['post_estoque_medicamento'] = medir(tp4.post_estoque_medicamento, n, lambda i: (itens[i],))
+    resultados['update_estoque_medicamento'] = medir(tp4.update_estoque_medicamento, n, lambda i: (itens[i],))
+    return resultados
+
+@benchmark('menu')
+def bench_menu(ctx):
+    rnd = random.Random(2)
+    dados, n = ctx['dados'], max(1, ctx['repeticoes'] // 10)
+
+    def fluxo(funcao, *valores):
+        with respostas(*valores):
+            funcao()
+
+    lote = dados.amostra_lotes[0]
+    resultados = {
+        'menu_unidades_get': medir(fluxo, n, lambda i: (tp4.menu_unidades_get, 'q')),
+        'menu_medicamentos_get': medir(fluxo, n, lambda i: (tp4.menu_medicamentos_get, 'q')),
+        'menu_medicamentos_estoque_get': medir(
+            fluxo, n, lambda i: (tp4.menu_medicamentos_estoque_get, str(rnd.choice(dados.cods_unidade)), 'q')),
+        'menu_medicamentos_buscar': medir(fluxo, n, lambda i: (tp4.menu_medicamentos_buscar, rnd.choice(PRINCIPIOS)[:5])),
+        'menu_medicamentos_estoque_subtract': medir(
+            fluxo, n, lambda i: (tp4.menu_medicamentos_estoque_subtract, str(lote[2]), lote[0], lote[1], '1')),
+        'menu_relatorio_vencendo': medir(fluxo, n, lambda i: (tp4.menu_relatorio_vencendo, '30')),
+    }
+
+    # Os fluxos de escrita só imprimem os erros; o estado final é conferido depois de cada etapa
+    # para que um fluxo que falhou em silêncio não entre nos resultados
+    def conferir(condicao, operacao):
+        if not condicao:
+            raise AssertionError(f'Falha em {operacao}')
+
+    cods_unidade = [str(dados.n_unidades + 1_000_001 + i) for i in range(n)]
+    cods_anvisa = [f'9{i:012d}' for i in range(n)]
+    lotes = [_base36(2 * 10**9 + i, 7) for i in range(n)]
+    validade = (datetime.date.today() + datetime.timedelta(days=365)).isoformat()
+    destino = str(dados.cods_unidade[0])
+
+    resultados['menu_unidades_add'] = medir(fluxo, n, lambda i: (
+        tp4.menu_unidades_add, cods_unidade[i], f'Menu {i}', '3133333333', 'UBS', 'Rua A', '1', 'Centro', '30000000'))
+    conferir(tp4.get_unidade(cods_unidade[-1]), 'menu_unidades_add')
+    resultados['menu_unidades_update'] = medir(fluxo, n, lambda i: (
+        tp4.menu_unidades_update, cods_unidade[i], f'Menu {i} atualizada', '', '', '', '', '', ''))
+    conferir(tp4.get_unidade(cods_unidade[-1]).nome.endswith('atualizada'), 'menu_unidades_update')
+
+    resultados['menu_medicamentos_add'] = medir(fluxo, n, lambda i: (
+        tp4.menu_medicamentos_add, cods_anvisa[i], f'Menu {i}', 'EMS', 'Comprimido', 'Oral', 'Paracetamol'))
+    conferir(tp4.get_medicamento(cods_anvisa[-1]), 'menu_medicamentos_add')
+    resultados['menu_medicamentos_update'] = medir(fluxo, n, lambda i: (
+        tp4.menu_medicamentos_update, cods_anvisa[i], f'Menu {i} atualizado', '', '', '', ''))
+    conferir(tp4.get_medicamento(cods_anvisa[-1]).nome_comercial.endswith('atualizado'), 'menu_medicamentos_update')
+
+    resultados['menu_medicamentos_estoque_add'] = medir(fluxo, n, lambda i: (
+        tp4.menu_medicamentos_estoque_add, cods_unidade[i], lotes[i], cods_anvisa[i], validade, '100'))
+    conferir(tp4.get_estoque_medicamento(cods_unidade[-1], lotes[-1], cods_anvisa[-1]), 'menu_medicamentos_estoque_add')
+    resultados['menu_medicamentos_transferir'] = medir(fluxo, n, lambda i: (
+        tp4.menu_medicamentos_transferir, cods_unidade[i], destino, lotes[i], cods_anvisa[i], '1', ''))
+    conferir(tp4.get_estoque_medicamento(destino, lotes[-1], cods_anvisa[-1]), 'menu_medicamentos_transferir')
+
+    resultados['menu_medicamentos_delete'] = medir(fluxo, n, lambda i: (tp4.menu_medicamentos_delete, cods_anvisa[i], 's'))
+    conferir(not tp4.get_medicamento(cods_anvisa[-1]), 'menu_medicamentos_delete')
+    resultados['menu_unidades_delete'] = medir(fluxo, n, lambda i: (tp4.menu_unidades_delete, cods_unidade[i], 's'))
+    conferir(not tp4.get_unidade(cods_unidade[-1]), 'menu_unidades_delete')
+    return resultados
+
+@benchmark('leitura')
+def bench_leitura(ctx):
+    # Caminho nativo (cursor nomeado + __slots__) contra o antigo pandas -> DataFrame -> dicts
+    consulta = f'SELECT {tp4.EstoqueMedicamento.COLUNAS} FROM medicamentoestocado'
+    resultados = {'leitura_nativa': medir_memoria(lambda: tp4._buscar_todos(tp4.EstoqueMedicamento, consulta))}
+    try:
+        import pandas as pd
+    except ImportError:
+        return resultados
+
+    def leitura_pandas():
+        with tp4.conexao() as conn:
+            df = pd.read_sql_query(consulta, conn)
+        return [tp4.EstoqueMedicamento(**item) for item in df.to_dict(orient='records')]
+    resultados['leitura_pandas'] = medir_memoria(leitura_pandas)
+    return resultados
+
+@benchmark('cache')
+def bench_cache(ctx):
+    rnd = random.Random(3)
+    dados, n = ctx['dados'], ctx['repeticoes']
+    quentes = [rnd.choice(dados.cods_anvisa) for _ in range(20)]
+
+    def sem_cache(cod):
+        tp4.cache_medicamentos.invalidar()
+        tp4.get_medicamento(cod)
+
+    tp4.cache_medicamentos.invalidar()
+    resultados = {
+        'get_medicamento_sem_cache': medir(sem_cache, n, lambda i: (quentes[i % len(quentes)],)),
+        'get_medicamento_com_cache': medir(tp4.get_medicamento, n, lambda i: (quentes[i % len(quentes)],)),
+    }
+    resultados['estatisticas'] = tp4.estatisticas_cache()
+    return resultados
+
+@benchmark('prepared')
+def bench_prepared(ctx):
+    dados, n = ctx['dados'], ctx['repeticoes']
+    lote = lambda i: dados.amostra_lotes[i % len(dados.amostra_lotes)]
+    argumentos = lambda i: (lote(i)[2], lote(i)[0], lote(i)[1])
+    resultados = {}
+    for usar in (False, True):
+        tp4.USAR_PREPARED_STATEMENTS = usar
+        resultados['get_estoque_medicamento_' + ('preparado' if usar else 'texto')] = \
+            medir(tp4.get_estoque_medicamento, n, argumentos)
+    return resultados
+
+@benchmark('dispensacao')
+def bench_dispensacao(ctx):
+    # Várias threads baixando o mesmo lote: no fim o saldo tem que bater exatamente
+    dados = ctx['dados']
+    lote, cod_anvisa, cod_unidade = dados.amostra_lotes[0][:3]
+    threads, por_thread, saldo_inicial = 8, 200, 1000
+    tp4.update_estoque_medicamento(tp4.EstoqueMedicamento(lote, cod_anvisa, cod_unidade, None, saldo_inicial))
+    sucessos = []
+    tempos = []
+    lock = threading.Lock()
+
+    def trabalhador():
+        locais, tempos_locais = 0, []
+        for _ in range(por_thread):
+            inicio = time.perf_counter()
+            result = tp4.dispensar_medicamento(cod_unidade, lote, cod_anvisa, 1)
+            tempos_locais.append(time.perf_counter() - inicio)
+            locais += result['status'] == 'success'
+        with lock:
+            sucessos.append(locais)
+            tempos.extend(tempos_locais)
+
+    inicio = time.perf_counter()
+    grupo = [threading.Thread(target=trabalhador) for _ in range(threads)]
+    for thread in grupo:
+        thread.start()
+    for thread in grupo:
+        thread.join()
+    duracao = time.perf_counter() - inicio
+
+    saldo_final = tp4.get_estoque_medicamento(cod_unidade, lote, cod_anvisa).quantidade
+    total = sum(sucessos)
+    if total != min(saldo_inicial, threads * por_thread) or saldo_final != saldo_inicial - total:
+        raise AssertionError(f'Atualização perdida: {total} baixas, saldo {saldo_inicial} -> {saldo_final}')
+    resultados = {'dispensar_concorrente': resumo(tempos)}
+    resultados['dispensar_concorrente']['dispensacoes_por_segundo'] = total / duracao
+
+    # FEFO numa unidade com milhares de lotes do mesmo medicamento
+    cod_unidade, cod_anvisa = dados.cods_unidade[-1], dados.cods_anvisa[-1]
+    hoje = datetime.date.today()
+    tp4.post_estoques([tp4.EstoqueMedicamento(_base36(2 * 10**9 + i, 7), cod_anvisa, cod_unidade,
+                                              hoje + datetime.timedelta(days=i % 700), 50) for i in range(5000)])
+    resultados['dispensar_fefo_5000_lotes'] = medir(
+        tp4.dispensar_medicamento_fefo, ctx['repeticoes'], lambda i: (cod_unidade, cod_anvisa, 75))
+    return resultados
+
+@benchmark('fila_escrita')
+def bench_fila_escrita(ctx):
+    # Dispensações por segundo com um COMMIT por chamada contra a fila de escrita com commit
+    # em grupo; cada thread baixa um lote diferente para medir o custo do COMMIT e não a
+    # espera pela trava da linha
+    dados = ctx['dados']
+    threads, por_thread = 32, 100
+    lotes = [amostra[:3] for amostra in dados.amostra_lotes[:threads]]
+    resultados = {}
+
+    for modo in ('commit_por_chamada', 'commit_em_grupo'):
+        for lote, cod_anvisa, cod_unidade in lotes:
+            tp4.update_estoque_medicamento(tp4.EstoqueMedicamento(lote, cod_anvisa, cod_unidade, None, 10**6))
+        fila = tp4.FilaEscrita() if modo == 'commit_em_grupo' else None
+        tempos, sucessos = [], []
+        lock = threading.Lock()
+
+        def trabalhador(lote, cod_anvisa, cod_unidade):
+            locais, tempos_locais = 0, []
+            for _ in range(por_thread):
+                inicio = time.perf_counter()
+                if fila is None:
+                    result = tp4.dispensar_medicamento(cod_unidade, lote, cod_anvisa, 1)
+                else:
+                    result = fila.dispensar_medicamento(cod_unidade, lote, cod_anvisa, 1).result()
+                tempos_locais.append(time.perf_counter() - inicio)
+                locais += result['status'] == 'success'
+            with lock:
+                sucessos.append(locais)
+                tempos.extend(tempos_locais)
+
+        inicio = time.perf_counter()
+        grupo = [threading.Thread(target=trabalhador, args=lote) for lote in lotes]
+        for thread in grupo:
+            thread.start()
+        for thread in grupo:
+            thread.join()
+        duracao = time.perf_counter() - inicio
+
+        total = sum(sucessos)
+        for lote, cod_anvisa, cod_unidade in lotes:
+            saldo = tp4.get_estoque_medicamento(cod_unidade, lote, cod_anvisa).quantidade
+            if saldo != 10**6 - por_thread:
+                raise AssertionError(f'Saldo errado no lote {lote} ({modo}): {saldo}')
+        resultados[modo] = resumo(tempos)
+        resultados[modo]['dispensacoes_por_segundo'] = total / duracao
+        if fila is not None:
+            resultados[modo].update(fila.estatisticas())
+            resultados[modo]['commits_por_segundo'] = resultados[modo]['grupos'] / duracao
+            fila.fechar()
+        else:
+            resultados[modo]['commits_por_segundo'] = total / duracao
+
+    # Entradas pela fila com dia > 12: a validade tem que ser gravada como dia/mês em qualquer DateStyle
+    lote, cod_anvisa, cod_unidade = lotes[0]
+    validade = datetime.date(datetime.date.today().year + 1, 12, 25)
+    fila = tp4.FilaEscrita()
+    entradas = [tp4.EstoqueMedicamento(_base36(6 * 10**9 + i, 7), cod_anvisa, cod_unidade, validade, 10) for i in range(100)]
+    inicio = time.perf_counter()
+    futuros = [fila.post_estoque_medicamento(estoque) for estoque in entradas]
+    falhas = [futuro.result()['message'] for futuro in futuros if futuro.result()['status'] != 'success']
+    duracao = time.perf_counter() - inicio
+    fila.fechar()
+    if falhas:
+        raise AssertionError(f'{len(falhas)} entradas pela fila falharam: {falhas[0]}')
+    for estoque in entradas:
+        gravada = tp4.get_estoque_medicamento(cod_unidade, estoque.lote, cod_anvisa).validade
+        if gravada != estoque.validade:
+            raise AssertionError(f'Validade do lote {estoque.lote} gravada como {gravada}, esperado {estoque.validade}')
+    resultados['entradas_pela_fila'] = {'entradas': len(entradas), 'entradas_por_segundo': len(entradas) / duracao}
+
+    # Contrapressão: com a fila pequena e sem espera, o excesso é recusado em vez de acumular
+    fila = tp4.FilaEscrita(capacidade=10)
+    futuros, recusadas = [], 0
+    for _ in range(1000):
+        try:
+            futuros.append(fila.dispensar_medicamento(cod_unidade, lote, cod_anvisa, 1, timeout=0))
+        except tp4.FilaEscritaCheia:
+            recusadas += 1
+    for futuro in futuros:
+        futuro.result()
+    fila.fechar()
+    resultados['contrapressao_capacidade_10'] = {'aceitas': len(futuros), 'recusadas': recusadas}
+    return resultados
+
+@benchmark('transferencia')
+def bench_transferencia(ctx):
+    # Threads transferindo os mesmos lotes entre poucas unidades, nos dois sentidos; o total
+    # de cada lote na rede tem que ser conservado e nenhuma transferência pode falhar por deadlock
+    dados = ctx['dados']
+    unidades = dados.cods_unidade[:4]
+    cod_anvisa = dados.cods_anvisa[0]
+    lotes = [_base36(3 * 10**9 + i, 7) for i in range(20)]
+    hoje = datetime.date.today()
+    tp4.post_estoques([tp4.EstoqueMedicamento(lote, cod_anvisa, cod_unidade, hoje + datetime.timedelta(days=365), 10_000)
+                       for lote in lotes for cod_unidade in unidades])
+    total_inicial = sum(tp4.get_saldo_em(cod_unidade, cod_anvisa, hoje) for cod_unidade in unidades)
+
+    threads, por_thread = 8, 100
+    tempos, erros = [], []
+    lock = threading.Lock()
+
+    def trabalhador(semente):
+        rnd = random.Random(semente)
+        locais = []
+        for _ in range(por_thread):
+            origem, destino = rnd.sample(unidades, 2)
+            itens = [(lote, cod_anvisa, rnd.randrange(1, 5)) for lote in rnd.sample(lotes, 5)]
+            inicio = time.perf_counter()
+            result = tp4.transferir_medicamentos(origem, destino, itens)
+            locais.append(time.perf_counter() - inicio)
+            if result['status'] != 'success':
+                with lock:
+                    erros.append(result['message'])
+        with lock:
+            tempos.extend(locais)
+
+    inicio = time.perf_counter()
+    grupo = [threading.Thread(target=trabalhador, args=(i,)) for i in range(threads)]
+    for thread in grupo:
+        thread.start()
+    for thread in grupo:
+        thread.join()
+    duracao = time.perf_counter() - inicio
+
+    total_final = sum(tp4.get_saldo_em(cod_unidade, cod_anvisa, hoje) for cod_unidade in unidades)
+    if erros or total_final != total_inicial:
+        raise AssertionError(f'Transferências inconsistentes: {len(erros)} erro(s) {erros[:3]}, total {total_inicial} -> {total_final}')
+    resultado = resumo(tempos)
+    resultado['transferencias_por_segundo'] = len(tempos) / duracao
+    return {'transferir_concorrente': resultado}
+
+@benchmark('exclusao')
+def bench_exclusao(ctx):
+    # Exclusão de um medicamento estocado em todas as unidades: DELETE único em cascata contra
+    # a exclusão em etapas, medindo ao mesmo tempo a latência de quem cadastra lotes dele
+    # (bloqueado pela trava da FK) e de quem dispensa outros medicamentos
+    dados = ctx['dados']
+    linhas = min(ctx['lote_maximo'], 200_000)
+    hoje = datetime.date.today()
+    outro_lote, outro_anvisa, outra_unidade = dados.amostra_lotes[0][:3]
+    resultados = {}
+
+    for modo in ('cascata', 'em_etapas'):
+        cod_anvisa = '6000000000000' if modo == 'cascata' else '6000000000001'
+        sucesso(tp4.post_medicamento(tp4.Medicamento(cod_anvisa, f'Exclusão {modo}', 'EMS', 'Comprimido', 'Oral', 'Dipirona')),
+                'post_medicamento')
+        sucesso(tp4.post_estoques([tp4.EstoqueMedicamento(_base36(4 * 10**9 + i, 7), cod_anvisa,
+                                                          dados.cods_unidade[i % len(dados.cods_unidade)],
+                                                          hoje + datetime.timedelta(days=365), 10) for i in range(linhas)],
+                                  tamanho_lote=10_000), 'post_estoques')
+        sucesso(tp4.update_estoque_medicamento(tp4.EstoqueMedicamento(outro_lote, outro_anvisa, outra_unidade, None, 10**6)),
+                'update_estoque_medicamento')
+
+        terminou = threading.Event()
+        latencias = {'dispensar_outro': [], 'post_lote_excluido': []}
+        falhas_dispensacao = []
+
+        def concorrente():
+            i = 0
+            while not terminou.is_set():
+                inicio = time.perf_counter()
+                result = tp4.dispensar_medicamento(outra_unidade, outro_lote, outro_anvisa, 1)
+                latencias['dispensar_outro'].append(time.perf_counter() - inicio)
+                if result['status'] != 'success':
+                    falhas_dispensacao.append(result['message'])
+                # O cadastro de lote do medicamento em exclusão pode falhar (a FK some no fim);
+                # aqui interessa só quanto tempo ele fica esperando a trava
+                inicio = time.perf_counter()
+                tp4.post_estoque_medicamento(tp4.EstoqueMedicamento(
+                    _base36(5 * 10**9 + i, 7), cod_anvisa, outra_unidade, hoje, 1))
+                latencias['post_lote_excluido'].append(time.perf_counter() - inicio)
+                i += 1
+                time.sleep(0.01)
+
+        thread = threading.Thread(target=concorrente)
+        thread.start()
+        inicio = time.perf_counter()
+        if modo == 'cascata':
+            result = tp4.delete_medicamento(cod_anvisa)
+        else:
+            result = tp4.delete_medicamento_em_etapas(cod_anvisa)
+        duracao = time.perf_counter() - inicio
+        terminou.set()
+        thread.join()
+        if result['status'] != 'success':
+            raise AssertionError(f'Falha na exclusão {modo}: {result["message"]}')
+        if falhas_dispensacao:
+            raise AssertionError(f'{len(falhas_dispensacao)} dispensações falharam durante a exclusão {modo}: '
+                                 f'{falhas_dispensacao[0]}')
+
+        resultados[f'delete_medicamento_{modo}'] = {'linhas': linhas, 'total_s': duracao}
+        for nome, tempos in latencias.items():
+            if tempos:
+                resultados[f'{nome}_durante_{modo}'] = resumo(tempos)
+    return resultados
+
+@benchmark('lote')
+def bench_lote(ctx):
+    resultados = {}
+    for tamanho in (1_000, 10_000, 100_000):
+        if tamanho > ctx['lote_maximo']:
+            break
+        medicamentos = [tp4.Medicamento(f'7{i:012d}', f'Lote {i}', 'EMS', 'Comprimido', 'Oral', 'Dipirona')
+                        for i in range(tamanho)]
+        inicio = time.perf_counter()
+        sucesso(tp4.post_medicamentos(medicamentos), 'post_medicamentos')
+        resultados[f'post_medicamentos_{tamanho}'] = {'linhas_por_segundo': tamanho / (time.perf_counter() - inicio)}
+        inicio = time.perf_counter()
+        sucesso(tp4.delete_medicamentos([med.cod_anvisa for med in medicamentos]), 'delete_medicamentos')
+        resultados[f'delete_medicamentos_{tamanho}'] = {'linhas_por_segundo': tamanho / (time.perf_counter() - inicio)}
+        if tamanho <= 10_000:
+            inicio = time.perf_counter()
+            for med in medicamentos:
+                sucesso(tp4.post_medicamento(med), 'post_medicamento')
+            resultados[f'post_medicamento_por_linha_{tamanho}'] = {
+                'linhas_por_segundo': tamanho / (time.perf_counter() - inicio)}
+            sucesso(tp4.delete_medicamentos([med.cod_anvisa for med in medicamentos]), 'delete_medicamentos')
+    return resultados
+
+@benchmark('relatorios')
+def bench_relatorios(ctx):
+    rnd = random.Random(4)
+    n = max(1, ctx['repeticoes'] // 10)
+    return {
+        'relatorio_vencendo': medir(tp4.relatorio_vencendo, n, lambda i: (30,)),
+        'relatorio_principio_ativo_bairro': medir(
+            tp4.relatorio_principio_ativo_bairro, n, lambda i: (rnd.choice(PRINCIPIOS),)),
+        'relatorio_abaixo_reposicao': medir(tp4.relatorio_abaixo_reposicao, n, lambda i: (10,)),
+        'buscar_medicamentos': medir(
+            tp4.buscar_medicamentos, ctx['repeticoes'], lambda i: (rnd.choice(SILABAS) + rnd.choice(SILABAS),)),
+    }
+
+@benchmark('movimentacoes')
+def bench_movimentacoes(ctx):
+    rnd = random.Random(5)
+    dados, n = ctx['dados'], ctx['repeticoes']
+    lote = lambda i: dados.amostra_lotes[i % len(dados.amostra_lotes)]
+    hoje = datetime.date.today()
+    inicio = time.perf_counter()
+    tp4.compactar_movimentacoes()
+    resultados = {'compactar_movimentacoes': {'total_s': time.perf_counter() - inicio}}
+    resultados['get_saldo_em_lote'] = medir(
+        tp4.get_saldo_em, n, lambda i: (lote(i)[2], lote(i)[1], hoje - datetime.timedelta(days=rnd.randrange(30)), lote(i)[0]))
+    resultados['get_saldo_em_medicamento'] = medir(
+        tp4.get_saldo_em, n, lambda i: (lote(i)[2], lote(i)[1], hoje))
+    resultados['get_movimentacoes'] = medir(tp4.get_movimentacoes, n, lambda i: (lote(i)[2], lote(i)[0], lote(i)[1]))
+    resultados['relatorio_consumo_unidade'] = medir(
+        tp4.relatorio_consumo, max(1, n // 10), lambda i: (90, rnd.choice(dados.cods_unidade)))
+    return resultados
+
+@benchmark('estoques')
+def bench_estoques(ctx):
+    # As duas estratégias de get_estoques para conjuntos crescentes de unidades, mais o
+    # laço antigo de uma chamada de get_estoque_medicamentos por unidade
+    dados, n = ctx['dados'], max(1, ctx['repeticoes'] // 50)
+    resultados = {}
+    for quantidade in (10, 50, 200, 1000, len(dados.cods_unidade)):
+        if quantidade > len(dados.cods_unidade):
+            continue
+        unidades = dados.cods_unidade[:quantidade]
+        for estrategia in ('unica', 'paralela'):
+            resultados[f'get_estoques_{estrategia}_{quantidade}'] = medir(
+                tp4.get_estoques, n, lambda i: (unidades, estrategia))
+        resultados[f'get_estoque_medicamentos_laco_{quantidade}'] = medir(
+            lambda: [tp4.get_estoque_medicamentos(cod_unidade) for cod_unidade in unidades], n)
+    return resultados
+
+@benchmark('estoque_detalhado')
+def bench_estoque_detalhado(ctx):
+    # Estoque de uma unidade com nome do medicamento e da unidade: JOIN único contra a
+    # busca de cada medicamento por linha (N+1), com e sem o cache dos cadastros
+    dados, n = ctx['dados'], max(1, ctx['repeticoes'] // 50)
+    cod_unidade = dados.cods_unidade[0]
+
+    def por_linha(com_cache):
+        if not com_cache:
+            tp4.cache_medicamentos.invalidar()
+            tp4.cache_unidades.invalidar()
+        unidade = tp4.get_unidade(cod_unidade)
+        return [(item, tp4.get_medicamento(item.cod_anvisa), unidade.nome)
+                for item in tp4.get_estoque_medicamentos(cod_unidade)]
+
+    hoje = datetime.date.today()
+    return {
+        'linhas': len(tp4.get_estoque_medicamentos(cod_unidade)),
+        'get_estoque_detalhado_unidade': medir(tp4.get_estoque_detalhado, n, lambda i: (cod_unidade,)),
+        'get_estoque_detalhado_pagina': medir(
+            tp4.get_estoque_detalhado_pagina, ctx['repeticoes'], lambda i: (cod_unidade,)),
+        'get_estoque_detalhado_medicamento': medir(
+            tp4.get_estoque_detalhado, n, lambda i: (None, dados.cods_anvisa[i % len(dados.cods_anvisa)])),
+        'get_estoque_detalhado_vencendo': medir(
+            tp4.get_estoque_detalhado, n, lambda i: (cod_unidade, None, hoje, hoje + datetime.timedelta(days=30), True)),
+        'por_linha_sem_cache': medir(por_linha, n, lambda i: (False,)),
+        'por_linha_com_cache': medir(por_linha, n, lambda i: (True,)),
+    }
+
+@benchmark('renderizacao')
+def bench_renderizacao(ctx):
+    # Renderização de todo o estoque de uma unidade para /dev/null, da lista já carregada
+    # e direto do gerador do cursor nomeado
+    dados = ctx['dados']
+    cod_unidade = dados.cods_unidade[0]
+    estoque = tp4.get_estoque_medicamentos(cod_unidade)
+    resultados = {'linhas': len(estoque)}
+    with open(os.devnull, 'w', encoding='utf-8') as nulo:
+        for formato in ('tabela', 'csv'):
+            resultados[f'render_estoque_{formato}'] = medir(
+                tp4.render_estoque_medicamentos, 5, lambda i: (estoque, nulo, formato))
+        resultados['render_estoque_gerador'] = medir(
+            lambda: tp4.render_estoque_medicamentos(tp4.iter_estoque_medicamentos(cod_unidade), nulo), 5)
+    return resultados
+
+@benchmark('exportacao')
+def bench_exportacao(ctx):
+    with tempfile.TemporaryDirectory() as pasta:
+        result = tp4.exportar_estoque(os.path.join(pasta, 'estoque.parquet'))
+    if result['status'] != 'success':
+        return {}
+    return {'exportar_estoque': {'linhas': result['linhas'], 'linhas_por_segundo': result['linhas_por_segundo']}}
+
+@benchmark('http')
+def bench_http(ctx):
+    import http.client
+    import server
+
+    porta = _porta_livre()
+    loop = asyncio.new_event_loop()
+    tarefa = loop.create_task(server.servir('127.0.0.1', porta))
+    thread_servidor = threading.Thread(target=loop.run_until_complete, args=(tarefa,), daemon=True)
+    with contextlib.redirect_stdout(io.StringIO()):
+        thread_servidor.start()
+        time.sleep(0.5)
+
+    dados, duracao, clientes = ctx['dados'], ctx['duracao_http'], 16
+    tempos = []
+    lock = threading.Lock()
+
+    def cliente(semente):
+        rnd = random.Random(semente)
+        conexao = http.client.HTTPConnection('127.0.0.1', porta)
+        locais = []
+        fim = time.perf_counter() + duracao
+        while time.perf_counter() < fim:
+            if rnd.random() < 0.8:
+                caminho = f'/medicamentos/{rnd.choice(dados.cods_anvisa)}'
+            else:
+                caminho = f'/unidades/{rnd.choice(dados.cods_unidade)}/medicamentos?limite=50'
+            inicio = time.perf_counter()
+            conexao.request('GET', caminho)
+            conexao.getresponse().read()
+            locais.append(time.perf_counter() - inicio)
+        conexao.close()
+        with lock:
+            tempos.extend(locais)
+
+    grupo = [threading.Thread(target=cliente, args=(i,)) for i in range(clientes)]
+    for thread in grupo:
+        thread.start()
+    for thread in grupo:
+        thread.join()
+    loop.call_soon_threadsafe(tarefa.cancel)
+    thread_servidor.join()
+
+    resultado = resumo(tempos)
+    resultado['requisicoes_por_segundo'] = len(tempos) / duracao
+    return {'http_get': resultado}
+
+# ==== Resultados
+def _commit_atual():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def _ultimo_resultado(pasta, lotes):
+    arquivos = sorted(glob.glob(os.path.join(pasta, f'benchmark-{lotes}-*.json')))
+    return arquivos[-1] if arquivos else None
+
+def comparar(atual, anterior):
+    print(f"\n{'Benchmark':<55} {'p50 anterior':>14} {'p50 atual':>12} {'variação':>10}")
+    print('=' * 95)
+    for grupo, medicoes in atual['resultados'].items():
+        for nome, valores in medicoes.items():
+            antes = anterior['resultados'].get(grupo, {}).get(nome)
+            if not isinstance(valores, dict) or not isinstance(antes, dict) or 'p50_ms' not in valores or 'p50_ms' not in antes:
+                continue
+            variacao = (valores['p50_ms'] - antes['p50_ms']) / antes['p50_ms'] if antes['p50_ms'] else 0.0
+            marca = '  REGRESSÃO' if variacao > LIMIAR_REGRESSAO else ''
+            print(f"{grupo + '/' + nome:<55} {antes['p50_ms']:>12.3f}ms {valores['p50_ms']:>10.3f}ms {variacao:>+9.0%}{marca}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks do tp4 num PostgreSQL descartável.')
+    parser.add_argument('--lotes', type=int, default=100_000, help='Linhas de medicamentoestocado geradas (1k a 10M)')
+    parser.add_argument('--repeticoes', type=int, default=500)
+    parser.add_argument('--lote-maximo', type=int, default=100_000, help='Maior lote no benchmark de escrita em lote')
+    parser.add_argument('--duracao-http', type=float, default=10.0, help='Segundos de carga no servidor HTTP')
+    parser.add_argument('--somente', help='Grupos separados por vírgula: ' + ','.join(nome for nome, _ in BENCHMARKS))
+    parser.add_argument('--bin-postgres', help='Pasta com initdb e pg_ctl')
+    parser.add_argument('--sem-fsync', action='store_true', help='Desliga fsync (mais rápido, não mede commits reais)')
+    parser.add_argument('--saida', default=PASTA_RESULTADOS)
+    parser.add_argument('--comparar', help='Arquivo de resultado anterior (padrão: o último com o mesmo --lotes)')
+    args = parser.parse_args()
+
+    selecionados = set(args.somente.split(',')) if args.somente else None
+    tp4.LIMIAR_CONSULTA_LENTA = float('inf')
+    resultados = {}
+    with PostgresDescartavel(args.bin_postgres, fsync=not args.sem_fsync) as postgres:
+        postgres.configurar_tp4()
+        dados = DadosSinteticos(args.lotes)
+        print(f'Gerando {args.lotes} lotes em {dados.n_unidades} unidades e {dados.n_medicamentos} medicamentos...')
+        resultados['carga'] = carregar(dados)
+        ctx = {
+            'dados': dados,
+            'repeticoes': args.repeticoes,
+            'lote_maximo': args.lote_maximo,
+            'duracao_http': args.duracao_http,
+        }
+        for nome, funcao in BENCHMARKS:
+            if selecionados and nome not in selecionados:
+                continue
+            print(f'Executando {nome}...')
+            resultados[nome] = funcao(ctx)
+        resultados['instrumentacao'] = tp4.estatisticas()
+        tp4.fechar_pool()
+
+    atual = {
+        'data': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': _commit_atual(),
+        'lotes': args.lotes,
+        'repeticoes': args.repeticoes,
+        'fsync': not args.sem_fsync,
+        'resultados': resultados,
+    }
+    os.makedirs(args.saida, exist_ok=True)
+    anterior = args.comparar or _ultimo_resultado(args.saida, args.lotes)
+    arquivo = os.path.join(args.saida, f"benchmark-{args.lotes}-{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(arquivo, 'w', encoding='utf-8') as saida:
+        json.dump(atual, saida, indent=2, ensure_ascii=False, default=str)
+    print(f'Resultados salvos em {arquivo}')
+
+    if anterior:
+        with open(anterior, encoding='utf-8') as entrada:
+            comparar(atual, json.load(entrada))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,563 @@
+# Réplica local (SQLite) para terminais de clínica: cadastros de medicamentos e unidades e
+# o estoque de uma unidade, sincronizados de forma incremental com o PostgreSQL central.
+# Leituras são sempre locais; escritas feitas sem conexão ficam numa fila e são reenviadas
+# com detecção de conflito quando o servidor central volta a responder.
+# python replica.py clinica.db --unidade 5
+
+import argparse
+import contextlib
+import datetime
+import sqlite3
+import threading
+import uuid
+
+import psycopg2
+import psycopg2.pool
+
+import tp4
+
+# Segundos entre sincronizações automáticas
+INTERVALO_SINCRONIZACAO = 60.0
+# Sem isso um servidor central inacessível prende cada tentativa no timeout do TCP
+TIMEOUT_CONEXAO_CENTRAL = 5
+ITENS_POR_LOTE_LOCAL = 1000
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS medicamento(
+    cod_anvisa_med TEXT PRIMARY KEY,
+    nome_comercial TEXT NOT NULL,
+    fabricante_med TEXT,
+    apresentacao_med TEXT,
+    forma_administracao_med TEXT,
+    principio_ativo_med TEXT NOT NULL,
+    versao_linha INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS unidadesaude(
+    cod_unidade INTEGER PRIMARY KEY,
+    nome_unidade TEXT NOT NULL,
+    tel_unidade TEXT,
+    tipo_unidade TEXT,
+    rua_end_unidade TEXT,
+    num_end_unidade INTEGER,
+    bairro_end_unidade TEXT,
+    cep_end_unidade TEXT,
+    versao_linha INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS medicamentoestocado(
+    lote_med TEXT,
+    cod_anvisa_med TEXT,
+    cod_unidade INTEGER,
+    validade_med_estoque TEXT,
+    quantidade_med_estoque INTEGER NOT NULL,
+    versao_linha INTEGER NOT NULL,
+    PRIMARY KEY(lote_med, cod_anvisa_med, cod_unidade)
+);
+
+CREATE TABLE IF NOT EXISTS sincronizacao(
+    tabela TEXT PRIMARY KEY,
+    watermark INTEGER NOT NULL,
+    sincronizada_em TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS escritapendente(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    operacao TEXT NOT NULL CHECK (operacao IN ('entrada', 'dispensacao', 'ajuste')),
+    lote_med TEXT NOT NULL,
+    cod_anvisa_med TEXT NOT NULL,
+    validade_med_estoque TEXT,
+    quantidade INTEGER NOT NULL,
+    versao_base INTEGER,
+    criada_em TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS identificacao(
+    id_replica TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS conflito(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    operacao TEXT NOT NULL,
+    lote_med TEXT NOT NULL,
+    cod_anvisa_med TEXT NOT NULL,
+    quantidade INTEGER NOT NULL,
+    motivo TEXT NOT NULL,
+    criada_em TEXT NOT NULL,
+    registrado_em TEXT NOT NULL
+);
+"""
+
+# tabela -> (colunas do modelo, chave, filtrada pela unidade da réplica)
+_TABELAS = {
+    'medicamento': (tp4.Medicamento.COLUNAS, ['cod_anvisa_med'], False),
+    'unidadesaude': (tp4.UnidadeSaude.COLUNAS, ['cod_unidade'], False),
+    'medicamentoestocado': (tp4.EstoqueMedicamento.COLUNAS, ['lote_med', 'cod_anvisa_med', 'cod_unidade'], True),
+}
+
+# Falhas que indicam servidor central fora do ar, e não erro da operação
+_ERROS_CONEXAO = (psycopg2.OperationalError, psycopg2.InterfaceError, psycopg2.pool.PoolError)
+
+def _agora():
+    return datetime.datetime.now().isoformat(timespec='seconds')
+
+def _estoque(linha):
+    lote, cod_anvisa, cod_unidade, validade, quantidade = linha
+    return tp4.EstoqueMedicamento(
+        lote, cod_anvisa, cod_unidade, datetime.date.fromisoformat(validade) if validade else None, quantidade)
+
+class ReplicaLocal:
+    def __init__(self, caminho, cod_unidade):
+        self.cod_unidade = int(cod_unidade)
+        self.db = sqlite3.connect(caminho, check_same_thread=False)
+        self.db.executescript(ESQUEMA)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.lock = threading.RLock()
+        # Um envio por vez: a sincronização automática e o envio após cada escrita não podem
+        # reaplicar a mesma linha da fila
+        self.envio = threading.Lock()
+        with self.lock, self.db:
+            linha = self.db.execute('SELECT id_replica FROM identificacao').fetchone()
+            if linha is None:
+                linha = (str(uuid.uuid4()),)
+                self.db.execute('INSERT INTO identificacao VALUES (?)', linha)
+        self.id_replica = linha[0]
+        self.online = None
+        self.ultimo_erro = None
+        self._parar = None
+
+    def fechar(self):
+        self.parar_sincronizacao()
+        self.db.close()
+
+    # ==== Leitura local
+    def get_medicamento(self, cod_anvisa):
+        with self.lock:
+            linha = self.db.execute(
+                f'SELECT {tp4.Medicamento.COLUNAS} FROM medicamento WHERE cod_anvisa_med = ?', (cod_anvisa,)).fetchone()
+        return tp4.Medicamento(*linha) if linha else None
+
+    def get_medicamentos(self):
+        with self.lock:
+            linhas = self.db.execute(
+                f'SELECT {tp4.Medicamento.COLUNAS} FROM medicamento ORDER BY cod_anvisa_med').fetchall()
+        return [tp4.Medicamento(*linha) for linha in linhas]
+
+    def buscar_medicamentos(self, termo, limite=20):
+        padrao = f'%{termo.strip()}%'
+        with self.lock:
+            linhas = self.db.execute(f"""
+            SELECT {tp4.Medicamento.COLUNAS} FROM medicamento
+            WHERE nome_comercial LIKE ? OR principio_ativo_med LIKE ?
+            ORDER BY nome_comercial
+            LIMIT ?
+            """, (padrao, padrao, limite)).fetchall()
+        return [tp4.Medicamento(*linha) for linha in linhas]
+
+    def get_unidade(self, cod_unidade):
+        with self.lock:
+            linha = self.db.execute(
+                f'SELECT {tp4.UnidadeSaude.COLUNAS} FROM unidadesaude WHERE cod_unidade = ?', (cod_unidade,)).fetchone()
+        return tp4.UnidadeSaude(*linha) if linha else None
+
+    def get_estoque_medicamentos(self):
+        with self.lock:
+            linhas = self.db.execute(f"""
+            SELECT {tp4.EstoqueMedicamento.COLUNAS} FROM medicamentoestocado
+            WHERE cod_unidade = ?
+            ORDER BY lote_med, cod_anvisa_med
+            """, (self.cod_unidade,)).fetchall()
+        return [_estoque(linha) for linha in linhas]
+
+    def get_estoque_medicamento(self, lote, cod_anvisa):
+        with self.lock:
+            linha = self.db.execute(f"""
+            SELECT {tp4.EstoqueMedicamento.COLUNAS} FROM medicamentoestocado
+            WHERE lote_med = ? AND cod_anvisa_med = ? AND cod_unidade = ?
+            """, (lote, cod_anvisa, self.cod_unidade)).fetchone()
+        return _estoque(linha) if linha else None
+
+    def pendencias(self):
+        with self.lock:
+            pendentes = self.db.execute(
+                'SELECT operacao, lote_med, cod_anvisa_med, quantidade, criada_em FROM escritapendente ORDER BY id').fetchall()
+            conflitos = self.db.execute(
+                'SELECT operacao, lote_med, cod_anvisa_med, quantidade, motivo, registrado_em FROM conflito ORDER BY id').fetchall()
+        return pendentes, conflitos
+
+    # ==== Escrita: aplicada localmente, enfileirada e enviada se o servidor central responder
+    def _enfileirar(self, operacao, lote, cod_anvisa, quantidade, validade=None, versao_base=None):
+        self.db.execute("""
+        INSERT INTO escritapendente (operacao, lote_med, cod_anvisa_med, validade_med_estoque, quantidade, versao_base, criada_em)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (operacao, lote, cod_anvisa, validade, quantidade, versao_base, _agora()))
+
+    def _versao_local(self, lote, cod_anvisa):
+        linha = self.db.execute("""
+        SELECT quantidade_med_estoque, versao_linha FROM medicamentoestocado
+        WHERE lote_med = ? AND cod_anvisa_med = ? AND cod_unidade = ?
+        """, (lote, cod_anvisa, self.cod_unidade)).fetchone()
+        return linha or (None, None)
+
+    def dispensar_medicamento(self, lote, cod_anvisa, quantidade):
+        quantidade = tp4._quantidade_valida(quantidade)
+        if quantidade is None:
+            return {'status': 'error', 'message': f'Quantidade inválida para o lote {lote} do medicamento {cod_anvisa}.'}
+        with self.lock, self.db:
+            saldo, versao = self._versao_local(lote, cod_anvisa)
+            if saldo is None:
+                return {'status': 'error', 'message': f"Lote {lote} do medicamento {cod_anvisa} não encontrado no estoque desta unidade."}
+            if saldo < quantidade:
+                return {'status': 'error', 'message': f"Quantidade solicitada do lote {lote} do medicamento {cod_anvisa} é maior que a disponível no estoque."}
+            self.db.execute("""
+            UPDATE medicamentoestocado SET quantidade_med_estoque = quantidade_med_estoque - ?
+            WHERE lote_med = ? AND cod_anvisa_med = ? AND cod_unidade = ?
+            """, (quantidade, lote, cod_anvisa, self.cod_unidade))
+            self._enfileirar('dispensacao', lote, cod_anvisa, quantidade, versao_base=versao)
+        self._tentar_enviar()
+        return {'status': 'success', 'message': 'Medicamento dispensado com sucesso.', 'saldos': [(lote, cod_anvisa, saldo - quantidade)]}
+
+    def update_estoque_medicamento(self, lote, cod_anvisa, quantidade):
+        # Zerar o lote é um ajuste válido; negativo ou não inteiro só viraria conflito no envio
+        quantidade = tp4._quantidade_valida(quantidade, minimo=0)
+        if quantidade is None:
+            return {'status': 'error', 'message': f'Quantidade inválida para o lote {lote} do medicamento {cod_anvisa}.'}
+        with self.lock, self.db:
+            saldo, versao = self._versao_local(lote, cod_anvisa)
+            if saldo is None:
+                return {'status': 'error', 'message': f"Lote {lote} do medicamento {cod_anvisa} não encontrado no estoque desta unidade."}
+            self.db.execute("""
+            UPDATE medicamentoestocado SET quantidade_med_estoque = ?
+            WHERE lote_med = ? AND cod_anvisa_med = ? AND cod_unidade = ?
+            """, (quantidade, lote, cod_anvisa, self.cod_unidade))
+            self._enfileirar('ajuste', lote, cod_anvisa, quantidade, versao_base=versao)
+        self._tentar_enviar()
+        return {'status': 'success', 'message': 'Medicamento no estoque atualizado com sucesso.'}
+
+    def post_estoque_medicamento(self, lote, cod_anvisa, validade, quantidade):
+        quantidade = tp4._quantidade_valida(quantidade, minimo=0)
+        if quantidade is None:
+            return {'status': 'error', 'message': f'Quantidade inválida para o lote {lote} do medicamento {cod_anvisa}.'}
+        validade = validade.isoformat() if validade else None
+        with self.lock, self.db:
+            if self._versao_local(lote, cod_anvisa)[0] is not None:
+                return {'status': 'error', 'message': 'Lote já cadastrado no estoque desta unidade.'}
+            if self.get_medicamento(cod_anvisa) is None:
+                return {'status': 'error', 'message': f'Medicamento {cod_anvisa} não encontrado.'}
+            # versao_linha 0: a versão real chega na próxima sincronização
+            self.db.execute(f"""
+            INSERT INTO medicamentoestocado ({tp4.EstoqueMedicamento.COLUNAS}, versao_linha) VALUES (?, ?, ?, ?, ?, 0)
+            """, (lote, cod_anvisa, self.cod_unidade, validade, quantidade))
+            self._enfileirar('entrada', lote, cod_anvisa, quantidade, validade=validade)
+        self._tentar_enviar()
+        return {'status': 'success', 'message': 'Medicamento adicionado ao estoque com sucesso.'}
+
+    # ==== Sincronização
+    def _tentar_enviar(self):
+        # Sem conexão a fila fica para a sincronização automática, para a escrita não esperar
+        # o timeout de conexão a cada operação
+        if self.online is not False:
+            self.enviar_pendentes()
+
+    def _reenviar(self, cursor, id_escrita, operacao, lote, cod_anvisa, validade, quantidade, versao_base):
+        # Aplica uma escrita da fila no servidor central; retorna (motivo do conflito, None)
+        # ou (None, nova versao_linha do lote). Escrita já aplicada antes só devolve a versão
+        cursor.execute("""
+        SELECT versao_linha FROM escritareplicaaplicada WHERE id_replica = %s AND id_escrita = %s
+        """, (self.id_replica, id_escrita))
+        aplicada = cursor.fetchone()
+        if aplicada:
+            return None, aplicada[0]
+        motivo, versao = self._aplicar(cursor, operacao, lote, cod_anvisa, validade, quantidade, versao_base)
+        if not motivo:
+            # Na mesma transação da escrita: ou as duas são confirmadas ou nenhuma
+            cursor.execute("""
+            INSERT INTO escritareplicaaplicada (id_replica, id_escrita, versao_linha) VALUES (%s, %s, %s)
+            """, (self.id_replica, id_escrita, versao))
+        return motivo, versao
+
+    def _aplicar(self, cursor, operacao, lote, cod_anvisa, validade, quantidade, versao_base):
+        chave = (lote, cod_anvisa, self.cod_unidade)
+        cursor.execute("""
+        SELECT quantidade_med_estoque, versao_linha FROM medicamentoestocado
+        WHERE lote_med = %s AND cod_anvisa_med = %s AND cod_unidade = %s
+        FOR UPDATE
+        """, chave)
+        atual = cursor.fetchone()
+        if operacao == 'entrada':
+            if atual is not None:
+                return 'Lote já cadastrado no servidor central.', None
+            cursor.execute(f"""
+            INSERT INTO medicamentoestocado ({tp4.EstoqueMedicamento.COLUNAS}) VALUES (%s, %s, %s, %s, %s)
+            RETURNING versao_linha
+            """, (lote, cod_anvisa, self.cod_unidade, validade, quantidade))
+            return None, cursor.fetchone()[0]
+        if atual is None:
+            return 'Lote não existe mais no servidor central.', None
+        if operacao == 'dispensacao':
+            # Baixa relativa: alterações feitas no servidor enquanto a réplica estava sem conexão
+            # não invalidam a dispensação, desde que o saldo central ainda cubra a quantidade
+            if atual[0] < quantidade:
+                return f'Saldo no servidor central ({atual[0]}) é menor que a quantidade dispensada.', None
+            cursor.execute("""
+            UPDATE medicamentoestocado SET quantidade_med_estoque = quantidade_med_estoque - %s
+            WHERE lote_med = %s AND cod_anvisa_med = %s AND cod_unidade = %s
+            RETURNING versao_linha
+            """, (quantidade, *chave))
+            return None, cursor.fetchone()[0]
+        # Ajuste absoluto: só vale se ninguém mexeu no lote desde a versão que a réplica conhecia
+        if atual[1] != versao_base:
+            return 'Lote alterado no servidor central depois da última sincronização.', None
+        cursor.execute("""
+        UPDATE medicamentoestocado SET quantidade_med_estoque = %s
+        WHERE lote_med = %s AND cod_anvisa_med = %s AND cod_unidade = %s
+        RETURNING versao_linha
+        """, (quantidade, *chave))
+        return None, cursor.fetchone()[0]
+
+    def enviar_pendentes(self):
+        with self.envio:
+            return self._enviar_pendentes()
+
+    def _enviar_pendentes(self):
+        # Reenvia a fila em ordem, uma transação por escrita; para na primeira falha de conexão
+        with self.lock:
+            pendentes = self.db.execute("""
+            SELECT id, operacao, lote_med, cod_anvisa_med, validade_med_estoque, quantidade, versao_base, criada_em
+            FROM escritapendente ORDER BY id
+            """).fetchall()
+        enviadas = conflitos = 0
+        for id_escrita, operacao, lote, cod_anvisa, validade, quantidade, versao_base, criada_em in pendentes:
+            try:
+                with tp4.conexao() as conn, conn.cursor() as cursor:
+                    tp4._tipo_movimentacao(cursor, operacao, f'Réplica da unidade {self.cod_unidade} ({criada_em})')
+                    motivo, versao = self._reenviar(cursor, id_escrita, operacao, lote, cod_anvisa, validade, quantidade, versao_base)
+                    if motivo:
+                        conn.rollback()
+                    else:
+                        conn.commit()
+            except _ERROS_CONEXAO as e:
+                self.online, self.ultimo_erro = False, str(e)
+                break
+            except psycopg2.Error as e:
+                motivo = str(e).strip()
+            self.online = True
+            with self.lock, self.db:
+                self.db.execute('DELETE FROM escritapendente WHERE id = ?', (id_escrita,))
+                if motivo:
+                    self.db.execute("""
+                    INSERT INTO conflito (operacao, lote_med, cod_anvisa_med, quantidade, motivo, criada_em, registrado_em)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """, (operacao, lote, cod_anvisa, quantidade, motivo, criada_em, _agora()))
+                    conflitos += 1
+                else:
+                    # As escritas seguintes no mesmo lote foram feitas sobre esta; passam a
+                    # ter como base a versão que ela gerou no servidor central
+                    self.db.execute("""
+                    UPDATE escritapendente SET versao_base = ?
+                    WHERE lote_med = ? AND cod_anvisa_med = ? AND id > ?
+                    """, (versao, lote, cod_anvisa, id_escrita))
+                    enviadas += 1
+        return enviadas, conflitos
+
+    def receber(self):
+        # Traz só o que mudou desde a última sincronização. O watermark é o xmin do snapshot
+        # usado na leitura: toda transação anterior a ele já estava visível, e as que estavam
+        # em andamento têm id >= xmin e são lidas de novo na próxima vez
+        with self.lock:
+            watermarks = dict(self.db.execute('SELECT tabela, watermark FROM sincronizacao').fetchall())
+        recebidas = 0
+        with tp4.conexao() as conn, conn.cursor() as cursor:
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+            cursor.execute('SELECT txid_snapshot_xmin(txid_current_snapshot())')
+            novo_watermark = cursor.fetchone()[0]
+            # Cada bloco é gravado numa transação curta do SQLite para não travar as leituras
+            # locais; se a sincronização parar no meio, o watermark antigo faz tudo ser relido
+            for tabela, (colunas, chave, por_unidade) in _TABELAS.items():
+                watermark = watermarks.get(tabela, 0)
+                filtro = 'AND cod_unidade = %(cod_unidade)s' if por_unidade else ''
+                params = {'watermark': watermark, 'cod_unidade': self.cod_unidade, 'tabela': tabela}
+                marcadores = ', '.join('?' * (len(colunas.split(',')) + 1))
+                with conn.cursor(name=f'replica_{tabela}') as leitura:
+                    leitura.itersize = tp4.ITERSIZE_CURSOR
+                    leitura.execute(
+                        f'SELECT {colunas}, versao_linha FROM {tabela} WHERE versao_linha >= %(watermark)s {filtro}',
+                        params)
+                    while linhas := leitura.fetchmany(ITENS_POR_LOTE_LOCAL):
+                        valores = [[valor.isoformat() if isinstance(valor, datetime.date) else valor for valor in linha]
+                                   for linha in linhas]
+                        with self.lock, self.db:
+                            self.db.executemany(
+                                f'INSERT OR REPLACE INTO {tabela} ({colunas}, versao_linha) VALUES ({marcadores})', valores)
+                        recebidas += len(linhas)
+
+                cursor.execute(f"""
+                SELECT chave, versao_linha FROM exclusaoreplicacao
+                WHERE tabela = %(tabela)s AND versao_linha >= %(watermark)s {filtro}
+                """, params)
+                # A linha pode ter sido recriada depois da exclusão: só remove versões anteriores
+                condicao = ' AND '.join(f'{coluna} = ?' for coluna in chave)
+                exclusoes = [(*valores, self.cod_unidade, versao) if por_unidade else (*valores, versao)
+                             for valores, versao in cursor.fetchall()]
+                with self.lock, self.db:
+                    self.db.executemany(f'DELETE FROM {tabela} WHERE {condicao} AND versao_linha < ?', exclusoes)
+                    self.db.execute('INSERT OR REPLACE INTO sincronizacao VALUES (?, ?, ?)', (tabela, novo_watermark, _agora()))
+            conn.commit()
+        return recebidas
+
+    def sincronizar(self):
+        # Envia a fila antes de receber: o que vier do servidor já reflete as escritas locais
+        try:
+            enviadas, conflitos = self.enviar_pendentes()
+            if self.online is False:
+                return {'status': 'error', 'message': f'Servidor central indisponível: {self.ultimo_erro}'}
+            recebidas = self.receber()
+        except _ERROS_CONEXAO as e:
+            self.online, self.ultimo_erro = False, str(e)
+            return {'status': 'error', 'message': f'Servidor central indisponível: {e}'}
+        self.online = True
+        return {
+            'status': 'success',
+            'message': f'{enviadas} escrita(s) enviada(s), {conflitos} conflito(s), {recebidas} linha(s) recebida(s).',
+            'enviadas': enviadas,
+            'conflitos': conflitos,
+            'recebidas': recebidas,
+        }
+
+    def iniciar_sincronizacao(self, intervalo=INTERVALO_SINCRONIZACAO):
+        if self._parar is not None:
+            return
+        self._parar = threading.Event()
+
+        def executar(parar):
+            while not parar.wait(intervalo):
+                self.sincronizar()
+
+        threading.Thread(target=executar, args=(self._parar,), name='tp4-replica', daemon=True).start()
+
+    def parar_sincronizacao(self):
+        if self._parar is not None:
+            self._parar.set()
+            self._parar = None
+
+# ==== Console menu functions
+def _menu_estoque(replica):
+    estoque = replica.get_estoque_medicamentos()
+    if not estoque:
+        print("Nenhum medicamento encontrado no estoque desta unidade.")
+        return
+    tp4.render_estoque_medicamentos(estoque)
+
+def _menu_medicamentos(replica):
+    medicamentos = replica.get_medicamentos()
+    if not medicamentos:
+        print("Nenhum medicamento encontrado.")
+        return
+    tp4.render_medicamentos(medicamentos)
+
+def _menu_buscar(replica):
+    medicamentos = replica.buscar_medicamentos(input("Nome comercial ou princípio ativo: "))
+    if not medicamentos:
+        print("Nenhum medicamento encontrado.")
+        return
+    tp4.render_medicamentos(medicamentos)
+
+def _menu_dispensar(replica):
+    lote = input("Lote do medicamento: ")
+    cod_anvisa = input("Código ANVISA do medicamento: ")
+    quantidade = input("Quantidade a ser diminuída do estoque: ")
+    result = replica.dispensar_medicamento(lote, cod_anvisa, quantidade)
+    if result['status'] == 'success':
+        _, _, saldo = result['saldos'][0]
+        print(f"Medicamento dispensado com sucesso. Saldo do lote: {saldo}.")
+    else:
+        print(f"Erro ao diminuir medicamento do estoque: {result['message']}")
+
+def _menu_ajustar(replica):
+    lote = input("Lote do medicamento: ")
+    cod_anvisa = input("Código ANVISA do medicamento: ")
+    quantidade = input("Nova quantidade no estoque: ")
+    print(replica.update_estoque_medicamento(lote, cod_anvisa, quantidade)['message'])
+
+def _menu_adicionar(replica):
+    lote = input("Lote do medicamento: ")
+    cod_anvisa = input("Código ANVISA do medicamento: ")
+    validade = input("Validade do medicamento (YYYY-MM-DD): ")
+    quantidade = input("Quantidade no estoque: ")
+    try:
+        validade = datetime.datetime.strptime(validade, '%Y-%m-%d').date()
+    except ValueError:
+        print("Data de validade inválida.")
+        return
+    print(replica.post_estoque_medicamento(lote, cod_anvisa, validade, quantidade)['message'])
+
+def _menu_sincronizar(replica):
+    print(replica.sincronizar()['message'])
+
+def _menu_pendencias(replica):
+    pendentes, conflitos = replica.pendencias()
+    print(f"{len(pendentes)} escrita(s) aguardando envio:")
+    for operacao, lote, cod_anvisa, quantidade, criada_em in pendentes:
+        print(f"  {criada_em} {operacao:<12} lote {lote} ({cod_anvisa}): {quantidade}")
+    print(f"{len(conflitos)} conflito(s):")
+    for operacao, lote, cod_anvisa, quantidade, motivo, registrado_em in conflitos:
+        print(f"  {registrado_em} {operacao:<12} lote {lote} ({cod_anvisa}): {quantidade} - {motivo}")
+
+cases = {
+    '1': _menu_estoque,
+    '2': _menu_medicamentos,
+    '3': _menu_buscar,
+    '4': _menu_dispensar,
+    '5': _menu_ajustar,
+    '6': _menu_adicionar,
+    '7': _menu_sincronizar,
+    '8': _menu_pendencias,
+}
+
+def main_menu(replica):
+    while True:
+        unidade = replica.get_unidade(replica.cod_unidade)
+        situacao = {True: 'online', False: 'sem conexão', None: 'não sincronizada'}[replica.online]
+        print(f"\nRéplica local - {unidade.nome if unidade else replica.cod_unidade} ({situacao})")
+        print("1. Listar Estoque da Unidade")
+        print("2. Listar Medicamentos")
+        print("3. Buscar Medicamento por Nome ou Princípio Ativo")
+        print("4. Dispensar Medicamento")
+        print("5. Ajustar Quantidade de um Lote")
+        print("6. Adicionar novo Lote ao Estoque")
+        print("7. Sincronizar agora")
+        print("8. Escritas pendentes e conflitos")
+        print("0. Sair")
+
+        print("")
+        choice = input("Escolha uma opção: ")
+        print("")
+
+        if choice == '0':
+            print("Saindo do programa...")
+            break
+
+        if choice in cases:
+            cases[choice](replica)
+        else:
+            print("Opção inválida. Tente novamente.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Terminal de clínica com réplica local do estoque.')
+    parser.add_argument('arquivo', help='Arquivo SQLite da réplica (criado se não existir)')
+    parser.add_argument('--unidade', type=int, required=True, help='Código da unidade de saúde deste terminal')
+    parser.add_argument('--intervalo', type=float, default=INTERVALO_SINCRONIZACAO,
+                        help='Segundos entre sincronizações automáticas')
+    args = parser.parse_args()
+
+    tp4.DB_CONFIG.setdefault('connect_timeout', TIMEOUT_CONEXAO_CENTRAL)
+    replica = ReplicaLocal(args.arquivo, args.unidade)
+    try:
+        with contextlib.suppress(*_ERROS_CONEXAO):
+            tp4.init()
+        print(replica.sincronizar()['message'])
+        replica.iniciar_sincronizacao(args.intervalo)
+        main_menu(replica)
+    finally:
+        replica.fechar()
+        tp4.fechar_pool()
@@ -0,0 +1,600 @@
+# Servidor HTTP para as rotas anotadas em tp4.py
+# python server.py --porta 8080
+
+import argparse
+import asyncio
+import concurrent.futures
+import datetime
+import decimal
+import json
+import re
+import urllib.parse
+
+import tp4
+
+HOST = '0.0.0.0'
+PORTA = 8080
+# Conexões keep-alive ociosas por mais tempo que isso são encerradas
+TIMEOUT_KEEP_ALIVE = 15.0
+TAMANHO_MAXIMO_CORPO = 16 * 1024 * 1024
+# Itens de uma listagem serializados por vez ao transmitir a resposta em chunks
+ITENS_POR_BLOCO = 500
+# Intervalo entre as atualizações dos saldos usados pelos relatórios (0 desliga)
+INTERVALO_ATUALIZACAO_RELATORIOS = 300.0
+# Com --fila-escrita, tempo que uma requisição espera vaga na fila cheia antes de responder 503
+TIMEOUT_FILA_ESCRITA = 1.0
+
+MENSAGENS_STATUS = {
+    200: 'OK',
+    201: 'Created',
+    202: 'Accepted',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+class ErroHttp(Exception):
+    def __init__(self, status, mensagem):
+        super().__init__(mensagem)
+        self.status = status
+
+class Texto(str):
+    # Resposta text/plain, usada pelas métricas no formato do Prometheus
+    pass
+
+class Listagem:
+    # Resposta transmitida em chunks a partir de um gerador de objetos do tp4
+    def __init__(self, gerador):
+        self.gerador = gerador
+
+def _serializar(obj):
+    if hasattr(type(obj), '__slots__'):
+        return {campo: getattr(obj, campo) for campo in type(obj).__slots__}
+    if isinstance(obj, (datetime.date, datetime.datetime)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    raise TypeError(f'{type(obj).__name__} não é serializável')
+
+def _json(dados):
+    return json.dumps(dados, default=_serializar, ensure_ascii=False).encode('utf-8')
+
+def _resultado(result, status_sucesso=200):
+    return (status_sucesso if result['status'] == 'success' else 400), result
+
+def _encontrado(obj, mensagem):
+    if obj is None:
+        raise ErroHttp(404, mensagem)
+    return 200, obj
+
+def _objeto(corpo):
+    if not isinstance(corpo, dict):
+        raise ErroHttp(400, 'O corpo da requisição deve ser um objeto JSON.')
+    return corpo
+
+def _lista(corpo, nome='O corpo da requisição'):
+    if not isinstance(corpo, list):
+        raise ErroHttp(400, f'{nome} deve ser uma lista JSON.')
+    return corpo
+
+def _campo(corpo, nome):
+    if not isinstance(corpo, dict) or nome not in corpo:
+        raise ErroHttp(400, f"Campo '{nome}' obrigatório.")
+    return corpo[nome]
+
+def _data(valor):
+    # Aceita também DD/MM/YYYY, o formato em que validade_med_estoque sai nas respostas
+    if valor in (None, ''):
+        return None
+    for formato in ('%Y-%m-%d', '%d/%m/%Y'):
+        try:
+            return datetime.datetime.strptime(valor, formato).date()
+        except (TypeError, ValueError):
+            pass
+    raise ErroHttp(400, f'Data inválida: {valor}. Use YYYY-MM-DD ou DD/MM/YYYY.')
+
+def _inteiro(query, nome, padrao=None):
+    if nome not in query:
+        return padrao
+    try:
+        return int(query[nome])
+    except ValueError:
+        raise ErroHttp(400, f'Parâmetro {nome} inválido.')
+
+def _pagina_ou_listagem(query, pagina, listagem, chave_apos=None):
+    if 'apos' not in query and 'limite' not in query:
+        return 200, Listagem(listagem())
+    try:
+        limite = int(query.get('limite', tp4.TAMANHO_PAGINA))
+    except ValueError:
+        raise ErroHttp(400, 'Parâmetro limite inválido.')
+    if limite < 1:
+        raise ErroHttp(400, 'Parâmetro limite deve ser maior que zero.')
+    apos = query.get('apos')
+    if apos is not None and chave_apos is not None:
+        # chave_apos levanta ValueError quando o cursor não tem o formato da chave da listagem
+        try:
+            apos = chave_apos(apos)
+        except ValueError:
+            raise ErroHttp(400, 'Parâmetro apos inválido.')
+    return 200, pagina(apos, limite)
+
+def _chave_lote(apos):
+    lote, cod_anvisa = apos.split(',', 1)
+    return lote, cod_anvisa
+
+def _importacao(corpo):
+    # Só aceita as linhas no corpo: um texto seria lido pelo tp4 como caminho de arquivo no
+    # servidor, o que fica restrito à linha de comando
+    return _lista(_campo(corpo, 'linhas'), "O campo 'linhas'"), corpo.get('upsert', False)
+
+def _medicamento(corpo, cod_anvisa=None):
+    corpo = _objeto(corpo)
+    try:
+        if cod_anvisa is not None:
+            corpo = {**corpo, 'cod_anvisa_med': cod_anvisa}
+        return tp4.Medicamento(**corpo)
+    except TypeError as e:
+        raise ErroHttp(400, str(e))
+
+def _unidade(corpo, cod_unidade=None):
+    corpo = _objeto(corpo)
+    try:
+        if cod_unidade is not None:
+            corpo = {**corpo, 'cod_unidade': cod_unidade}
+        return tp4.UnidadeSaude(**corpo)
+    except TypeError as e:
+        raise ErroHttp(400, str(e))
+
+def _estoque(corpo, cod_unidade=None):
+    corpo = _objeto(corpo)
+    try:
+        if cod_unidade is not None:
+            corpo = {**corpo, 'cod_unidade': cod_unidade}
+        corpo = {**corpo, 'validade_med_estoque': _data(corpo.get('validade_med_estoque'))}
+        return tp4.EstoqueMedicamento(**corpo)
+    except TypeError as e:
+        raise ErroHttp(400, str(e))
+
+# ==== Rotas
+ROTAS = []
+
+def rota(metodo, padrao):
+    def registrar(funcao):
+        ROTAS.append((metodo, re.compile(f'^{padrao}$'), funcao))
+        return funcao
+    return registrar
+
+def _escrita(nome, *args):
+    # Com a fila de escrita ativa a operação é confirmada no próximo COMMIT em grupo
+    fila = tp4.fila_escrita()
+    if fila is None:
+        return getattr(tp4, nome)(*args)
+    try:
+        return getattr(fila, nome)(*args, timeout=TIMEOUT_FILA_ESCRITA).result()
+    except tp4.FilaEscritaCheia as e:
+        raise ErroHttp(503, str(e))
+
+def _exclusao_em_etapas(funcao, chave):
+    # A exclusão continua em segundo plano; o andamento fica em GET /exclusoes/<id>
+    id_exclusao = tp4.iniciar_exclusao(funcao, chave)
+    return 202, {'status': 'running', 'id': id_exclusao, 'andamento': f'/exclusoes/{id_exclusao}'}
+
+# As rotas de lote e importação vêm antes de /medicamentos/<cod_anvisa> para não serem confundidas com um código
+@rota('POST', r'/medicamentos/lote')
+def _post_medicamentos(query, corpo):
+    return _resultado(tp4.post_medicamentos([_medicamento(item) for item in _lista(corpo)]), 201)
+
+@rota('PUT', r'/medicamentos/lote')
+def _update_medicamentos(query, corpo):
+    return _resultado(tp4.update_medicamentos([_medicamento(item) for item in _lista(corpo)]))
+
+@rota('DELETE', r'/medicamentos/lote')
+def _delete_medicamentos(query, corpo):
+    return _resultado(tp4.delete_medicamentos(_lista(corpo)))
+
+@rota('POST', r'/medicamentos/importacao')
+def _import_medicamentos(query, corpo):
+    return _resultado(tp4.import_medicamentos(*_importacao(corpo)))
+
+@rota('GET', r'/medicamentos/busca')
+def _buscar_medicamentos(query, corpo):
+    return 200, tp4.buscar_medicamentos(query.get('q', ''), _inteiro(query, 'limite', 20))
+
+@rota('GET', r'/medicamentos')
+def _get_medicamentos(query, corpo):
+    return _pagina_ou_listagem(query, tp4.get_medicamentos_pagina, tp4.iter_medicamentos)
+
+@rota('POST', r'/medicamentos')
+def _post_medicamento(query, corpo):
+    return _resultado(tp4.post_medicamento(_medicamento(corpo)), 201)
+
+@rota('GET', r'/medicamentos/(?P<cod_anvisa>[^/]+)')
+def _get_medicamento(query, corpo, cod_anvisa):
+    return _encontrado(tp4.get_medicamento(cod_anvisa), 'Medicamento não encontrado.')
+
+@rota('DELETE', r'/medicamentos/(?P<cod_anvisa>[^/]+)')
+def _delete_medicamento(query, corpo, cod_anvisa):
+    if query.get('em_etapas') in ('1', 'true'):
+        return _exclusao_em_etapas(tp4.delete_medicamento_em_etapas, cod_anvisa)
+    return _resultado(tp4.delete_medicamento(cod_anvisa))
+
+@rota('PUT', r'/medicamentos/(?P<cod_anvisa>[^/]+)')
+def _update_medicamento(query, corpo, cod_anvisa):
+    return _resultado(tp4.update_medicamento(_medicamento(corpo, cod_anvisa)))
+
+@rota('POST', r'/unidades/lote')
+def _post_unidades(query, corpo):
+    return _resultado(tp4.post_unidades([_unidade(item) for item in _lista(corpo)]), 201)
+
+@rota('PUT', r'/unidades/lote')
+def _update_unidades(query, corpo):
+    return _resultado(tp4.update_unidades([_unidade(item) for item in _lista(corpo)]))
+
+@rota('DELETE', r'/unidades/lote')
+def _delete_unidades(query, corpo):
+    return _resultado(tp4.delete_unidades(_lista(corpo)))
+
+@rota('POST', r'/unidades/importacao')
+def _import_unidades(query, corpo):
+    return _resultado(tp4.import_unidades(*_importacao(corpo)))
+
+@rota('POST', r'/unidades/medicamentos/lote')
+def _post_estoques(query, corpo):
+    return _resultado(tp4.post_estoques([_estoque(item) for item in _lista(corpo)]), 201)
+
+@rota('PUT', r'/unidades/medicamentos/lote')
+def _update_estoques(query, corpo):
+    return _resultado(tp4.update_estoques([_estoque(item) for item in _lista(corpo)]))
+
+@rota('POST', r'/unidades/medicamentos/importacao')
+def _import_estoque_medicamentos(query, corpo):
+    return _resultado(tp4.import_estoque_medicamentos(*_importacao(corpo)))
+
+@rota('GET', r'/unidades')
+def _get_unidades(query, corpo):
+    return _pagina_ou_listagem(query, tp4.get_unidades_pagina, tp4.iter_unidades, int)
+
+@rota('POST', r'/unidades')
+def _post_unidade(query, corpo):
+    return _resultado(tp4.post_unidade(_unidade(corpo)), 201)
+
+@rota('GET', r'/unidades/(?P<cod_unidade>\d+)')
+def _get_unidade(query, corpo, cod_unidade):
+    return _encontrado(tp4.get_unidade(cod_unidade), 'Unidade não encontrada.')
+
+@rota('DELETE', r'/unidades/(?P<cod_unidade>\d+)')
+def _delete_unidade(query, corpo, cod_unidade):
+    if query.get('em_etapas') in ('1', 'true'):
+        return _exclusao_em_etapas(tp4.delete_unidade_em_etapas, cod_unidade)
+    return _resultado(tp4.delete_unidade(cod_unidade))
+
+@rota('PUT', r'/unidades/(?P<cod_unidade>\d+)')
+def _update_unidade(query, corpo, cod_unidade):
+    return _resultado(tp4.update_unidade(_unidade(corpo, cod_unidade)))
+
+@rota('GET', r'/unidades/(?P<cod_unidade>\d+)/medicamentos')
+def _get_estoque_medicamentos(query, corpo, cod_unidade):
+    return _pagina_ou_listagem(
+        query,
+        lambda apos, limite: tp4.get_estoque_medicamentos_pagina(cod_unidade, apos, limite),
+        lambda: tp4.iter_estoque_medicamentos(cod_unidade),
+        _chave_lote)
+
+@rota('POST', r'/unidades/(?P<cod_unidade>\d+)/medicamentos')
+def _post_estoque_medicamento(query, corpo, cod_unidade):
+    return _resultado(_escrita('post_estoque_medicamento', _estoque(corpo, cod_unidade)), 201)
+
+@rota('PUT', r'/unidades/(?P<cod_unidade>\d+)/medicamentos')
+def _update_estoque_medicamento(query, corpo, cod_unidade):
+    return _resultado(_escrita('update_estoque_medicamento', _estoque(corpo, cod_unidade)))
+
+# Vem antes de /medicamentos/<lote>/<cod_anvisa> para 'saldo' não ser lido como código ANVISA
+@rota('GET', r'/unidades/(?P<cod_unidade>\d+)/medicamentos/(?P<cod_anvisa>[^/]+)/saldo')
+def _get_saldo_em(query, corpo, cod_unidade, cod_anvisa):
+    data = _data(query.get('data')) or datetime.date.today()
+    return 200, {'cod_unidade': int(cod_unidade), 'cod_anvisa_med': cod_anvisa, 'lote_med': query.get('lote'),
+                 'data': data, 'saldo': tp4.get_saldo_em(cod_unidade, cod_anvisa, data, query.get('lote'))}
+
+@rota('GET', r'/unidades/(?P<cod_unidade>\d+)/medicamentos/(?P<lote>[^/]+)/(?P<cod_anvisa>[^/]+)')
+def _get_estoque_medicamento(query, corpo, cod_unidade, lote, cod_anvisa):
+    return _encontrado(
+        tp4.get_estoque_medicamento(cod_unidade, lote, cod_anvisa),
+        'Medicamento não encontrado no estoque desta unidade.')
+
+@rota('POST', r'/unidades/(?P<cod_unidade>\d+)/dispensacoes')
+def _dispensar_medicamentos(query, corpo, cod_unidade):
+    itens = [(_campo(item, 'lote_med'), _campo(item, 'cod_anvisa_med'), _campo(item, 'quantidade'))
+             for item in _lista(_campo(corpo, 'itens'), "O campo 'itens'")]
+    return _resultado(_escrita('dispensar_medicamentos', cod_unidade, itens))
+
+@rota('POST', r'/unidades/(?P<cod_unidade>\d+)/medicamentos/(?P<lote>[^/]+)/(?P<cod_anvisa>[^/]+)/dispensacao')
+def _dispensar_medicamento(query, corpo, cod_unidade, lote, cod_anvisa):
+    return _resultado(_escrita('dispensar_medicamento', cod_unidade, lote, cod_anvisa, _campo(corpo, 'quantidade')))
+
+@rota('POST', r'/unidades/(?P<cod_unidade>\d+)/dispensacoes/fefo')
+def _dispensar_medicamentos_fefo(query, corpo, cod_unidade):
+    itens = [(_campo(item, 'cod_anvisa_med'), _campo(item, 'quantidade'))
+             for item in _lista(_campo(corpo, 'itens'), "O campo 'itens'")]
+    return _resultado(_escrita('dispensar_medicamentos_fefo', cod_unidade, itens))
+
+@rota('POST', r'/unidades/(?P<cod_unidade>\d+)/medicamentos/(?P<cod_anvisa>[^/]+)/dispensacao')
+def _dispensar_medicamento_fefo(query, corpo, cod_unidade, cod_anvisa):
+    return _resultado(_escrita('dispensar_medicamento_fefo', cod_unidade, cod_anvisa, _campo(corpo, 'quantidade')))
+
+@rota('POST', r'/unidades/(?P<cod_unidade>\d+)/transferencias')
+def _transferir_medicamentos(query, corpo, cod_unidade):
+    itens = [(_campo(item, 'lote_med'), _campo(item, 'cod_anvisa_med'), _campo(item, 'quantidade'))
+             for item in _lista(_campo(corpo, 'itens'), "O campo 'itens'")]
+    return _resultado(tp4.transferir_medicamentos(cod_unidade, _campo(corpo, 'cod_unidade_destino'), itens))
+
+@rota('GET', r'/estoque')
+def _get_estoque_detalhado(query, corpo):
+    filtros = (_inteiro(query, 'cod_unidade'), query.get('cod_anvisa'), _data(query.get('validade_desde')),
+               _data(query.get('validade_ate')), query.get('com_saldo') in ('1', 'true'))
+
+    def chave_apos(apos):
+        try:
+            cod_unidade, lote, cod_anvisa = apos.split(',', 2)
+            return int(cod_unidade), lote, cod_anvisa
+        except ValueError:
+            raise ErroHttp(400, 'Parâmetro apos inválido.')
+
+    return _pagina_ou_listagem(
+        query,
+        lambda apos, limite: tp4.get_estoque_detalhado_pagina(*filtros, apos, limite),
+        lambda: tp4.iter_estoque_detalhado(*filtros),
+        chave_apos)
+
+@rota('GET', r'/estoques')
+def _get_estoques(query, corpo):
+    try:
+        cod_unidades = [int(cod) for cod in _campo(query, 'unidades').split(',') if cod.strip()]
+    except ValueError:
+        raise ErroHttp(400, 'Parâmetro unidades inválido.')
+    estrategia = query.get('estrategia')
+    if estrategia not in (None, 'unica', 'paralela'):
+        raise ErroHttp(400, 'Parâmetro estrategia inválido.')
+    return 200, tp4.get_estoques(cod_unidades, estrategia)
+
+@rota('GET', r'/relatorios/vencendo')
+def _relatorio_vencendo(query, corpo):
+    return 200, tp4.relatorio_vencendo(_inteiro(query, 'dias', 30), _inteiro(query, 'cod_unidade'))
+
+@rota('GET', r'/relatorios/principio-ativo-bairro')
+def _relatorio_principio_ativo_bairro(query, corpo):
+    return 200, tp4.relatorio_principio_ativo_bairro(query.get('principio_ativo'), query.get('bairro'))
+
+@rota('POST', r'/relatorios/atualizacao')
+def _atualizar_relatorios(query, corpo):
+    return _resultado(tp4.atualizar_relatorios())
+
+@rota('GET', r'/relatorios/abaixo-reposicao')
+def _relatorio_abaixo_reposicao(query, corpo):
+    return 200, tp4.relatorio_abaixo_reposicao(_inteiro(query, 'quantidade_minima'), _inteiro(query, 'cod_unidade'))
+
+@rota('GET', r'/relatorios/consumo')
+def _relatorio_consumo(query, corpo):
+    return 200, tp4.relatorio_consumo(_inteiro(query, 'dias', 30), _inteiro(query, 'cod_unidade'), query.get('cod_anvisa'))
+
+@rota('GET', r'/unidades/(?P<cod_unidade>\d+)/medicamentos/(?P<lote>[^/]+)/(?P<cod_anvisa>[^/]+)/movimentacoes')
+def _get_movimentacoes(query, corpo, cod_unidade, lote, cod_anvisa):
+    return 200, tp4.get_movimentacoes(cod_unidade, lote, cod_anvisa, _data(query.get('desde')), _data(query.get('ate')))
+
+@rota('PUT', r'/unidades/(?P<cod_unidade>\d+)/medicamentos/(?P<cod_anvisa>[^/]+)/reposicao')
+def _update_ponto_reposicao(query, corpo, cod_unidade, cod_anvisa):
+    return _resultado(tp4.update_ponto_reposicao(cod_unidade, cod_anvisa, _campo(corpo, 'quantidade_minima')))
+
+@rota('GET', r'/exclusoes/(?P<id_exclusao>\d+)')
+def _get_exclusao(query, corpo, id_exclusao):
+    return _encontrado(tp4.get_exclusao(id_exclusao), 'Exclusão não encontrada.')
+
+@rota('GET', r'/metricas')
+def _metricas(query, corpo):
+    if query.get('formato') == 'json':
+        return 200, tp4.estatisticas()
+    return 200, Texto(tp4.estatisticas_prometheus())
+
+def _resolver(metodo, caminho):
+    metodos_permitidos = False
+    for metodo_rota, padrao, funcao in ROTAS:
+        encontrado = padrao.match(caminho)
+        if encontrado:
+            metodos_permitidos = True
+            if metodo_rota == metodo:
+                return funcao, {nome: urllib.parse.unquote(valor) for nome, valor in encontrado.groupdict().items()}
+    if metodos_permitidos:
+        raise ErroHttp(405, 'Método não permitido para esta rota.')
+    raise ErroHttp(404, 'Rota não encontrada.')
+
+# ==== Servidor
+def _proximo_bloco(gerador):
+    bloco = []
+    for item in gerador:
+        bloco.append(item)
+        if len(bloco) >= ITENS_POR_BLOCO:
+            break
+    return bloco
+
+def _cabecalho(status, manter_conexao, extras, tipo='application/json'):
+    linhas = [f'HTTP/1.1 {status} {MENSAGENS_STATUS.get(status, "")}',
+              f'Content-Type: {tipo}; charset=utf-8',
+              f'Connection: {"keep-alive" if manter_conexao else "close"}']
+    linhas.extend(extras)
+    return ('\r\n'.join(linhas) + '\r\n\r\n').encode('latin-1')
+
+def _corpo(dados):
+    if isinstance(dados, Texto):
+        return dados.encode('utf-8'), 'text/plain; version=0.0.4'
+    return _json(dados), 'application/json'
+
+async def _enviar(writer, status, corpo, tipo, manter_conexao):
+    writer.write(_cabecalho(status, manter_conexao, [f'Content-Length: {len(corpo)}'], tipo))
+    writer.write(corpo)
+    await writer.drain()
+
+async def _enviar_listagem(writer, executor, listagem, bloco, manter_conexao):
+    # bloco: primeiro bloco, já buscado por _processar antes de qualquer byte ser enviado
+    loop = asyncio.get_running_loop()
+    gerador = listagem.gerador
+    writer.write(_cabecalho(200, manter_conexao, ['Transfer-Encoding: chunked']))
+    try:
+        primeiro = True
+        while True:
+            if not primeiro:
+                bloco = await loop.run_in_executor(executor, _proximo_bloco, gerador)
+            if not bloco:
+                break
+            trecho = b',\n'.join(_json(item) for item in bloco)
+            trecho = (b'[' if primeiro else b',\n') + trecho
+            primeiro = False
+            writer.write(f'{len(trecho):x}\r\n'.encode('latin-1') + trecho + b'\r\n')
+            await writer.drain()
+        final = b'[]' if primeiro else b']'
+        writer.write(f'{len(final):x}\r\n'.encode('latin-1') + final + b'\r\n0\r\n\r\n')
+        await writer.drain()
+    finally:
+        # Devolve ao pool a conexão presa ao cursor nomeado mesmo se o cliente desconectar
+        await loop.run_in_executor(executor, gerador.close)
+
+async def _processar(writer, executor, metodo, alvo, corpo_bruto, manter_conexao):
+    url = urllib.parse.urlsplit(alvo)
+    query = dict(urllib.parse.parse_qsl(url.query))
+    try:
+        funcao, parametros = _resolver(metodo, url.path.rstrip('/') or '/')
+        try:
+            corpo = json.loads(corpo_bruto) if corpo_bruto else {}
+        except ValueError:
+            raise ErroHttp(400, 'Corpo da requisição não é um JSON válido.')
+        loop = asyncio.get_running_loop()
+        status, dados = await loop.run_in_executor(executor, lambda: funcao(query, corpo, **parametros))
+        if isinstance(dados, Listagem):
+            # A consulta só roda no primeiro FETCH; buscando o primeiro bloco aqui, um erro nela
+            # ainda vira 500, já que depois do cabeçalho 200 só restaria cortar a resposta no meio
+            try:
+                primeiro_bloco = await loop.run_in_executor(executor, _proximo_bloco, dados.gerador)
+            except BaseException:
+                await loop.run_in_executor(executor, dados.gerador.close)
+                raise
+            resposta = dados
+        else:
+            # Serializa aqui para um valor que o JSON não aceita virar 500 em vez de derrubar a conexão
+            resposta = _corpo(dados)
+    except ErroHttp as e:
+        status, resposta = e.status, _corpo({'status': 'error', 'message': str(e)})
+    except Exception as e:
+        status, resposta = 500, _corpo({'status': 'error', 'message': str(e)})
+
+    if isinstance(resposta, Listagem):
+        await _enviar_listagem(writer, executor, resposta, primeiro_bloco, manter_conexao)
+    else:
+        await _enviar(writer, status, *resposta, manter_conexao)
+
+async def _atender(reader, writer, executor):
+    try:
+        while True:
+            try:
+                linha = await asyncio.wait_for(reader.readline(), TIMEOUT_KEEP_ALIVE)
+            except asyncio.TimeoutError:
+                break
+            if not linha.strip():
+                break
+            try:
+                metodo, alvo, versao = linha.decode('latin-1').split()
+            except ValueError:
+                await _enviar(writer, 400, *_corpo({'status': 'error', 'message': 'Linha de requisição inválida.'}), False)
+                break
+
+            cabecalhos = {}
+            while True:
+                linha = await reader.readline()
+                if linha in (b'\r\n', b'\n', b''):
+                    break
+                nome, _, valor = linha.decode('latin-1').partition(':')
+                cabecalhos[nome.strip().lower()] = valor.strip()
+
+            conexao = cabecalhos.get('connection', '').lower()
+            if versao == 'HTTP/1.0':
+                manter_conexao = conexao == 'keep-alive'
+            else:
+                manter_conexao = conexao != 'close'
+
+            try:
+                tamanho = int(cabecalhos.get('content-length', 0) or 0)
+            except ValueError:
+                tamanho = -1
+            if tamanho < 0:
+                # Sem saber onde o corpo termina não dá para ler a próxima requisição da conexão
+                await _enviar(writer, 400, *_corpo({'status': 'error', 'message': 'Content-Length inválido.'}), False)
+                break
+            if tamanho > TAMANHO_MAXIMO_CORPO:
+                await _enviar(writer, 413, *_corpo({'status': 'error', 'message': 'Corpo da requisição muito grande.'}), False)
+                break
+            corpo = await reader.readexactly(tamanho) if tamanho else b''
+
+            await _processar(writer, executor, metodo.upper(), alvo, corpo, manter_conexao)
+            if not manter_conexao:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def _atualizar_relatorios_periodicamente(executor, intervalo):
+    # A primeira atualização é na subida, para uma instalação nova não servir a view vazia
+    loop = asyncio.get_running_loop()
+    while True:
+        result = await loop.run_in_executor(executor, tp4.atualizar_relatorios)
+        if result['status'] != 'success':
+            print(f"Falha ao atualizar relatórios: {result['message']}")
+        await asyncio.sleep(intervalo)
+
+async def servir(host=HOST, porta=PORTA, workers=None, intervalo_relatorios=INTERVALO_ATUALIZACAO_RELATORIOS):
+    # As funções do tp4 são bloqueantes e rodam num pool de threads; o padrão é uma
+    # thread por conexão do pool para nenhuma requisição ficar esperando conexão livre
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers or tp4.POOL_MAX_CONEXOES)
+    servidor = await asyncio.start_server(
+        lambda reader, writer: _atender(reader, writer, executor), host, porta)
+    # Cadastros alterados pelo console ou por outro servidor chegam por NOTIFY e limpam o cache
+    tp4.iniciar_invalidacao_remota()
+    atualizacao = None
+    if intervalo_relatorios:
+        atualizacao = asyncio.create_task(_atualizar_relatorios_periodicamente(executor, intervalo_relatorios))
+    print(f"Servidor ouvindo em http://{host}:{porta}")
+    try:
+        async with servidor:
+            await servidor.serve_forever()
+    finally:
+        if atualizacao is not None:
+            atualizacao.cancel()
+        tp4.parar_invalidacao_remota()
+        executor.shutdown(wait=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Servidor HTTP do sistema de estoque de medicamentos.')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--porta', type=int, default=PORTA)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--intervalo-relatorios', type=float, default=INTERVALO_ATUALIZACAO_RELATORIOS,
+                        help='segundos entre as atualizações dos relatórios; 0 desliga')
+    parser.add_argument('--fila-escrita', action='store_true',
+                        help='confirma dispensações e escritas de estoque em grupo (um COMMIT para várias requisições)')
+    args = parser.parse_args()
+
+    tp4.init()
+    workers = args.workers
+    if args.fila_escrita:
+        tp4.iniciar_fila_escrita()
+        # Threads paradas esperando o COMMIT do grupo não seguram conexão; com mais delas
+        # cabem mais requisições por grupo
+        workers = workers or tp4.FILA_TAMANHO_GRUPO
+    try:
+        asyncio.run(servir(args.host, args.porta, workers, args.intervalo_relatorios))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        tp4.parar_fila_escrita()
+        tp4.fechar_pool()
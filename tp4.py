@@ -1,45 +1,207 @@
 # pip install psycopg2-binary
 
+import argparse
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import datetime
+import functools
+import io
+import itertools
+import json
+import logging
+import os
+import queue
+import re
+import reprlib
+import select
+import shlex
+import shutil
+import subprocess
+import sys
+import threading
+import time
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
 from psycopg2 import sql
-import pandas as pd
-import warnings
 
-warnings.filterwarnings('ignore')
+DB_CONFIG = {
+    'user': 'postgres',
+    'password': 'postgres',
+    'host': 'localhost',
+}
 
-conn = psycopg2.connect(
-    dbname='postgres',
-    user='postgres',
-    password='postgres',
-    host='localhost')
+nome_db = 'saude'
 
-conn.autocommit = True
-cur = conn.cursor()
+# Tamanho do pool de conexões compartilhado pelas funções de acesso ao banco. O
+# ThreadedConnectionPool fecha as conexões acima do mínimo ao recebê-las de volta (e com
+# elas os prepared statements), então o mínimo é o próprio máximo
+POOL_MAX_CONEXOES = 10
+POOL_MIN_CONEXOES = POOL_MAX_CONEXOES
+# Conexões ociosas há mais tempo que isso são testadas com SELECT 1 antes do uso
+POOL_INTERVALO_HEALTH_CHECK = 30.0
+# Tempo máximo esperando uma conexão livre quando todas estão em uso
+POOL_TIMEOUT_CHECKOUT = 30.0
 
-nome_db = 'saude'
+# ==== Pool de conexões
+_pool = None
+_pool_lock = threading.Lock()
+_vagas = None
+_ultimo_uso = {}
+
+class _Conexao(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Comandos já preparados nesta sessão; somem junto com a conexão quando ela é fechada
+        self.preparados = set()
+
+def _get_pool():
+    global _pool, _vagas
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # O ThreadedConnectionPool falha na hora quando esgota; o semáforo
+                # faz quem chega depois esperar uma conexão ser devolvida
+                _vagas = threading.BoundedSemaphore(POOL_MAX_CONEXOES)
+                _pool = psycopg2.pool.ThreadedConnectionPool(
+                    POOL_MIN_CONEXOES, POOL_MAX_CONEXOES, dbname=nome_db,
+                    connection_factory=_Conexao, cursor_factory=_CursorInstrumentado, **DB_CONFIG)
+    return _pool
+
+def _conexao_saudavel(conn):
+    if conn.closed:
+        return False
+    if time.monotonic() - _ultimo_uso.get(id(conn), 0.0) < POOL_INTERVALO_HEALTH_CHECK:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _checkout():
+    pool = _get_pool()
+    # Uma conexão quebrada é descartada e substituída por uma nova; se todas as
+    # tentativas falharem o erro do servidor é propagado para quem chamou
+    for _ in range(POOL_MAX_CONEXOES + 1):
+        conn = pool.getconn()
+        if _conexao_saudavel(conn):
+            return conn
+        _ultimo_uso.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+    raise psycopg2.OperationalError('Não foi possível obter uma conexão válida com o banco.')
+
+def _conexao_perdida(erro):
+    # Deadlock, falha de serialização e statement_timeout também são OperationalError, mas a
+    # sessão continua boa (e com seus prepared statements); só a classe 08 ou erro sem SQLSTATE
+    # (conexão caiu antes de o servidor responder) indicam conexão quebrada
+    if isinstance(erro, psycopg2.InterfaceError):
+        return True
+    if isinstance(erro, psycopg2.OperationalError):
+        return erro.pgcode is None or erro.pgcode.startswith('08')
+    return False
+
+@contextlib.contextmanager
+def conexao():
+    pool = _get_pool()
+    vagas = _vagas
+    if not vagas.acquire(timeout=POOL_TIMEOUT_CHECKOUT):
+        raise psycopg2.pool.PoolError('Tempo esgotado esperando uma conexão livre no pool.')
+    try:
+        conn = _checkout()
+    except BaseException:
+        vagas.release()
+        raise
+    descartar = False
+    try:
+        yield conn
+    except Exception as e:
+        descartar = bool(conn.closed) or _conexao_perdida(e)
+        if not descartar:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                descartar = True
+        raise
+    finally:
+        descartar = descartar or bool(conn.closed)
+        if descartar:
+            _ultimo_uso.pop(id(conn), None)
+        else:
+            _ultimo_uso[id(conn)] = time.monotonic()
+        pool.putconn(conn, close=descartar)
+        vagas.release()
+
+def fechar_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _ultimo_uso.clear()
+
+# ==== Prepared statements
+# Consultas quentes são preparadas uma vez por conexão e depois executadas pelo nome
+USAR_PREPARED_STATEMENTS = True
 
-cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (nome_db,))
-flag_exist = cur.fetchone()
+_textos_preparados = {}
 
-if not flag_exist:
-    cur.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(nome_db)))
-    print(f"Database '{nome_db}' criado com sucesso.")
-else:
-    print(f"Database '{nome_db}' já existe.")
+def _texto_preparado(nome, query):
+    texto = _textos_preparados.get(nome)
+    if texto is None:
+        posicao = itertools.count(1)
+        texto = re.sub(r'%s', lambda _: f'${next(posicao)}', query)
+        _textos_preparados[nome] = texto
+    return texto
 
-cur.close()
-conn.close()
+def _preparar(cursor, nome, query):
+    nomes = cursor.connection.preparados
+    if nome in nomes:
+        return
+    # O savepoint mantém a transação utilizável se a sessão já tinha o comando preparado
+    cursor.execute('SAVEPOINT tp4_preparar')
+    try:
+        cursor.execute(sql.SQL('PREPARE {} AS {}').format(sql.Identifier(nome), sql.SQL(_texto_preparado(nome, query))))
+    except psycopg2.errors.DuplicatePreparedStatement:
+        cursor.execute('ROLLBACK TO SAVEPOINT tp4_preparar')
+    else:
+        cursor.execute('RELEASE SAVEPOINT tp4_preparar')
+    nomes.add(nome)
 
-conn = psycopg2.connect(
-    dbname=nome_db,
-    user='postgres',
-    password='postgres',
-    host='localhost')
+def _executar_preparado(cursor, nome, query, params):
+    conn = cursor.connection
+    # Conexões abertas fora do pool não guardam o que foi preparado
+    if not USAR_PREPARED_STATEMENTS or not isinstance(conn, _Conexao):
+        cursor.execute(query, params)
+        return
+    inicio_transacao = conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    comando = sql.SQL('EXECUTE {} ({})').format(sql.Identifier(nome), sql.SQL(', ').join(sql.Placeholder() * len(params)))
+    _preparar(cursor, nome, query)
+    try:
+        cursor.execute(comando, params)
+    except psycopg2.errors.InvalidSqlStatementName:
+        # A sessão perdeu os comandos preparados (ex.: DISCARD ALL feito por um proxy);
+        # só dá para repetir se nada mais foi feito nesta transação
+        conn.preparados.clear()
+        if not inicio_transacao:
+            raise
+        conn.rollback()
+        _preparar(cursor, nome, query)
+        cursor.execute(comando, params)
 
-if not flag_exist:
-    cur = conn.cursor()
-    create_tables_sql = """
-    CREATE TABLE unidadesaude(
+# ==== Inicialização do banco
+# Cada migração é aplicada uma única vez, em ordem, e registrada em schema_migracao.
+# A primeira usa IF NOT EXISTS para adotar bancos criados antes deste controle.
+MIGRACOES = [
+    """
+    CREATE TABLE IF NOT EXISTS unidadesaude(
         cod_unidade INTEGER PRIMARY KEY,
         nome_unidade VARCHAR(100) UNIQUE NOT NULL,
         tel_unidade VARCHAR(11),
@@ -50,7 +212,7 @@ if not flag_exist:
         cep_end_unidade VARCHAR(8)
     );
 
-    CREATE TABLE medicamento(
+    CREATE TABLE IF NOT EXISTS medicamento(
         cod_anvisa_med VARCHAR(13) PRIMARY KEY,
         nome_comercial VARCHAR(100) NOT NULL,
         fabricante_med VARCHAR(50),
@@ -59,7 +221,7 @@ if not flag_exist:
         principio_ativo_med VARCHAR(50) NOT NULL
     );
 
-    CREATE TABLE medicamentoestocado(
+    CREATE TABLE IF NOT EXISTS medicamentoestocado(
         lote_med VARCHAR(7),
         cod_anvisa_med VARCHAR(13),
         cod_unidade INTEGER,
@@ -71,16 +233,308 @@ if not flag_exist:
         CONSTRAINT fkmedestoqueunidadesaude FOREIGN KEY(cod_unidade)
             REFERENCES unidadesaude(cod_unidade) ON DELETE CASCADE ON UPDATE CASCADE
     );
+    """,
+    # Busca de lotes por unidade + medicamento em ordem de validade (dispensação FEFO)
+    """
+    CREATE INDEX IF NOT EXISTS idxmedestoqueunidademedvalidade
+        ON medicamentoestocado(cod_unidade, cod_anvisa_med, validade_med_estoque);
+    """,
+    # Relatórios: vencimentos da rede, ponto de reposição e saldo válido por unidade/medicamento
     """
+    CREATE INDEX IF NOT EXISTS idxmedestoquevalidadecomsaldo
+        ON medicamentoestocado(validade_med_estoque) WHERE quantidade_med_estoque > 0;
 
-    cur.execute(create_tables_sql)
-    conn.commit()
-    
+    CREATE TABLE IF NOT EXISTS pontoreposicao(
+        cod_unidade INTEGER,
+        cod_anvisa_med VARCHAR(13),
+        quantidade_minima INTEGER NOT NULL CHECK (quantidade_minima >= 0),
+        CONSTRAINT pkpontoreposicao PRIMARY KEY(cod_unidade, cod_anvisa_med),
+        CONSTRAINT fkpontoreposicaounidadesaude FOREIGN KEY(cod_unidade)
+            REFERENCES unidadesaude(cod_unidade) ON DELETE CASCADE ON UPDATE CASCADE,
+        CONSTRAINT fkpontoreposicaomedicamento FOREIGN KEY(cod_anvisa_med)
+            REFERENCES medicamento(cod_anvisa_med) ON DELETE CASCADE ON UPDATE CASCADE
+    );
+
+    CREATE MATERIALIZED VIEW IF NOT EXISTS mvsaldounidademedicamento AS
+        SELECT cod_unidade, cod_anvisa_med,
+               SUM(quantidade_med_estoque) AS quantidade,
+               MIN(validade_med_estoque) AS proxima_validade
+        FROM medicamentoestocado
+        WHERE quantidade_med_estoque > 0
+          AND (validade_med_estoque IS NULL OR validade_med_estoque >= CURRENT_DATE)
+        GROUP BY cod_unidade, cod_anvisa_med;
+
+    CREATE UNIQUE INDEX IF NOT EXISTS idxmvsaldounidademedicamento
+        ON mvsaldounidademedicamento(cod_unidade, cod_anvisa_med);
+    """,
+    # Busca por trecho do nome comercial ou do princípio ativo, sem diferenciar acentos;
+    # unaccent() não é IMMUTABLE, então os índices usam um wrapper com o dicionário fixo
+    """
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    CREATE EXTENSION IF NOT EXISTS unaccent;
+
+    CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+        AS $$ SELECT public.unaccent('public.unaccent', lower($1)) $$;
+
+    CREATE INDEX IF NOT EXISTS idxmedicamentonometrgm
+        ON medicamento USING gin (f_unaccent(nome_comercial) gin_trgm_ops);
+    CREATE INDEX IF NOT EXISTS idxmedicamentoprincipiotrgm
+        ON medicamento USING gin (f_unaccent(principio_ativo_med) gin_trgm_ops);
+    """,
+    # Histórico de movimentações: toda mudança de saldo em medicamentoestocado vira uma linha
+    # em movimentacaoestoque (particionada por mês) via trigger por comando; meses fechados
+    # são consolidados em saldomensalestoque por compactar_movimentacoes()
+    """
+    CREATE TABLE IF NOT EXISTS movimentacaoestoque(
+        id_mov BIGSERIAL,
+        data_mov TIMESTAMPTZ NOT NULL DEFAULT now(),
+        lote_med VARCHAR(7) NOT NULL,
+        cod_anvisa_med VARCHAR(13) NOT NULL,
+        cod_unidade INTEGER NOT NULL,
+        tipo_mov VARCHAR(13) NOT NULL
+            CHECK (tipo_mov IN ('entrada', 'dispensacao', 'transferencia', 'ajuste')),
+        quantidade_mov INTEGER NOT NULL,
+        observacao_mov VARCHAR(100),
+        CONSTRAINT pkmovimentacaoestoque PRIMARY KEY(id_mov, data_mov)
+    ) PARTITION BY RANGE (data_mov);
 
-    cur.close()
+    CREATE TABLE IF NOT EXISTS movimentacaoestoque_padrao PARTITION OF movimentacaoestoque DEFAULT;
+
+    CREATE INDEX IF NOT EXISTS idxmovimentacaoestoquelote
+        ON movimentacaoestoque(cod_unidade, cod_anvisa_med, lote_med, data_mov);
+
+    CREATE OR REPLACE FUNCTION criar_particao_movimentacao(mes DATE) RETURNS void LANGUAGE plpgsql AS $$
+    DECLARE
+        inicio TIMESTAMPTZ := date_trunc('month', mes);
+        fim TIMESTAMPTZ := date_trunc('month', mes) + INTERVAL '1 month';
+        nome TEXT := 'movimentacaoestoque_' || to_char(mes, 'YYYYMM');
+    BEGIN
+        IF to_regclass(nome) IS NOT NULL THEN
+            RETURN;
+        END IF;
+        -- Linhas do mês que caíram na partição padrão antes desta existir são movidas para ela
+        EXECUTE format('CREATE TABLE %I (LIKE movimentacaoestoque INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', nome);
+        EXECUTE format('WITH movidas AS (DELETE FROM movimentacaoestoque_padrao WHERE data_mov >= %L AND data_mov < %L RETURNING *) '
+                       'INSERT INTO %I SELECT * FROM movidas', inicio, fim, nome);
+        EXECUTE format('ALTER TABLE movimentacaoestoque ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', nome, inicio, fim);
+    END $$;
+
+    SELECT criar_particao_movimentacao((CURRENT_DATE + make_interval(months => m))::date)
+    FROM generate_series(0, 2) m;
+
+    CREATE TABLE IF NOT EXISTS saldomensalestoque(
+        cod_unidade INTEGER,
+        cod_anvisa_med VARCHAR(13),
+        lote_med VARCHAR(7),
+        mes DATE,
+        saldo INTEGER NOT NULL,
+        entradas INTEGER NOT NULL,
+        saidas INTEGER NOT NULL,
+        dispensado INTEGER NOT NULL,
+        CONSTRAINT pksaldomensalestoque PRIMARY KEY(cod_unidade, cod_anvisa_med, lote_med, mes)
+    );
+
+    CREATE TABLE IF NOT EXISTS compactacaomovimentacao(
+        mes DATE PRIMARY KEY,
+        compactada_em TIMESTAMP NOT NULL DEFAULT now()
+    );
+
+    INSERT INTO movimentacaoestoque (lote_med, cod_anvisa_med, cod_unidade, tipo_mov, quantidade_mov, observacao_mov)
+    SELECT lote_med, cod_anvisa_med, cod_unidade, 'ajuste', quantidade_med_estoque, 'Saldo inicial'
+    FROM medicamentoestocado
+    WHERE quantidade_med_estoque <> 0;
+
+    -- O tipo e a observação vêm de tp4.tipo_movimentacao/tp4.observacao_movimentacao, definidos
+    -- com set_config(..., true) na transação; sem eles inserção é entrada e o resto é ajuste
+    CREATE OR REPLACE FUNCTION registrar_movimentacao() RETURNS trigger LANGUAGE plpgsql AS $$
+    DECLARE
+        tipo TEXT := NULLIF(current_setting('tp4.tipo_movimentacao', true), '');
+        observacao TEXT := NULLIF(current_setting('tp4.observacao_movimentacao', true), '');
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO movimentacaoestoque (lote_med, cod_anvisa_med, cod_unidade, tipo_mov, quantidade_mov, observacao_mov)
+            SELECT lote_med, cod_anvisa_med, cod_unidade, COALESCE(tipo, 'entrada'), quantidade_med_estoque, observacao
+            FROM novos
+            WHERE quantidade_med_estoque <> 0;
+        ELSIF TG_OP = 'UPDATE' THEN
+            INSERT INTO movimentacaoestoque (lote_med, cod_anvisa_med, cod_unidade, tipo_mov, quantidade_mov, observacao_mov)
+            SELECT n.lote_med, n.cod_anvisa_med, n.cod_unidade, COALESCE(tipo, 'ajuste'),
+                   n.quantidade_med_estoque - a.quantidade_med_estoque, observacao
+            FROM novos n
+            JOIN antigos a USING (lote_med, cod_anvisa_med, cod_unidade)
+            WHERE n.quantidade_med_estoque <> a.quantidade_med_estoque;
+        ELSE
+            INSERT INTO movimentacaoestoque (lote_med, cod_anvisa_med, cod_unidade, tipo_mov, quantidade_mov, observacao_mov)
+            SELECT lote_med, cod_anvisa_med, cod_unidade, COALESCE(tipo, 'ajuste'), -quantidade_med_estoque, observacao
+            FROM antigos
+            WHERE quantidade_med_estoque <> 0;
+        END IF;
+        RETURN NULL;
+    END $$;
+
+    CREATE TRIGGER trgmovimentacaoinsercao AFTER INSERT ON medicamentoestocado
+        REFERENCING NEW TABLE AS novos
+        FOR EACH STATEMENT EXECUTE FUNCTION registrar_movimentacao();
+    CREATE TRIGGER trgmovimentacaoalteracao AFTER UPDATE ON medicamentoestocado
+        REFERENCING OLD TABLE AS antigos NEW TABLE AS novos
+        FOR EACH STATEMENT EXECUTE FUNCTION registrar_movimentacao();
+    CREATE TRIGGER trgmovimentacaoexclusao AFTER DELETE ON medicamentoestocado
+        REFERENCING OLD TABLE AS antigos
+        FOR EACH STATEMENT EXECUTE FUNCTION registrar_movimentacao();
+    """,
+    # Listagem detalhada do estoque: por unidade em ordem de lote (keyset) e por medicamento
+    # em qualquer unidade. A migração 10 tira quantidade_med_estoque do INCLUDE
+    """
+    CREATE INDEX IF NOT EXISTS idxmedestoqueunidadelote
+        ON medicamentoestocado(cod_unidade, lote_med, cod_anvisa_med)
+        INCLUDE (validade_med_estoque, quantidade_med_estoque);
+    CREATE INDEX IF NOT EXISTS idxmedestoquemedicamentounidade
+        ON medicamentoestocado(cod_anvisa_med, cod_unidade);
+    """,
+    # Sincronização incremental das réplicas locais (replica.py): versao_linha guarda o id da
+    # transação que gravou a linha por último e exclusaoreplicacao registra as exclusões.
+    # O DEFAULT entra depois do ADD COLUMN para não reescrever as tabelas existentes
+    """
+    ALTER TABLE medicamento ADD COLUMN IF NOT EXISTS versao_linha BIGINT NOT NULL DEFAULT 0;
+    ALTER TABLE unidadesaude ADD COLUMN IF NOT EXISTS versao_linha BIGINT NOT NULL DEFAULT 0;
+    ALTER TABLE medicamentoestocado ADD COLUMN IF NOT EXISTS versao_linha BIGINT NOT NULL DEFAULT 0;
+    ALTER TABLE medicamento ALTER COLUMN versao_linha SET DEFAULT txid_current();
+    ALTER TABLE unidadesaude ALTER COLUMN versao_linha SET DEFAULT txid_current();
+    ALTER TABLE medicamentoestocado ALTER COLUMN versao_linha SET DEFAULT txid_current();
+
+    CREATE INDEX IF NOT EXISTS idxmedicamentoversao ON medicamento(versao_linha);
+    CREATE INDEX IF NOT EXISTS idxunidadesaudeversao ON unidadesaude(versao_linha);
+    CREATE INDEX IF NOT EXISTS idxmedestoqueunidadeversao ON medicamentoestocado(cod_unidade, versao_linha);
+
+    CREATE OR REPLACE FUNCTION atualizar_versao_linha() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        NEW.versao_linha := txid_current();
+        RETURN NEW;
+    END $$;
+
+    CREATE TRIGGER trgversaomedicamento BEFORE UPDATE ON medicamento
+        FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE FUNCTION atualizar_versao_linha();
+    CREATE TRIGGER trgversaounidadesaude BEFORE UPDATE ON unidadesaude
+        FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE FUNCTION atualizar_versao_linha();
+    CREATE TRIGGER trgversaomedicamentoestocado BEFORE UPDATE ON medicamentoestocado
+        FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE FUNCTION atualizar_versao_linha();
+
+    CREATE TABLE IF NOT EXISTS exclusaoreplicacao(
+        id_exclusao BIGSERIAL PRIMARY KEY,
+        tabela VARCHAR(30) NOT NULL,
+        chave TEXT[] NOT NULL,
+        cod_unidade INTEGER,
+        versao_linha BIGINT NOT NULL DEFAULT txid_current()
+    );
+    CREATE INDEX IF NOT EXISTS idxexclusaoreplicacaoversao ON exclusaoreplicacao(tabela, versao_linha);
+
+    CREATE OR REPLACE FUNCTION registrar_exclusao() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_TABLE_NAME = 'medicamento' THEN
+            INSERT INTO exclusaoreplicacao (tabela, chave)
+            SELECT TG_TABLE_NAME, ARRAY[cod_anvisa_med] FROM antigos;
+        ELSIF TG_TABLE_NAME = 'unidadesaude' THEN
+            INSERT INTO exclusaoreplicacao (tabela, chave, cod_unidade)
+            SELECT TG_TABLE_NAME, ARRAY[cod_unidade::text], cod_unidade FROM antigos;
+        ELSE
+            INSERT INTO exclusaoreplicacao (tabela, chave, cod_unidade)
+            SELECT TG_TABLE_NAME, ARRAY[lote_med, cod_anvisa_med], cod_unidade FROM antigos;
+        END IF;
+        RETURN NULL;
+    END $$;
+
+    CREATE TRIGGER trgexclusaomedicamento AFTER DELETE ON medicamento
+        REFERENCING OLD TABLE AS antigos
+        FOR EACH STATEMENT EXECUTE FUNCTION registrar_exclusao();
+    CREATE TRIGGER trgexclusaounidadesaude AFTER DELETE ON unidadesaude
+        REFERENCING OLD TABLE AS antigos
+        FOR EACH STATEMENT EXECUTE FUNCTION registrar_exclusao();
+    CREATE TRIGGER trgexclusaomedicamentoestocado AFTER DELETE ON medicamentoestocado
+        REFERENCING OLD TABLE AS antigos
+        FOR EACH STATEMENT EXECUTE FUNCTION registrar_exclusao();
+    """,
+    # Índices das FKs usados pelo ON DELETE CASCADE; em medicamentoestocado as duas colunas
+    # já abrem índices (idxmedestoqueunidadelote e idxmedestoquemedicamentounidade)
+    """
+    CREATE INDEX IF NOT EXISTS idxpontoreposicaomedicamento ON pontoreposicao(cod_anvisa_med);
+    """,
+    # Escritas de réplicas já aplicadas: reenviar a mesma escrita (processo que caiu antes de
+    # tirá-la da fila local) devolve a versão gravada em vez de aplicar de novo
+    """
+    CREATE TABLE IF NOT EXISTS escritareplicaaplicada(
+        id_replica UUID NOT NULL,
+        id_escrita BIGINT NOT NULL,
+        versao_linha BIGINT NOT NULL,
+        aplicada_em TIMESTAMP NOT NULL DEFAULT now(),
+        PRIMARY KEY (id_replica, id_escrita)
+    );
+    """,
+    # quantidade_med_estoque muda a cada dispensação; estando no INCLUDE, toda dispensação
+    # atualizava também idxmedestoqueunidadelote e deixava de ser HOT. A listagem por unidade
+    # segue ordenada pelo índice e busca só a quantidade na tabela
+    """
+    DROP INDEX IF EXISTS idxmedestoqueunidadelote;
+    CREATE INDEX idxmedestoqueunidadelote
+        ON medicamentoestocado(cod_unidade, lote_med, cod_anvisa_med)
+        INCLUDE (validade_med_estoque);
+    """,
+]
+
+# Chaves dos advisory locks que serializam migrações e compactações de processos diferentes
+_LOCK_MIGRACAO = 4_020_001
+_LOCK_COMPACTACAO = 4_020_002
+
+_inicializado = False
+_init_lock = threading.Lock()
+
+def _criar_database():
+    conn = psycopg2.connect(dbname='postgres', **DB_CONFIG)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (nome_db,))
+            if cur.fetchone():
+                return
+            cur.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(nome_db)))
+            print(f"Database '{nome_db}' criado com sucesso.")
+    except psycopg2.errors.DuplicateDatabase:
+        pass
+    finally:
+        conn.close()
+
+def migrar():
+    with conexao() as conn, conn.cursor() as cur:
+        cur.execute('SELECT pg_advisory_xact_lock(%s)', (_LOCK_MIGRACAO,))
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migracao(
+            versao INTEGER PRIMARY KEY,
+            aplicada_em TIMESTAMP NOT NULL DEFAULT now()
+        )
+        """)
+        cur.execute('SELECT COALESCE(MAX(versao), 0) FROM schema_migracao')
+        versao_atual = cur.fetchone()[0]
+        for versao, ddl in enumerate(MIGRACOES, start=1):
+            if versao > versao_atual:
+                cur.execute(ddl)
+                cur.execute('INSERT INTO schema_migracao (versao) VALUES (%s)', (versao,))
+        conn.commit()
+
+def init():
+    # Cria o database e aplica as migrações pendentes; chamadas seguintes não fazem nada
+    global _inicializado
+    with _init_lock:
+        if not _inicializado:
+            _criar_database()
+            migrar()
+            criar_particoes_movimentacao()
+            _inicializado = True
 
 
 class Medicamento:
+    __slots__ = ('cod_anvisa', 'nome_comercial', 'fabricante', 'apresentacao', 'forma_administracao', 'principio_ativo')
+    COLUNAS = 'cod_anvisa_med, nome_comercial, fabricante_med, apresentacao_med, forma_administracao_med, principio_ativo_med'
+
     def __init__(self, cod_anvisa_med, nome_comercial, fabricante_med, apresentacao_med, forma_administracao_med, principio_ativo_med):
         self.cod_anvisa = cod_anvisa_med
         self.nome_comercial = nome_comercial
@@ -90,14 +544,20 @@ class Medicamento:
         self.principio_ativo = principio_ativo_med
 
 class EstoqueMedicamento:
+    __slots__ = ('lote', 'cod_anvisa', 'cod_unidade', 'validade', 'quantidade')
+    COLUNAS = 'lote_med, cod_anvisa_med, cod_unidade, validade_med_estoque, quantidade_med_estoque'
+
     def __init__(self, lote_med, cod_anvisa_med, cod_unidade, validade_med_estoque, quantidade_med_estoque):
         self.lote = lote_med
         self.cod_anvisa = cod_anvisa_med
         self.cod_unidade = cod_unidade
-        self.validade = validade_med_estoque.strftime("%d/%m/%Y")
+        self.validade = validade_med_estoque.strftime("%d/%m/%Y") if validade_med_estoque else None
         self.quantidade = quantidade_med_estoque
 
 class UnidadeSaude:
+    __slots__ = ('cod', 'nome', 'telefone', 'cep', 'rua', 'numero', 'bairro', 'tipo')
+    COLUNAS = 'cod_unidade, nome_unidade, tel_unidade, tipo_unidade, rua_end_unidade, num_end_unidade, bairro_end_unidade, cep_end_unidade'
+
     def __init__(self, cod_unidade, nome_unidade, tel_unidade, tipo_unidade, rua_end_unidade, num_end_unidade, bairro_end_unidade, cep_end_unidade):
         self.cod = cod_unidade
         self.nome = nome_unidade
@@ -108,14 +568,223 @@ class UnidadeSaude:
         self.bairro = bairro_end_unidade
         self.tipo = tipo_unidade
 
+class EstoqueDetalhado:
+    # Lote do estoque já com os dados do medicamento e da unidade (um único JOIN)
+    __slots__ = ('lote', 'cod_anvisa', 'cod_unidade', 'validade', 'quantidade',
+                 'nome_comercial', 'principio_ativo', 'fabricante', 'nome_unidade')
+    COLUNAS = ('e.lote_med, e.cod_anvisa_med, e.cod_unidade, e.validade_med_estoque, e.quantidade_med_estoque, '
+               'm.nome_comercial, m.principio_ativo_med, m.fabricante_med, u.nome_unidade')
+
+    def __init__(self, lote_med, cod_anvisa_med, cod_unidade, validade_med_estoque, quantidade_med_estoque,
+                 nome_comercial, principio_ativo_med, fabricante_med, nome_unidade):
+        self.lote = lote_med
+        self.cod_anvisa = cod_anvisa_med
+        self.cod_unidade = cod_unidade
+        self.validade = validade_med_estoque.strftime("%d/%m/%Y") if validade_med_estoque else None
+        self.quantidade = quantidade_med_estoque
+        self.nome_comercial = nome_comercial
+        self.principio_ativo = principio_ativo_med
+        self.fabricante = fabricante_med
+        self.nome_unidade = nome_unidade
+
+# ==== Leitura direta do cursor
+# Quantidade de linhas trazidas por round trip pelos cursores do lado do servidor
+ITERSIZE_CURSOR = 2000
+# Quantidade de linhas exibidas por página nas listagens do menu
+TAMANHO_PAGINA = 50
+
+def _buscar_um(classe, query, params, preparado=None):
+    with conexao() as conn, conn.cursor() as cursor:
+        if preparado:
+            _executar_preparado(cursor, preparado, query, params)
+        else:
+            cursor.execute(query, params)
+        linha = cursor.fetchone()
+    return classe(*linha) if linha else None
+
+def _buscar_pagina(classe, query, params):
+    with conexao() as conn, conn.cursor() as cursor:
+        cursor.execute(query, params)
+        return [classe(*linha) for linha in cursor.fetchall()]
+
+def _iterar(classe, query, params=None):
+    # Cursor nomeado: as linhas ficam no servidor e são trazidas em blocos de ITERSIZE_CURSOR,
+    # a conexão só volta ao pool quando o gerador termina ou é fechado
+    with conexao() as conn, conn.cursor(name=f'cursor_{classe.__name__.lower()}') as cursor:
+        cursor.itersize = ITERSIZE_CURSOR
+        cursor.execute(query, params)
+        for linha in cursor:
+            yield classe(*linha)
+
+def _buscar_todos(classe, query, params=None):
+    return list(_iterar(classe, query, params))
+
+# ==== Cache dos cadastros de medicamentos e unidades
+CACHE_TAMANHO_MAXIMO = 10_000
+CACHE_TTL = 300.0
+# Canal usado para avisar outros processos que um cadastro mudou
+CACHE_CANAL_NOTIFY = 'tp4_cache'
+
+class CacheLRU:
+    def __init__(self, tamanho_maximo=CACHE_TAMANHO_MAXIMO, ttl=CACHE_TTL):
+        self.tamanho_maximo = tamanho_maximo
+        self.ttl = ttl
+        self.dados = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.geracao = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidacoes = 0
+
+    def get(self, chave):
+        # Retorna (encontrado, valor, geracao); a geração deve ser repassada ao put
+        # para que uma leitura concorrente com uma invalidação não grave valor velho
+        chave = str(chave).strip()
+        with self.lock:
+            item = self.dados.get(chave)
+            if item is not None and time.monotonic() - item[1] < self.ttl:
+                self.dados.move_to_end(chave)
+                self.hits += 1
+                return True, item[0], self.geracao
+            if item is not None:
+                del self.dados[chave]
+            self.misses += 1
+            return False, None, self.geracao
+
+    def put(self, chave, valor, geracao):
+        chave = str(chave).strip()
+        with self.lock:
+            if geracao != self.geracao:
+                return
+            self.dados[chave] = (valor, time.monotonic())
+            self.dados.move_to_end(chave)
+            if len(self.dados) > self.tamanho_maximo:
+                self.dados.popitem(last=False)
+
+    def invalidar(self, chave=None):
+        with self.lock:
+            self.geracao += 1
+            self.invalidacoes += 1
+            if chave is None:
+                self.dados.clear()
+            else:
+                self.dados.pop(str(chave).strip(), None)
+
+    def estatisticas(self):
+        with self.lock:
+            consultas = self.hits + self.misses
+            return {
+                'itens': len(self.dados),
+                'tamanho_maximo': self.tamanho_maximo,
+                'hits': self.hits,
+                'misses': self.misses,
+                'taxa_acerto': self.hits / consultas if consultas else 0.0,
+                'invalidacoes': self.invalidacoes,
+            }
+
+cache_medicamentos = CacheLRU()
+cache_unidades = CacheLRU()
+_CACHES = {
+    'medicamento': cache_medicamentos,
+    'unidadesaude': cache_unidades,
+}
+
+def _invalidar_cache(tabela, chave=None):
+    if tabela in _CACHES:
+        _CACHES[tabela].invalidar(chave)
+
+def _notificar_cache(cursor, tabela, chave='*'):
+    # Entregue pelo PostgreSQL só no commit, junto com a alteração
+    cursor.execute('SELECT pg_notify(%s, %s)', (CACHE_CANAL_NOTIFY, f'{tabela}:{chave}'))
+
+def estatisticas_cache():
+    return {tabela: cache.estatisticas() for tabela, cache in _CACHES.items()}
+
+_ouvinte_cache = None
+
+def _ouvir_invalidacoes(parar):
+    conn = None
+    while not parar.is_set():
+        try:
+            if conn is None or conn.closed:
+                conn = psycopg2.connect(dbname=nome_db, **DB_CONFIG)
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(sql.SQL('LISTEN {}').format(sql.Identifier(CACHE_CANAL_NOTIFY)))
+                # Notificações perdidas enquanto estava desconectado não têm como ser recuperadas
+                for cache in _CACHES.values():
+                    cache.invalidar()
+            if select.select([conn], [], [], 1.0) == ([], [], []):
+                continue
+            conn.poll()
+            while conn.notifies:
+                tabela, _, chave = conn.notifies.pop(0).payload.partition(':')
+                _invalidar_cache(tabela, None if chave == '*' else chave)
+        except psycopg2.Error:
+            if conn is not None:
+                conn.close()
+            conn = None
+            parar.wait(5.0)
+    if conn is not None:
+        conn.close()
+
+def iniciar_invalidacao_remota():
+    # Opcional: mantém o cache coerente com alterações feitas por outros processos
+    global _ouvinte_cache
+    if _ouvinte_cache is None:
+        parar = threading.Event()
+        thread = threading.Thread(target=_ouvir_invalidacoes, args=(parar,), daemon=True, name='tp4-cache-listen')
+        thread.start()
+        _ouvinte_cache = (thread, parar)
+
+def parar_invalidacao_remota():
+    global _ouvinte_cache
+    if _ouvinte_cache is not None:
+        thread, parar = _ouvinte_cache
+        parar.set()
+        thread.join()
+        _ouvinte_cache = None
+
 
 # GET /medicamentos
 def get_medicamentos():
-    df = pd.read_sql_query(
-        'SELECT * FROM medicamento',
-        conn)
-    medicamentos = df.to_dict(orient='records')
-    return [Medicamento(**med) for med in medicamentos]
+    return _buscar_todos(Medicamento, f'SELECT {Medicamento.COLUNAS} FROM medicamento')
+
+def iter_medicamentos():
+    return _iterar(Medicamento, f'SELECT {Medicamento.COLUNAS} FROM medicamento ORDER BY cod_anvisa_med')
+
+# GET /medicamentos?apos=<cod_anvisa>&limite=<n>
+def get_medicamentos_pagina(apos=None, limite=TAMANHO_PAGINA):
+    if apos is None:
+        return _buscar_pagina(
+            Medicamento,
+            f'SELECT {Medicamento.COLUNAS} FROM medicamento ORDER BY cod_anvisa_med LIMIT %s',
+            (limite,))
+    return _buscar_pagina(
+        Medicamento,
+        f'SELECT {Medicamento.COLUNAS} FROM medicamento WHERE cod_anvisa_med > %s ORDER BY cod_anvisa_med LIMIT %s',
+        (apos, limite))
+
+# GET /medicamentos/busca?q=<texto>&limite=<n>
+def buscar_medicamentos(termo, limite=20):
+    # word_similarity (<%) acha o termo como trecho de uma palavra, tolerando erros de
+    # digitação; os resultados vêm dos mais parecidos para os menos parecidos
+    termo = termo.strip()
+    if not termo:
+        return []
+    return _buscar_pagina(
+        Medicamento,
+        f"""
+        SELECT {Medicamento.COLUNAS}
+        FROM medicamento
+        WHERE f_unaccent(%(termo)s) <%% f_unaccent(nome_comercial)
+           OR f_unaccent(%(termo)s) <%% f_unaccent(principio_ativo_med)
+        ORDER BY GREATEST(word_similarity(f_unaccent(%(termo)s), f_unaccent(nome_comercial)),
+                          word_similarity(f_unaccent(%(termo)s), f_unaccent(principio_ativo_med))) DESC,
+                 nome_comercial
+        LIMIT %(limite)s
+        """,
+        {'termo': termo, 'limite': limite})
 
 # POST /medicamentos
 def post_medicamento(medicamento: Medicamento):
@@ -124,7 +793,7 @@ def post_medicamento(medicamento: Medicamento):
     VALUES (%s, %s, %s, %s, %s, %s)
     """
     try:
-        with conn.cursor() as cursor:
+        with conexao() as conn, conn.cursor() as cursor:
             cursor.execute(query, (
                 medicamento.cod_anvisa,
                 medicamento.nome_comercial,
@@ -133,33 +802,36 @@ def post_medicamento(medicamento: Medicamento):
                 medicamento.forma_administracao,
                 medicamento.principio_ativo
             ))
-        conn.commit()
+            conn.commit()
         return {'status': 'success', 'message': 'Medicamento adicionado com sucesso.'}
     except Exception as e:
-        conn.rollback()
         return {'status': 'error', 'message': str(e)}
 
 # GET /medicamentos/<cod_anvisa>
 def get_medicamento(cod_anvisa):
-    df = pd.read_sql_query(
-        'SELECT * FROM medicamento WHERE cod_anvisa_med = %s',
-        conn,
-        params=(cod_anvisa,))
-    if df.empty:
-        return None
-    medicamento = Medicamento(**df.iloc[0].to_dict())
+    encontrado, medicamento, geracao = cache_medicamentos.get(cod_anvisa)
+    if encontrado:
+        return medicamento
+    medicamento = _buscar_um(
+        Medicamento,
+        f'SELECT {Medicamento.COLUNAS} FROM medicamento WHERE cod_anvisa_med = %s',
+        (cod_anvisa,),
+        preparado='tp4_get_medicamento')
+    if medicamento is not None:
+        cache_medicamentos.put(cod_anvisa, medicamento, geracao)
     return medicamento
 
 # DELETE /medicamentos/<cod_anvisa>
 def delete_medicamento(cod_anvisa):
     query = 'DELETE FROM medicamento WHERE cod_anvisa_med = %s'
     try:
-        with conn.cursor() as cursor:
+        with conexao() as conn, conn.cursor() as cursor:
             cursor.execute(query, (cod_anvisa,))
-        conn.commit()
+            _notificar_cache(cursor, 'medicamento', cod_anvisa)
+            conn.commit()
+        _invalidar_cache('medicamento', cod_anvisa)
         return {'status': 'success', 'message': 'Medicamento deletado com sucesso.'}
     except Exception as e:
-        conn.rollback()
         return {'status': 'error', 'message': str(e)}
     
 # UPDATE /medicamentos/<cod_anvisa>
@@ -170,8 +842,8 @@ def update_medicamento(medicamento: Medicamento):
     WHERE cod_anvisa_med = %s
     """
     try:
-        with conn.cursor() as cursor:
-            cursor.execute(query, (
+        with conexao() as conn, conn.cursor() as cursor:
+            _executar_preparado(cursor, 'tp4_update_medicamento', query, (
                 medicamento.nome_comercial,
                 medicamento.fabricante,
                 medicamento.apresentacao,
@@ -179,19 +851,31 @@ def update_medicamento(medicamento: Medicamento):
                 medicamento.principio_ativo,
                 medicamento.cod_anvisa
             ))
-        conn.commit()
+            _notificar_cache(cursor, 'medicamento', medicamento.cod_anvisa)
+            conn.commit()
+        _invalidar_cache('medicamento', medicamento.cod_anvisa)
         return {'status': 'success', 'message': 'Medicamento atualizado com sucesso.'}
     except Exception as e:
-        conn.rollback()
         return {'status': 'error', 'message': str(e)}
 
 # GET /unidades
 def get_unidades():
-    df = pd.read_sql_query(
-        'SELECT * FROM unidadesaude',
-        conn)
-    unidades = df.to_dict(orient='records')
-    return [UnidadeSaude(**un) for un in unidades]
+    return _buscar_todos(UnidadeSaude, f'SELECT {UnidadeSaude.COLUNAS} FROM unidadesaude')
+
+def iter_unidades():
+    return _iterar(UnidadeSaude, f'SELECT {UnidadeSaude.COLUNAS} FROM unidadesaude ORDER BY cod_unidade')
+
+# GET /unidades?apos=<cod_unidade>&limite=<n>
+def get_unidades_pagina(apos=None, limite=TAMANHO_PAGINA):
+    if apos is None:
+        return _buscar_pagina(
+            UnidadeSaude,
+            f'SELECT {UnidadeSaude.COLUNAS} FROM unidadesaude ORDER BY cod_unidade LIMIT %s',
+            (limite,))
+    return _buscar_pagina(
+        UnidadeSaude,
+        f'SELECT {UnidadeSaude.COLUNAS} FROM unidadesaude WHERE cod_unidade > %s ORDER BY cod_unidade LIMIT %s',
+        (apos, limite))
 
 # POST /unidades
 def post_unidade(unidade: UnidadeSaude):
@@ -200,7 +884,7 @@ def post_unidade(unidade: UnidadeSaude):
     VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
     """
     try:
-        with conn.cursor() as cursor:
+        with conexao() as conn, conn.cursor() as cursor:
             cursor.execute(query, (
                 unidade.cod,
                 unidade.nome,
@@ -211,34 +895,36 @@ def post_unidade(unidade: UnidadeSaude):
                 unidade.bairro,
                 unidade.cep
             ))
-        conn.commit()
+            conn.commit()
         return {'status': 'success', 'message': 'Unidade de saúde adicionada com sucesso.'}
     except Exception as e:
-        conn.rollback()
         return {'status': 'error', 'message': str(e)}
 
 # GET /unidades/<cod_unidade>
 def get_unidade(cod_unidade):
-    df = pd.read_sql_query(
-        'SELECT * FROM unidadesaude WHERE cod_unidade = %s',
-        conn,
-        params=(cod_unidade,))
-    if df.empty:
-        return None
-    
-    unidade = UnidadeSaude(**df.iloc[0].to_dict())
+    encontrado, unidade, geracao = cache_unidades.get(cod_unidade)
+    if encontrado:
+        return unidade
+    unidade = _buscar_um(
+        UnidadeSaude,
+        f'SELECT {UnidadeSaude.COLUNAS} FROM unidadesaude WHERE cod_unidade = %s',
+        (cod_unidade,),
+        preparado='tp4_get_unidade')
+    if unidade is not None:
+        cache_unidades.put(cod_unidade, unidade, geracao)
     return unidade
 
 # DELETE /unidades/<cod_unidade>
 def delete_unidade(cod_unidade):
     query = 'DELETE FROM unidadesaude WHERE cod_unidade = %s'
     try:
-        with conn.cursor() as cursor:
+        with conexao() as conn, conn.cursor() as cursor:
             cursor.execute(query, (cod_unidade,))
-        conn.commit()
+            _notificar_cache(cursor, 'unidadesaude', cod_unidade)
+            conn.commit()
+        _invalidar_cache('unidadesaude', cod_unidade)
         return {'status': 'success', 'message': 'Unidade de saúde deletada com sucesso.'}
     except Exception as e:
-        conn.rollback()
         return {'status': 'error', 'message': str(e)}
 
 # UPDATE /unidades/<cod_unidade>
@@ -249,8 +935,8 @@ def update_unidade(unidade: UnidadeSaude):
     WHERE cod_unidade = %s
     """
     try:
-        with conn.cursor() as cursor:
-            cursor.execute(query, (
+        with conexao() as conn, conn.cursor() as cursor:
+            _executar_preparado(cursor, 'tp4_update_unidade', query, (
                 unidade.nome,
                 unidade.telefone,
                 unidade.tipo,
@@ -260,112 +946,1792 @@ def update_unidade(unidade: UnidadeSaude):
                 unidade.cep,
                 unidade.cod
             ))
-        conn.commit()
+            _notificar_cache(cursor, 'unidadesaude', unidade.cod)
+            conn.commit()
+        _invalidar_cache('unidadesaude', unidade.cod)
         return {'status': 'success', 'message': 'Unidade de saúde atualizada com sucesso.'}
     except Exception as e:
-        conn.rollback()
         return {'status': 'error', 'message': str(e)}
 
 # GET /unidades/<cod_unidade>/medicamentos
 def get_estoque_medicamentos(cod_unidade):
-    df = pd.read_sql_query(
-        'SELECT * FROM medicamentoestocado WHERE cod_unidade = %s',
-        conn,
-        params=(cod_unidade,))
-    if df.empty:
-        return []
-    
-    estoque = df.to_dict(orient='records')
-    return [EstoqueMedicamento(**item) for item in estoque]
+    return _buscar_todos(
+        EstoqueMedicamento,
+        f'SELECT {EstoqueMedicamento.COLUNAS} FROM medicamentoestocado WHERE cod_unidade = %s',
+        (cod_unidade,))
 
-# POST /unidades/<cod_unidade>/medicamentos
-def post_estoque_medicamento(estoque: EstoqueMedicamento):
-    query = """
-    INSERT INTO medicamentoestocado (lote_med, cod_anvisa_med, cod_unidade, validade_med_estoque, quantidade_med_estoque)
-    VALUES (%s, %s, %s, %s, %s)
+def iter_estoque_medicamentos(cod_unidade):
+    return _iterar(
+        EstoqueMedicamento,
+        f'SELECT {EstoqueMedicamento.COLUNAS} FROM medicamentoestocado WHERE cod_unidade = %s ORDER BY lote_med, cod_anvisa_med',
+        (cod_unidade,))
+
+# GET /unidades/<cod_unidade>/medicamentos?apos=<lote>,<cod_anvisa>&limite=<n>
+def get_estoque_medicamentos_pagina(cod_unidade, apos=None, limite=TAMANHO_PAGINA):
+    if apos is None:
+        return _buscar_pagina(
+            EstoqueMedicamento,
+            f'SELECT {EstoqueMedicamento.COLUNAS} FROM medicamentoestocado WHERE cod_unidade = %s '
+            'ORDER BY lote_med, cod_anvisa_med LIMIT %s',
+            (cod_unidade, limite))
+    return _buscar_pagina(
+        EstoqueMedicamento,
+        f'SELECT {EstoqueMedicamento.COLUNAS} FROM medicamentoestocado WHERE cod_unidade = %s '
+        'AND (lote_med, cod_anvisa_med) > (%s, %s) ORDER BY lote_med, cod_anvisa_med LIMIT %s',
+        (cod_unidade, apos[0], apos[1], limite))
+
+def _consulta_estoque_detalhado(cod_unidade, cod_anvisa, validade_desde, validade_ate, com_saldo, apos):
+    filtros = []
+    if cod_unidade is not None:
+        filtros.append('e.cod_unidade = %(cod_unidade)s')
+    if cod_anvisa is not None:
+        filtros.append('e.cod_anvisa_med = %(cod_anvisa)s')
+    if validade_desde is not None:
+        filtros.append('e.validade_med_estoque >= %(validade_desde)s')
+    if validade_ate is not None:
+        filtros.append('e.validade_med_estoque <= %(validade_ate)s')
+    if com_saldo:
+        filtros.append('e.quantidade_med_estoque > 0')
+    if apos is not None:
+        filtros.append('(e.cod_unidade, e.lote_med, e.cod_anvisa_med) > (%(apos_unidade)s, %(apos_lote)s, %(apos_anvisa)s)')
+    where = f"WHERE {' AND '.join(filtros)}" if filtros else ''
+    query = f"""
+    SELECT {EstoqueDetalhado.COLUNAS}
+    FROM medicamentoestocado e
+    JOIN medicamento m ON m.cod_anvisa_med = e.cod_anvisa_med
+    JOIN unidadesaude u ON u.cod_unidade = e.cod_unidade
+    {where}
+    ORDER BY e.cod_unidade, e.lote_med, e.cod_anvisa_med
     """
+    params = {
+        'cod_unidade': cod_unidade,
+        'cod_anvisa': cod_anvisa,
+        'validade_desde': validade_desde,
+        'validade_ate': validade_ate,
+    }
+    if apos is not None:
+        params['apos_unidade'], params['apos_lote'], params['apos_anvisa'] = apos
+    return query, params
+
+# GET /estoque?cod_unidade=<cod>&cod_anvisa=<cod>&validade_desde=<data>&validade_ate=<data>&com_saldo=1
+def iter_estoque_detalhado(cod_unidade=None, cod_anvisa=None, validade_desde=None, validade_ate=None, com_saldo=False):
+    query, params = _consulta_estoque_detalhado(cod_unidade, cod_anvisa, validade_desde, validade_ate, com_saldo, None)
+    return _iterar(EstoqueDetalhado, query, params)
+
+def get_estoque_detalhado(cod_unidade=None, cod_anvisa=None, validade_desde=None, validade_ate=None, com_saldo=False):
+    return list(iter_estoque_detalhado(cod_unidade, cod_anvisa, validade_desde, validade_ate, com_saldo))
+
+# GET /estoque?...&apos=<cod_unidade>,<lote>,<cod_anvisa>&limite=<n>
+def get_estoque_detalhado_pagina(cod_unidade=None, cod_anvisa=None, validade_desde=None, validade_ate=None,
+                                 com_saldo=False, apos=None, limite=TAMANHO_PAGINA):
+    query, params = _consulta_estoque_detalhado(cod_unidade, cod_anvisa, validade_desde, validade_ate, com_saldo, apos)
+    params['limite'] = limite
+    return _buscar_pagina(EstoqueDetalhado, query + 'LIMIT %(limite)s', params)
+
+# Acima desta quantidade de unidades get_estoques divide a busca entre várias conexões do pool
+LIMITE_ESTOQUES_CONSULTA_UNICA = 200
+UNIDADES_POR_PARTE = 50
+WORKERS_ESTOQUES = 4
+
+def _buscar_estoques(cod_unidades):
+    # Uma consulta para todas as unidades, lida em blocos pelo cursor nomeado e agrupada aqui
+    estoques = {cod_unidade: [] for cod_unidade in cod_unidades}
+    for item in _iterar(
+            EstoqueMedicamento,
+            f'SELECT {EstoqueMedicamento.COLUNAS} FROM medicamentoestocado WHERE cod_unidade = ANY(%s)',
+            (list(cod_unidades),)):
+        estoques[item.cod_unidade].append(item)
+    return estoques
+
+# GET /estoques?unidades=<cod>,<cod>,...
+def get_estoques(cod_unidades, estrategia=None):
+    # estrategia 'unica' faz uma só consulta com ANY; 'paralela' divide as unidades em partes
+    # buscadas ao mesmo tempo em conexões diferentes. Sem estrategia escolhe pelo tamanho
+    cod_unidades = sorted({int(cod_unidade) for cod_unidade in cod_unidades})
+    if estrategia is None:
+        estrategia = 'unica' if len(cod_unidades) <= LIMITE_ESTOQUES_CONSULTA_UNICA else 'paralela'
+    if estrategia == 'unica':
+        return _buscar_estoques(cod_unidades)
+    if estrategia != 'paralela':
+        raise ValueError(f'Estratégia desconhecida: {estrategia}')
+
+    partes = [cod_unidades[i:i + UNIDADES_POR_PARTE] for i in range(0, len(cod_unidades), UNIDADES_POR_PARTE)]
+    estoques = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(len(partes), WORKERS_ESTOQUES))) as executor:
+        for parcial in executor.map(_buscar_estoques, partes):
+            estoques.update(parcial)
+    return estoques
+
+def _erro(e):
+    if isinstance(e, EstoqueInsuficiente):
+        return {'status': 'error', 'message': str(e), 'lote': e.lote, 'cod_anvisa': e.cod_anvisa}
+    return {'status': 'error', 'message': str(e)}
+
+def _em_transacao(operacao, *args):
+    # Roda uma operação de escrita (cursor, *args) -> resultado na sua própria transação;
+    # a fila de escrita usa as mesmas operações, mas várias por COMMIT
     try:
-        with conn.cursor() as cursor:
-            cursor.execute(query, (
-                estoque.lote,
-                estoque.cod_anvisa,
-                estoque.cod_unidade,
-                estoque.validade,
-                estoque.quantidade
-            ))
-        conn.commit()
-        return {'status': 'success', 'message': 'Medicamento adicionado ao estoque com sucesso.'}
+        with conexao() as conn, conn.cursor() as cursor:
+            resultado = operacao(cursor, *args)
+            conn.commit()
+        return resultado
     except Exception as e:
-        conn.rollback()
-        return {'status': 'error', 'message': str(e)}
+        return _erro(e)
+
+def _inserir_estoque(cursor, estoque):
+    cursor.execute("""
+    INSERT INTO medicamentoestocado (lote_med, cod_anvisa_med, cod_unidade, validade_med_estoque, quantidade_med_estoque)
+    VALUES (%s, %s, %s, to_date(%s, 'DD/MM/YYYY'), %s)
+    """, (
+        estoque.lote,
+        estoque.cod_anvisa,
+        estoque.cod_unidade,
+        estoque.validade,
+        estoque.quantidade
+    ))
+    return {'status': 'success', 'message': 'Medicamento adicionado ao estoque com sucesso.'}
+
+# POST /unidades/<cod_unidade>/medicamentos
+def post_estoque_medicamento(estoque: EstoqueMedicamento):
+    return _em_transacao(_inserir_estoque, estoque)
 
 # GET /unidades/<cod_unidade>/medicamentos/<lote>/<cod_anvisa>
 def get_estoque_medicamento(cod_unidade, lote, cod_anvisa):
-    df = pd.read_sql_query(
-        'SELECT * FROM medicamentoestocado WHERE cod_unidade = %s AND lote_med = %s AND cod_anvisa_med = %s',
-        conn,
-        params=(cod_unidade, lote, cod_anvisa))
-    
-    if df.empty:
-        return None
-    
-    estoque = EstoqueMedicamento(**df.iloc[0].to_dict())
-    return estoque
+    return _buscar_um(
+        EstoqueMedicamento,
+        f'SELECT {EstoqueMedicamento.COLUNAS} FROM medicamentoestocado WHERE cod_unidade = %s AND lote_med = %s AND cod_anvisa_med = %s',
+        (cod_unidade, lote, cod_anvisa),
+        preparado='tp4_get_estoque_medicamento')
+
+def _atualizar_estoque(cursor, estoque):
+    _executar_preparado(cursor, 'tp4_update_estoque_medicamento', """
+    UPDATE medicamentoestocado
+    SET quantidade_med_estoque = %s
+    WHERE lote_med = %s AND cod_anvisa_med = %s AND cod_unidade = %s
+    """, (
+        estoque.quantidade,
+        estoque.lote,
+        estoque.cod_anvisa,
+        estoque.cod_unidade
+    ))
+    return {'status': 'success', 'message': 'Medicamento no estoque atualizado com sucesso.'}
 
 # PUT /unidades/<cod_unidade>/medicamentos
 def update_estoque_medicamento(estoque: EstoqueMedicamento):
-    query = """
+    return _em_transacao(_atualizar_estoque, estoque)
+
+# ==== Dispensação
+class EstoqueInsuficiente(Exception):
+    def __init__(self, lote, cod_anvisa, mensagem):
+        super().__init__(mensagem)
+        self.lote = lote
+        self.cod_anvisa = cod_anvisa
+
+def _dispensar_item(cursor, cod_unidade, lote, cod_anvisa, quantidade):
+    # A verificação de saldo e a baixa acontecem no mesmo UPDATE, então duas
+    # dispensações simultâneas do mesmo lote nunca deixam o estoque negativo
+    _executar_preparado(cursor, 'tp4_dispensar_item', """
     UPDATE medicamentoestocado
-    SET quantidade_med_estoque = %s
+    SET quantidade_med_estoque = quantidade_med_estoque - %s
+    WHERE lote_med = %s AND cod_anvisa_med = %s AND cod_unidade = %s AND quantidade_med_estoque >= %s
+    RETURNING quantidade_med_estoque
+    """, (quantidade, lote, cod_anvisa, cod_unidade, quantidade))
+    linha = cursor.fetchone()
+    if linha:
+        return linha[0]
+
+    cursor.execute("""
+    SELECT quantidade_med_estoque FROM medicamentoestocado
     WHERE lote_med = %s AND cod_anvisa_med = %s AND cod_unidade = %s
+    """, (lote, cod_anvisa, cod_unidade))
+    if cursor.fetchone() is None:
+        raise EstoqueInsuficiente(lote, cod_anvisa, f"Lote {lote} do medicamento {cod_anvisa} não encontrado no estoque desta unidade.")
+    raise EstoqueInsuficiente(lote, cod_anvisa, f"Quantidade solicitada do lote {lote} do medicamento {cod_anvisa} é maior que a disponível no estoque.")
+
+def _quantidade_valida(valor, minimo=1):
+    # Inteiro >= minimo, ou texto com um (vindo do menu); 2.5, 'abc', None e booleanos não valem
+    if isinstance(valor, bool):
+        return None
+    if isinstance(valor, str):
+        try:
+            valor = int(valor.strip())
+        except ValueError:
+            return None
+    if not isinstance(valor, int) or valor < minimo:
+        return None
+    return valor
+
+def _pedido_dispensacao(itens):
+    pedido = {}
+    for lote, cod_anvisa, quantidade in itens:
+        quantidade = _quantidade_valida(quantidade)
+        if quantidade is None:
+            return None, {'status': 'error', 'message': f'Quantidade inválida para o lote {lote} do medicamento {cod_anvisa}.'}
+        pedido[(lote, cod_anvisa)] = pedido.get((lote, cod_anvisa), 0) + quantidade
+    if not pedido:
+        return None, {'status': 'error', 'message': 'Nenhum item para dispensar.'}
+    return pedido, None
+
+def _dispensar(cursor, cod_unidade, pedido):
+    _tipo_movimentacao(cursor, 'dispensacao')
+    # Ordem fixa de atualização evita deadlock entre receitas com lotes em comum
+    saldos = [
+        (lote, cod_anvisa, _dispensar_item(cursor, cod_unidade, lote, cod_anvisa, quantidade))
+        for (lote, cod_anvisa), quantidade in sorted(pedido.items())
+    ]
+    return {'status': 'success', 'message': 'Medicamentos dispensados com sucesso.', 'saldos': saldos}
+
+# POST /unidades/<cod_unidade>/dispensacoes
+def dispensar_medicamentos(cod_unidade, itens):
+    # itens: lista de (lote, cod_anvisa, quantidade) de uma mesma receita; ou todos
+    # os itens são baixados ou nenhum é
+    pedido, erro = _pedido_dispensacao(itens)
+    if erro:
+        return erro
+    return _em_transacao(_dispensar, cod_unidade, pedido)
+
+# POST /unidades/<cod_unidade>/medicamentos/<lote>/<cod_anvisa>/dispensacao
+def dispensar_medicamento(cod_unidade, lote, cod_anvisa, quantidade):
+    return dispensar_medicamentos(cod_unidade, [(lote, cod_anvisa, quantidade)])
+
+def _dispensar_fefo_item(cursor, cod_unidade, cod_anvisa, quantidade):
+    # Trava os lotes válidos do medicamento na unidade e distribui a quantidade
+    # começando pelo que vence primeiro (lotes sem validade ficam por último)
+    cursor.execute("""
+    WITH lotes AS (
+        SELECT lote_med, validade_med_estoque, quantidade_med_estoque
+        FROM medicamentoestocado
+        WHERE cod_unidade = %(cod_unidade)s AND cod_anvisa_med = %(cod_anvisa)s
+          AND quantidade_med_estoque > 0
+          AND (validade_med_estoque IS NULL OR validade_med_estoque >= CURRENT_DATE)
+        ORDER BY validade_med_estoque NULLS LAST, lote_med
+        FOR UPDATE
+    ), alocacao AS (
+        SELECT lote_med,
+               LEAST(quantidade_med_estoque,
+                     %(quantidade)s - (SUM(quantidade_med_estoque) OVER ordem - quantidade_med_estoque)) AS retirada
+        FROM lotes
+        WINDOW ordem AS (ORDER BY validade_med_estoque NULLS LAST, lote_med)
+    )
+    UPDATE medicamentoestocado e
+    SET quantidade_med_estoque = e.quantidade_med_estoque - a.retirada
+    FROM alocacao a
+    WHERE e.cod_unidade = %(cod_unidade)s AND e.cod_anvisa_med = %(cod_anvisa)s
+      AND e.lote_med = a.lote_med AND a.retirada > 0
+    RETURNING e.lote_med, a.retirada, e.quantidade_med_estoque
+    """, {'cod_unidade': cod_unidade, 'cod_anvisa': cod_anvisa, 'quantidade': quantidade})
+    retiradas = cursor.fetchall()
+    if sum(retirada for _, retirada, _ in retiradas) < quantidade:
+        raise EstoqueInsuficiente(None, cod_anvisa, f"Estoque válido do medicamento {cod_anvisa} é menor que a quantidade solicitada.")
+    return retiradas
+
+def _pedido_dispensacao_fefo(itens):
+    pedido = {}
+    for cod_anvisa, quantidade in itens:
+        quantidade = _quantidade_valida(quantidade)
+        if quantidade is None:
+            return None, {'status': 'error', 'message': f'Quantidade inválida para o medicamento {cod_anvisa}.'}
+        pedido[cod_anvisa] = pedido.get(cod_anvisa, 0) + quantidade
+    if not pedido:
+        return None, {'status': 'error', 'message': 'Nenhum item para dispensar.'}
+    return pedido, None
+
+def _dispensar_fefo(cursor, cod_unidade, pedido):
+    _tipo_movimentacao(cursor, 'dispensacao')
+    retiradas = [
+        (lote, cod_anvisa, retirada, saldo)
+        for cod_anvisa, quantidade in sorted(pedido.items())
+        for lote, retirada, saldo in _dispensar_fefo_item(cursor, cod_unidade, cod_anvisa, quantidade)
+    ]
+    return {'status': 'success', 'message': 'Medicamentos dispensados com sucesso.', 'retiradas': retiradas}
+
+# POST /unidades/<cod_unidade>/dispensacoes/fefo
+def dispensar_medicamentos_fefo(cod_unidade, itens):
+    # itens: lista de (cod_anvisa, quantidade); cada medicamento é retirado dos lotes
+    # com validade mais próxima, tudo na mesma transação
+    pedido, erro = _pedido_dispensacao_fefo(itens)
+    if erro:
+        return erro
+    return _em_transacao(_dispensar_fefo, cod_unidade, pedido)
+
+# POST /unidades/<cod_unidade>/medicamentos/<cod_anvisa>/dispensacao
+def dispensar_medicamento_fefo(cod_unidade, cod_anvisa, quantidade):
+    return dispensar_medicamentos_fefo(cod_unidade, [(cod_anvisa, quantidade)])
+
+# ==== Transferências
+# POST /unidades/<cod_unidade>/transferencias
+def transferir_medicamentos(cod_unidade_origem, cod_unidade_destino, itens):
+    # itens: lista de (lote, cod_anvisa, quantidade) levados da origem para o destino
+    # numa única transação; no destino o lote é criado ou tem o saldo somado (upsert)
+    if str(cod_unidade_origem) == str(cod_unidade_destino):
+        return {'status': 'error', 'message': 'A unidade de destino deve ser diferente da unidade de origem.'}
+    pedido = {}
+    for lote, cod_anvisa, quantidade in itens:
+        quantidade = _quantidade_valida(quantidade)
+        if quantidade is None:
+            return {'status': 'error', 'message': f'Quantidade inválida para o lote {lote} do medicamento {cod_anvisa}.'}
+        pedido[(lote, cod_anvisa)] = pedido.get((lote, cod_anvisa), 0) + quantidade
+    if not pedido:
+        return {'status': 'error', 'message': 'Nenhum item para transferir.'}
+    chaves = sorted(pedido)
+    params = {
+        'origem': cod_unidade_origem,
+        'destino': cod_unidade_destino,
+        'lotes': [lote for lote, _ in chaves],
+        'cods_anvisa': [cod_anvisa for _, cod_anvisa in chaves],
+        'quantidades': [pedido[chave] for chave in chaves],
+    }
+
+    try:
+        with conexao() as conn, conn.cursor() as cursor:
+            _tipo_movimentacao(cursor, 'transferencia', f'Unidade {cod_unidade_origem} -> {cod_unidade_destino}')
+            cursor.execute('SELECT 1 FROM unidadesaude WHERE cod_unidade = %s', (cod_unidade_destino,))
+            if cursor.fetchone() is None:
+                conn.rollback()
+                return {'status': 'error', 'message': 'Unidade de destino não encontrada.'}
+
+            # Trava os lotes das duas unidades sempre na mesma ordem (lote, medicamento,
+            # unidade): transferências simultâneas, inclusive em sentidos opostos, esperam
+            # uma pela outra em vez de entrar em deadlock
+            cursor.execute("""
+            SELECT e.lote_med, e.cod_anvisa_med, e.cod_unidade = %(origem)s, e.quantidade_med_estoque
+            FROM medicamentoestocado e
+            JOIN unnest(%(lotes)s::varchar[], %(cods_anvisa)s::varchar[]) AS p(lote_med, cod_anvisa_med)
+                USING (lote_med, cod_anvisa_med)
+            WHERE e.cod_unidade IN (%(origem)s, %(destino)s)
+            ORDER BY e.lote_med, e.cod_anvisa_med, e.cod_unidade
+            FOR UPDATE OF e
+            """, params)
+            saldos_origem = {(lote, cod_anvisa): saldo for lote, cod_anvisa, origem, saldo in cursor.fetchall() if origem}
+            for (lote, cod_anvisa), quantidade in zip(chaves, params['quantidades']):
+                if (lote, cod_anvisa) not in saldos_origem:
+                    raise EstoqueInsuficiente(lote, cod_anvisa, f"Lote {lote} do medicamento {cod_anvisa} não encontrado no estoque da unidade de origem.")
+                if saldos_origem[(lote, cod_anvisa)] < quantidade:
+                    raise EstoqueInsuficiente(lote, cod_anvisa, f"Quantidade solicitada do lote {lote} do medicamento {cod_anvisa} é maior que a disponível na unidade de origem.")
+
+            cursor.execute(f"""
+            WITH pedido AS (
+                SELECT * FROM unnest(%(lotes)s::varchar[], %(cods_anvisa)s::varchar[], %(quantidades)s::int[])
+                    AS p(lote_med, cod_anvisa_med, quantidade)
+            ), saida AS (
+                UPDATE medicamentoestocado e
+                SET quantidade_med_estoque = e.quantidade_med_estoque - p.quantidade
+                FROM pedido p
+                WHERE e.cod_unidade = %(origem)s AND e.lote_med = p.lote_med AND e.cod_anvisa_med = p.cod_anvisa_med
+                RETURNING e.lote_med, e.cod_anvisa_med, e.validade_med_estoque, p.quantidade
+            )
+            INSERT INTO medicamentoestocado ({EstoqueMedicamento.COLUNAS})
+            SELECT lote_med, cod_anvisa_med, %(destino)s, validade_med_estoque, quantidade
+            FROM saida
+            ORDER BY lote_med, cod_anvisa_med
+            ON CONFLICT (lote_med, cod_anvisa_med, cod_unidade) DO UPDATE
+                SET quantidade_med_estoque = medicamentoestocado.quantidade_med_estoque + EXCLUDED.quantidade_med_estoque
+            RETURNING lote_med, cod_anvisa_med, quantidade_med_estoque
+            """, params)
+            saldos_destino = {(lote, cod_anvisa): saldo for lote, cod_anvisa, saldo in cursor.fetchall()}
+            conn.commit()
+        transferencias = [
+            (lote, cod_anvisa, quantidade, saldos_origem[(lote, cod_anvisa)] - quantidade, saldos_destino[(lote, cod_anvisa)])
+            for (lote, cod_anvisa), quantidade in zip(chaves, params['quantidades'])
+        ]
+        return {'status': 'success', 'message': 'Medicamentos transferidos com sucesso.', 'transferencias': transferencias}
+    except EstoqueInsuficiente as e:
+        return {'status': 'error', 'message': str(e), 'lote': e.lote, 'cod_anvisa': e.cod_anvisa}
+    except Exception as e:
+        return {'status': 'error', 'message': str(e)}
+
+# ==== Relatórios
+def _relatorio(query, params=None):
+    with conexao() as conn, conn.cursor() as cursor:
+        cursor.execute(query, params)
+        colunas = [coluna.name for coluna in cursor.description]
+        return [dict(zip(colunas, linha)) for linha in cursor.fetchall()]
+
+# POST /relatorios/atualizacao
+def atualizar_relatorios(concorrente=True):
+    # mvsaldounidademedicamento é um retrato do estoque válido no momento da atualização;
+    # CONCURRENTLY não bloqueia quem está lendo a view durante o refresh. O servidor HTTP
+    # atualiza a cada INTERVALO_ATUALIZACAO_RELATORIOS; fora dele, `tp4.py atualizar-relatorios`
+    comando = 'REFRESH MATERIALIZED VIEW CONCURRENTLY mvsaldounidademedicamento' if concorrente \
+        else 'REFRESH MATERIALIZED VIEW mvsaldounidademedicamento'
+    try:
+        with conexao() as conn, conn.cursor() as cursor:
+            cursor.execute(comando)
+            conn.commit()
+        return {'status': 'success', 'message': 'Relatórios atualizados com sucesso.'}
+    except Exception as e:
+        return {'status': 'error', 'message': str(e)}
+
+# GET /relatorios/vencendo?dias=<n>&cod_unidade=<cod_unidade>
+def relatorio_vencendo(dias=30, cod_unidade=None, limite=1000):
+    filtro_unidade = 'AND e.cod_unidade = %(cod_unidade)s' if cod_unidade is not None else ''
+    return _relatorio(f"""
+    SELECT e.validade_med_estoque, e.cod_unidade, u.nome_unidade, e.cod_anvisa_med, m.nome_comercial,
+           e.lote_med, e.quantidade_med_estoque
+    FROM medicamentoestocado e
+    JOIN unidadesaude u ON u.cod_unidade = e.cod_unidade
+    JOIN medicamento m ON m.cod_anvisa_med = e.cod_anvisa_med
+    WHERE e.quantidade_med_estoque > 0
+      AND e.validade_med_estoque BETWEEN CURRENT_DATE AND CURRENT_DATE + %(dias)s
+      {filtro_unidade}
+    ORDER BY e.validade_med_estoque, e.cod_unidade, e.cod_anvisa_med
+    LIMIT %(limite)s
+    """, {'dias': int(dias), 'cod_unidade': cod_unidade, 'limite': limite})
+
+# GET /relatorios/principio-ativo-bairro?principio_ativo=<texto>&bairro=<texto>
+def relatorio_principio_ativo_bairro(principio_ativo=None, bairro=None):
+    filtros = []
+    if principio_ativo is not None:
+        filtros.append('m.principio_ativo_med = %(principio_ativo)s')
+    if bairro is not None:
+        filtros.append('u.bairro_end_unidade = %(bairro)s')
+    where = f"WHERE {' AND '.join(filtros)}" if filtros else ''
+    return _relatorio(f"""
+    SELECT m.principio_ativo_med, u.bairro_end_unidade,
+           SUM(s.quantidade)::bigint AS quantidade,
+           COUNT(DISTINCT s.cod_unidade) AS unidades,
+           MIN(s.proxima_validade) AS proxima_validade
+    FROM mvsaldounidademedicamento s
+    JOIN medicamento m ON m.cod_anvisa_med = s.cod_anvisa_med
+    JOIN unidadesaude u ON u.cod_unidade = s.cod_unidade
+    {where}
+    GROUP BY m.principio_ativo_med, u.bairro_end_unidade
+    ORDER BY m.principio_ativo_med, u.bairro_end_unidade
+    """, {'principio_ativo': principio_ativo, 'bairro': bairro})
+
+# GET /relatorios/abaixo-reposicao?quantidade_minima=<n>&cod_unidade=<cod_unidade>
+def relatorio_abaixo_reposicao(quantidade_minima=None, cod_unidade=None):
+    # Sem quantidade_minima usa os pontos de reposição cadastrados (inclusive de
+    # medicamentos sem saldo); com ela compara todos os medicamentos estocados
+    filtro_unidade = 'AND u.cod_unidade = %(cod_unidade)s' if cod_unidade is not None else ''
+    if quantidade_minima is None:
+        origem = 'pontoreposicao p LEFT JOIN mvsaldounidademedicamento s USING (cod_unidade, cod_anvisa_med)'
+        chave = 'p'
+        minimo = 'p.quantidade_minima'
+    else:
+        origem = 'mvsaldounidademedicamento s'
+        chave = 's'
+        minimo = '%(quantidade_minima)s'
+    return _relatorio(f"""
+    SELECT u.cod_unidade, u.nome_unidade, m.cod_anvisa_med, m.nome_comercial,
+           COALESCE(s.quantidade, 0) AS quantidade, {minimo} AS quantidade_minima
+    FROM {origem}
+    JOIN unidadesaude u ON u.cod_unidade = {chave}.cod_unidade
+    JOIN medicamento m ON m.cod_anvisa_med = {chave}.cod_anvisa_med
+    WHERE COALESCE(s.quantidade, 0) < {minimo}
+      {filtro_unidade}
+    ORDER BY u.cod_unidade, m.cod_anvisa_med
+    """, {'quantidade_minima': quantidade_minima, 'cod_unidade': cod_unidade})
+
+# PUT /unidades/<cod_unidade>/medicamentos/<cod_anvisa>/reposicao
+def update_ponto_reposicao(cod_unidade, cod_anvisa, quantidade_minima):
+    query = """
+    INSERT INTO pontoreposicao (cod_unidade, cod_anvisa_med, quantidade_minima)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (cod_unidade, cod_anvisa_med) DO UPDATE SET quantidade_minima = EXCLUDED.quantidade_minima
     """
     try:
-        with conn.cursor() as cursor:
-            cursor.execute(query, (
-                estoque.quantidade,
-                estoque.lote,
-                estoque.cod_anvisa,
-                estoque.cod_unidade
-            ))
+        with conexao() as conn, conn.cursor() as cursor:
+            cursor.execute(query, (cod_unidade, cod_anvisa, quantidade_minima))
+            conn.commit()
+        return {'status': 'success', 'message': 'Ponto de reposição atualizado com sucesso.'}
+    except Exception as e:
+        return {'status': 'error', 'message': str(e)}
+
+# ==== Movimentações de estoque
+# Partições mensais de movimentacaoestoque mantidas à frente do mês corrente
+MESES_PARTICOES_FUTURAS = 3
+# Quantidade máxima de movimentações devolvidas por get_movimentacoes
+LIMITE_MOVIMENTACOES = 1000
+
+def _tipo_movimentacao(cursor, tipo, observacao=None):
+    # Vale só para a transação corrente; o trigger de medicamentoestocado usa estes
+    # valores nas movimentações geradas pelos comandos seguintes
+    cursor.execute("""
+    SELECT set_config('tp4.tipo_movimentacao', %s, true), set_config('tp4.observacao_movimentacao', %s, true)
+    """, (tipo, observacao or ''))
+
+def _inicio_mes(data):
+    return datetime.date(data.year, data.month, 1)
+
+def _somar_meses(mes, meses):
+    indice = mes.year * 12 + mes.month - 1 + meses
+    return datetime.date(indice // 12, indice % 12 + 1, 1)
+
+def _fim_compactacao(cursor):
+    # Primeiro dia do primeiro mês ainda não compactado; antes dele os saldos estão em
+    # saldomensalestoque, depois só nas movimentações
+    cursor.execute('SELECT MAX(mes) FROM compactacaomovimentacao')
+    ultimo = cursor.fetchone()[0]
+    return _somar_meses(ultimo, 1) if ultimo else datetime.date.min
+
+def criar_particoes_movimentacao(meses=MESES_PARTICOES_FUTURAS):
+    mes = _inicio_mes(datetime.date.today())
+    with conexao() as conn, conn.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', (_LOCK_MIGRACAO,))
+        for i in range(meses + 1):
+            cursor.execute('SELECT criar_particao_movimentacao(%s)', (_somar_meses(mes, i),))
         conn.commit()
-        return {'status': 'success', 'message': 'Medicamento no estoque atualizado com sucesso.'}
+
+def compactar_movimentacoes():
+    # Consolida cada mês fechado ainda não compactado: uma linha por lote movimentado no
+    # mês, com o saldo ao final dele. Movimentações de meses fechados não mudam mais
+    # (data_mov é sempre now()), então cada mês só precisa ser compactado uma vez
+    mes_atual = _inicio_mes(datetime.date.today())
+    try:
+        with conexao() as conn, conn.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', (_LOCK_COMPACTACAO,))
+            mes = _fim_compactacao(cursor)
+            if mes == datetime.date.min:
+                cursor.execute('SELECT MIN(data_mov) FROM movimentacaoestoque')
+                primeira = cursor.fetchone()[0]
+                mes = _inicio_mes(primeira) if primeira else mes_atual
+            compactados = []
+            while mes < mes_atual:
+                cursor.execute("""
+                WITH movimentos AS (
+                    SELECT cod_unidade, cod_anvisa_med, lote_med,
+                           SUM(quantidade_mov) AS variacao,
+                           COALESCE(SUM(quantidade_mov) FILTER (WHERE quantidade_mov > 0), 0) AS entradas,
+                           COALESCE(-SUM(quantidade_mov) FILTER (WHERE quantidade_mov < 0), 0) AS saidas,
+                           COALESCE(-SUM(quantidade_mov) FILTER (WHERE tipo_mov = 'dispensacao'), 0) AS dispensado
+                    FROM movimentacaoestoque
+                    WHERE data_mov >= %(mes)s AND data_mov < %(fim)s
+                    GROUP BY cod_unidade, cod_anvisa_med, lote_med
+                )
+                INSERT INTO saldomensalestoque (cod_unidade, cod_anvisa_med, lote_med, mes, saldo, entradas, saidas, dispensado)
+                SELECT m.cod_unidade, m.cod_anvisa_med, m.lote_med, %(mes)s,
+                       COALESCE(anterior.saldo, 0) + m.variacao, m.entradas, m.saidas, m.dispensado
+                FROM movimentos m
+                LEFT JOIN LATERAL (
+                    SELECT s.saldo FROM saldomensalestoque s
+                    WHERE s.cod_unidade = m.cod_unidade AND s.cod_anvisa_med = m.cod_anvisa_med
+                      AND s.lote_med = m.lote_med AND s.mes < %(mes)s
+                    ORDER BY s.mes DESC
+                    LIMIT 1
+                ) anterior ON true
+                """, {'mes': mes, 'fim': _somar_meses(mes, 1)})
+                cursor.execute('INSERT INTO compactacaomovimentacao (mes) VALUES (%s)', (mes,))
+                compactados.append(mes)
+                mes = _somar_meses(mes, 1)
+            conn.commit()
+        return {'status': 'success', 'message': f'{len(compactados)} mês(es) compactado(s).', 'meses': compactados}
+    except Exception as e:
+        return {'status': 'error', 'message': str(e)}
+
+# GET /unidades/<cod_unidade>/medicamentos/<lote>/<cod_anvisa>/movimentacoes?desde=<data>&ate=<data>
+def get_movimentacoes(cod_unidade, lote, cod_anvisa, desde=None, ate=None, limite=LIMITE_MOVIMENTACOES):
+    filtros = ''
+    if desde is not None:
+        filtros += ' AND data_mov >= %(desde)s'
+    if ate is not None:
+        filtros += " AND data_mov < %(ate)s::date + 1"
+    return _relatorio(f"""
+    SELECT data_mov, tipo_mov, quantidade_mov, observacao_mov
+    FROM movimentacaoestoque
+    WHERE cod_unidade = %(cod_unidade)s AND cod_anvisa_med = %(cod_anvisa)s AND lote_med = %(lote)s
+      {filtros}
+    ORDER BY data_mov DESC, id_mov DESC
+    LIMIT %(limite)s
+    """, {'cod_unidade': cod_unidade, 'cod_anvisa': cod_anvisa, 'lote': lote, 'desde': desde, 'ate': ate, 'limite': limite})
+
+# GET /unidades/<cod_unidade>/medicamentos/<cod_anvisa>/saldo?data=<data>&lote=<lote>
+def get_saldo_em(cod_unidade, cod_anvisa, data, lote=None):
+    # Saldo ao final do dia `data` (de um lote ou de todos os lotes do medicamento na
+    # unidade): último retrato mensal compactado antes do corte + movimentações do corte
+    # em diante, que ficam no máximo num mês de partição
+    limite = data + datetime.timedelta(days=1)
+    filtro_lote = 'AND lote_med = %(lote)s' if lote is not None else ''
+    with conexao() as conn, conn.cursor() as cursor:
+        corte = min(_fim_compactacao(cursor), _inicio_mes(data))
+        cursor.execute(f"""
+        SELECT COALESCE((
+            SELECT SUM(saldo) FROM (
+                SELECT DISTINCT ON (lote_med) saldo
+                FROM saldomensalestoque
+                WHERE cod_unidade = %(cod_unidade)s AND cod_anvisa_med = %(cod_anvisa)s {filtro_lote}
+                  AND mes < %(corte)s
+                ORDER BY lote_med, mes DESC
+            ) ultimos
+        ), 0) + COALESCE((
+            SELECT SUM(quantidade_mov)
+            FROM movimentacaoestoque
+            WHERE cod_unidade = %(cod_unidade)s AND cod_anvisa_med = %(cod_anvisa)s {filtro_lote}
+              AND data_mov >= %(corte)s AND data_mov < %(limite)s
+        ), 0)
+        """, {'cod_unidade': cod_unidade, 'cod_anvisa': cod_anvisa, 'lote': lote, 'corte': corte, 'limite': limite})
+        return cursor.fetchone()[0]
+
+# GET /relatorios/consumo?dias=<n>&cod_unidade=<cod_unidade>&cod_anvisa=<cod_anvisa>
+def relatorio_consumo(dias=30, cod_unidade=None, cod_anvisa=None):
+    # Quantidade dispensada nos últimos `dias` dias e média diária por unidade e medicamento.
+    # Meses inteiros já compactados vêm de saldomensalestoque; só o mês parcial do início
+    # e os meses ainda não compactados são lidos das movimentações
+    inicio = datetime.date.today() - datetime.timedelta(days=int(dias))
+    primeiro_mes = inicio if inicio.day == 1 else _somar_meses(_inicio_mes(inicio), 1)
+    filtros = ''
+    if cod_unidade is not None:
+        filtros += ' AND cod_unidade = %(cod_unidade)s'
+    if cod_anvisa is not None:
+        filtros += ' AND cod_anvisa_med = %(cod_anvisa)s'
+    with conexao() as conn, conn.cursor() as cursor:
+        corte = _fim_compactacao(cursor)
+        if primeiro_mes >= corte:
+            primeiro_mes = corte = inicio
+        cursor.execute(f"""
+        SELECT c.cod_unidade, c.cod_anvisa_med, m.nome_comercial,
+               SUM(c.dispensado) AS dispensado,
+               ROUND(SUM(c.dispensado)::numeric / %(dias)s, 2)::float8 AS consumo_diario
+        FROM (
+            SELECT cod_unidade, cod_anvisa_med, dispensado
+            FROM saldomensalestoque
+            WHERE mes >= %(primeiro_mes)s AND mes < %(corte)s {filtros}
+            UNION ALL
+            SELECT cod_unidade, cod_anvisa_med, -quantidade_mov
+            FROM movimentacaoestoque
+            WHERE tipo_mov = 'dispensacao'
+              AND ((data_mov >= %(inicio)s AND data_mov < %(primeiro_mes)s) OR data_mov >= %(corte)s)
+              {filtros}
+        ) c
+        JOIN medicamento m ON m.cod_anvisa_med = c.cod_anvisa_med
+        GROUP BY c.cod_unidade, c.cod_anvisa_med, m.nome_comercial
+        HAVING SUM(c.dispensado) > 0
+        ORDER BY consumo_diario DESC, c.cod_unidade, c.cod_anvisa_med
+        """, {'dias': max(1, int(dias)), 'inicio': inicio, 'primeiro_mes': primeiro_mes, 'corte': corte,
+              'cod_unidade': cod_unidade, 'cod_anvisa': cod_anvisa})
+        colunas = [coluna.name for coluna in cursor.description]
+        return [dict(zip(colunas, linha)) for linha in cursor.fetchall()]
+
+# ==== Exclusão em etapas
+# Linhas de estoque removidas por transação ao excluir uma unidade ou medicamento em etapas
+TAMANHO_LOTE_EXCLUSAO = 5000
+# Pausa entre os lotes para não disputar I/O e WAL com as dispensações
+PAUSA_LOTE_EXCLUSAO = 0.05
+# Exclusões concluídas que continuam consultáveis em get_exclusao; as mais antigas são descartadas
+EXCLUSOES_CONCLUIDAS_MANTIDAS = 100
+
+_exclusoes = {}
+_exclusoes_concluidas = collections.deque()
+_exclusoes_lock = threading.Lock()
+_ids_exclusao = itertools.count(1)
+
+def _excluir_em_etapas(tabela, coluna, valor, mensagem, tamanho_lote, pausa, progresso):
+    # O estoque dependente sai em lotes curtos (cada um trava só as próprias linhas e pula as
+    # que estão em uso numa dispensação); no fim o DELETE do cadastro só cascateia o que sobrou
+    filtro = sql.SQL('{} = %s').format(sql.Identifier(coluna))
+    observacao = f'Exclusão de {tabela} {valor}'
+    removidas = 0
+    try:
+        with conexao() as conn, conn.cursor() as cursor:
+            cursor.execute(sql.SQL('SELECT COUNT(*) FROM medicamentoestocado WHERE {}').format(filtro), (valor,))
+            total = cursor.fetchone()[0]
+            conn.commit()
+        if progresso:
+            progresso(removidas, total)
+
+        while True:
+            with conexao() as conn, conn.cursor() as cursor:
+                _tipo_movimentacao(cursor, 'ajuste', observacao)
+                cursor.execute(sql.SQL("""
+                DELETE FROM medicamentoestocado
+                WHERE (lote_med, cod_anvisa_med, cod_unidade) IN (
+                    SELECT lote_med, cod_anvisa_med, cod_unidade FROM medicamentoestocado
+                    WHERE {}
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                """).format(filtro), (valor, tamanho_lote))
+                apagadas = cursor.rowcount
+                conn.commit()
+            removidas += apagadas
+            if progresso:
+                progresso(removidas, max(total, removidas))
+            if apagadas < tamanho_lote:
+                break
+            time.sleep(pausa)
+
+        with conexao() as conn, conn.cursor() as cursor:
+            _tipo_movimentacao(cursor, 'ajuste', observacao)
+            cursor.execute(sql.SQL('DELETE FROM {} WHERE {}').format(sql.Identifier(tabela), filtro), (valor,))
+            _notificar_cache(cursor, tabela, valor)
+            conn.commit()
+        _invalidar_cache(tabela, valor)
+        return {'status': 'success', 'message': mensagem, 'linhas_estoque': removidas}
+    except Exception as e:
+        return {'status': 'error', 'message': str(e), 'linhas_estoque': removidas}
+
+# DELETE /medicamentos/<cod_anvisa>?em_etapas=1
+def delete_medicamento_em_etapas(cod_anvisa, tamanho_lote=TAMANHO_LOTE_EXCLUSAO, pausa=PAUSA_LOTE_EXCLUSAO, progresso=None):
+    return _excluir_em_etapas('medicamento', 'cod_anvisa_med', cod_anvisa, 'Medicamento deletado com sucesso.',
+                              tamanho_lote, pausa, progresso)
+
+# DELETE /unidades/<cod_unidade>?em_etapas=1
+def delete_unidade_em_etapas(cod_unidade, tamanho_lote=TAMANHO_LOTE_EXCLUSAO, pausa=PAUSA_LOTE_EXCLUSAO, progresso=None):
+    try:
+        cod_unidade = int(cod_unidade)
+    except (TypeError, ValueError):
+        return {'status': 'error', 'message': f'Código de unidade inválido: {cod_unidade}', 'linhas_estoque': 0}
+    return _excluir_em_etapas('unidadesaude', 'cod_unidade', cod_unidade, 'Unidade de saúde deletada com sucesso.',
+                              tamanho_lote, pausa, progresso)
+
+def iniciar_exclusao(funcao, chave, **opcoes):
+    # Roda delete_*_em_etapas numa thread; o andamento é consultado com get_exclusao(id)
+    id_exclusao = next(_ids_exclusao)
+    estado = {'id': id_exclusao, 'chave': chave, 'status': 'running', 'removidas': 0, 'total': None,
+              'iniciada_em': datetime.datetime.now(), 'resultado': None}
+
+    def progresso(removidas, total):
+        with _exclusoes_lock:
+            estado['removidas'], estado['total'] = removidas, total
+
+    def executar():
+        # Uma exceção aqui mataria a thread e deixaria a exclusão como 'running' para sempre
+        try:
+            resultado = funcao(chave, progresso=progresso, **opcoes)
+        except Exception as e:
+            resultado = {'status': 'error', 'message': str(e)}
+        with _exclusoes_lock:
+            estado['status'], estado['resultado'] = resultado['status'], resultado
+            _exclusoes_concluidas.append(id_exclusao)
+            while len(_exclusoes_concluidas) > EXCLUSOES_CONCLUIDAS_MANTIDAS:
+                _exclusoes.pop(_exclusoes_concluidas.popleft(), None)
+
+    with _exclusoes_lock:
+        _exclusoes[id_exclusao] = estado
+    threading.Thread(target=executar, name=f'tp4-exclusao-{id_exclusao}', daemon=True).start()
+    return id_exclusao
+
+# GET /exclusoes/<id>
+def get_exclusao(id_exclusao):
+    with _exclusoes_lock:
+        estado = _exclusoes.get(int(id_exclusao))
+        return dict(estado) if estado else None
+
+# ==== Fila de escrita com commit em grupo
+# Opcional: escritas de estoque de muitos chamadores entram numa fila e são confirmadas em
+# grupo, um COMMIT (e um flush do WAL) para várias dispensações em vez de um por chamada
+# Tempo máximo que a primeira escrita de um grupo espera por outras antes do COMMIT
+FILA_LATENCIA_MAXIMA = 0.005
+# Escritas confirmadas por um mesmo COMMIT
+FILA_TAMANHO_GRUPO = 200
+# Escritas aguardando na fila; com ela cheia, quem envia espera uma vaga até o timeout
+FILA_CAPACIDADE = 10_000
+
+class FilaEscritaCheia(Exception):
+    pass
+
+def _futuro_resolvido(resultado):
+    futuro = concurrent.futures.Future()
+    futuro.set_result(resultado)
+    return futuro
+
+class FilaEscrita:
+    # Cada escrita roda num SAVEPOINT dentro da transação do grupo, então a falha de uma
+    # (estoque insuficiente, lote duplicado...) só desfaz a dela e vira o resultado do seu futuro
+    def __init__(self, latencia_maxima=FILA_LATENCIA_MAXIMA, tamanho_grupo=FILA_TAMANHO_GRUPO, capacidade=FILA_CAPACIDADE):
+        self.latencia_maxima = latencia_maxima
+        self.tamanho_grupo = tamanho_grupo
+        self._fila = queue.Queue(maxsize=capacidade)
+        self._fechada = False
+        self._lock = threading.Lock()
+        self._grupos = 0
+        self._escritas = 0
+        self._maior_grupo = 0
+        self._recusadas = 0
+        self._thread = threading.Thread(target=self._executar, name='tp4-fila-escrita', daemon=True)
+        self._thread.start()
+
+    def enviar(self, operacao, *args, timeout=None):
+        # operacao(cursor, *args) -> resultado no formato das funções do módulo. Com a fila cheia
+        # espera até timeout segundos (None: sem limite, 0: não espera) e levanta FilaEscritaCheia
+        if self._fechada:
+            raise RuntimeError('Fila de escrita fechada.')
+        futuro = concurrent.futures.Future()
+        try:
+            self._fila.put((operacao, args, futuro), timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self._recusadas += 1
+            raise FilaEscritaCheia('Fila de escrita cheia; tente novamente em instantes.') from None
+        return futuro
+
+    def post_estoque_medicamento(self, estoque: EstoqueMedicamento, timeout=None):
+        return self.enviar(_inserir_estoque, estoque, timeout=timeout)
+
+    def update_estoque_medicamento(self, estoque: EstoqueMedicamento, timeout=None):
+        return self.enviar(_atualizar_estoque, estoque, timeout=timeout)
+
+    def dispensar_medicamentos(self, cod_unidade, itens, timeout=None):
+        pedido, erro = _pedido_dispensacao(itens)
+        if erro:
+            return _futuro_resolvido(erro)
+        return self.enviar(_dispensar, cod_unidade, pedido, timeout=timeout)
+
+    def dispensar_medicamento(self, cod_unidade, lote, cod_anvisa, quantidade, timeout=None):
+        return self.dispensar_medicamentos(cod_unidade, [(lote, cod_anvisa, quantidade)], timeout=timeout)
+
+    def dispensar_medicamentos_fefo(self, cod_unidade, itens, timeout=None):
+        pedido, erro = _pedido_dispensacao_fefo(itens)
+        if erro:
+            return _futuro_resolvido(erro)
+        return self.enviar(_dispensar_fefo, cod_unidade, pedido, timeout=timeout)
+
+    def dispensar_medicamento_fefo(self, cod_unidade, cod_anvisa, quantidade, timeout=None):
+        return self.dispensar_medicamentos_fefo(cod_unidade, [(cod_anvisa, quantidade)], timeout=timeout)
+
+    def fechar(self):
+        # Para de aceitar escritas e espera as que já estão na fila serem confirmadas
+        if not self._fechada:
+            self._fechada = True
+            self._fila.put(None)
+            self._thread.join()
+            # Escritas enviadas durante o fechamento ficaram atrás do marcador de fim
+            while True:
+                try:
+                    _, _, futuro = self._fila.get_nowait()
+                except queue.Empty:
+                    break
+                if futuro.set_running_or_notify_cancel():
+                    futuro.set_result({'status': 'error', 'message': 'Fila de escrita fechada.'})
+
+    def estatisticas(self):
+        with self._lock:
+            return {
+                'pendentes': self._fila.qsize(),
+                'grupos': self._grupos,
+                'escritas': self._escritas,
+                'media_grupo': self._escritas / self._grupos if self._grupos else 0.0,
+                'maior_grupo': self._maior_grupo,
+                'recusadas': self._recusadas,
+            }
+
+    def _executar(self):
+        fim = False
+        while not fim:
+            item = self._fila.get()
+            if item is None:
+                break
+            grupo = [item]
+            limite = time.monotonic() + self.latencia_maxima
+            while len(grupo) < self.tamanho_grupo:
+                try:
+                    item = self._fila.get(timeout=max(0.0, limite - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    fim = True
+                    break
+                grupo.append(item)
+            grupo = [(operacao, args, futuro) for operacao, args, futuro in grupo if futuro.set_running_or_notify_cancel()]
+            if grupo:
+                try:
+                    self._confirmar(grupo)
+                except Exception as e:
+                    for _, _, futuro in grupo:
+                        if not futuro.done():
+                            futuro.set_result(_erro(e))
+
+    def _confirmar(self, grupo):
+        resultados = []
+        enviando_commit = False
+        try:
+            with conexao() as conn, conn.cursor() as cursor:
+                for operacao, args, _ in grupo:
+                    # O tipo de movimentação de uma escrita não pode vazar para a seguinte
+                    cursor.execute("""
+                    SAVEPOINT tp4_fila;
+                    SELECT set_config('tp4.tipo_movimentacao', '', true), set_config('tp4.observacao_movimentacao', '', true)
+                    """)
+                    try:
+                        resultados.append(operacao(cursor, *args))
+                    except Exception as e:
+                        # Um deadlock desta escrita só desfaz o savepoint dela; conexão perdida derruba o grupo
+                        if conn.closed or _conexao_perdida(e):
+                            raise
+                        cursor.execute('ROLLBACK TO SAVEPOINT tp4_fila')
+                        resultados.append(_erro(e))
+                    else:
+                        cursor.execute('RELEASE SAVEPOINT tp4_fila')
+                enviando_commit = True
+                conn.commit()
+        except Exception as e:
+            if enviando_commit:
+                # Não dá para saber se o COMMIT chegou a ser aplicado; repetir poderia baixar duas vezes
+                resultados = [_erro(e)] * len(grupo)
+            else:
+                # Nada do grupo foi confirmado: cada escrita é refeita na sua própria transação
+                resultados = [_em_transacao(operacao, *args) for operacao, args, _ in grupo]
+
+        with self._lock:
+            self._grupos += 1
+            self._escritas += len(grupo)
+            self._maior_grupo = max(self._maior_grupo, len(grupo))
+        for (_, _, futuro), resultado in zip(grupo, resultados):
+            futuro.set_result(resultado)
+
+_fila_escrita = None
+_fila_escrita_lock = threading.Lock()
+
+def iniciar_fila_escrita(**opcoes):
+    global _fila_escrita
+    with _fila_escrita_lock:
+        if _fila_escrita is None:
+            _fila_escrita = FilaEscrita(**opcoes)
+        return _fila_escrita
+
+def fila_escrita():
+    return _fila_escrita
+
+def parar_fila_escrita():
+    global _fila_escrita
+    with _fila_escrita_lock:
+        if _fila_escrita is not None:
+            _fila_escrita.fechar()
+            _fila_escrita = None
+
+# ==== Operações em lote
+# Quantidade de linhas enviadas por comando pelo execute_values
+TAMANHO_LOTE = 1000
+
+def _executar_lote(query, chaves, valores, mensagem_sucesso, mensagem_falha, tamanho_lote, template=None, tabela_cache=None):
+    # Executa o lote inteiro numa única transação; as chaves devolvidas pelo RETURNING
+    # indicam quais itens foram aplicados
+    if not valores:
+        return {'status': 'success', 'message': 'Nenhum item informado.', 'itens': []}
+    try:
+        with conexao() as conn, conn.cursor() as cursor:
+            afetadas = psycopg2.extras.execute_values(
+                cursor, query, valores, template=template, page_size=tamanho_lote, fetch=True)
+            if tabela_cache:
+                _notificar_cache(cursor, tabela_cache)
+            conn.commit()
+    except Exception as e:
+        return {
+            'status': 'error',
+            'message': str(e),
+            'itens': [{'chave': chave, 'status': 'error', 'message': str(e)} for chave in chaves],
+        }
+
+    afetadas = {tuple(str(valor) for valor in linha) for linha in afetadas}
+    itens = []
+    for chave in chaves:
+        aplicado = tuple(str(valor) for valor in chave) in afetadas
+        if aplicado and tabela_cache:
+            _invalidar_cache(tabela_cache, chave[0])
+        itens.append({
+            'chave': chave,
+            'status': 'success' if aplicado else 'error',
+            'message': mensagem_sucesso if aplicado else mensagem_falha,
+        })
+    aplicados = sum(item['status'] == 'success' for item in itens)
+    return {
+        'status': 'success' if aplicados == len(itens) else 'error',
+        'message': f'{aplicados} de {len(itens)} itens processados com sucesso.',
+        'itens': itens,
+    }
+
+# POST /medicamentos/lote
+def post_medicamentos(medicamentos: list[Medicamento], tamanho_lote=TAMANHO_LOTE):
+    return _executar_lote(
+        f"""
+        INSERT INTO medicamento ({Medicamento.COLUNAS}) VALUES %s
+        ON CONFLICT (cod_anvisa_med) DO NOTHING
+        RETURNING cod_anvisa_med
+        """,
+        [(med.cod_anvisa,) for med in medicamentos],
+        [(med.cod_anvisa, med.nome_comercial, med.fabricante, med.apresentacao, med.forma_administracao, med.principio_ativo)
+         for med in medicamentos],
+        'Medicamento adicionado com sucesso.',
+        'Medicamento já cadastrado.',
+        tamanho_lote)
+
+# UPDATE /medicamentos/lote
+def update_medicamentos(medicamentos: list[Medicamento], tamanho_lote=TAMANHO_LOTE):
+    return _executar_lote(
+        """
+        UPDATE medicamento m
+        SET nome_comercial = v.nome_comercial, fabricante_med = v.fabricante_med, apresentacao_med = v.apresentacao_med,
+            forma_administracao_med = v.forma_administracao_med, principio_ativo_med = v.principio_ativo_med
+        FROM (VALUES %s) AS v(cod_anvisa_med, nome_comercial, fabricante_med, apresentacao_med, forma_administracao_med, principio_ativo_med)
+        WHERE m.cod_anvisa_med = v.cod_anvisa_med
+        RETURNING m.cod_anvisa_med
+        """,
+        [(med.cod_anvisa,) for med in medicamentos],
+        [(med.cod_anvisa, med.nome_comercial, med.fabricante, med.apresentacao, med.forma_administracao, med.principio_ativo)
+         for med in medicamentos],
+        'Medicamento atualizado com sucesso.',
+        'Medicamento não encontrado.',
+        tamanho_lote,
+        tabela_cache='medicamento')
+
+# DELETE /medicamentos/lote
+def delete_medicamentos(cods_anvisa: list[str], tamanho_lote=TAMANHO_LOTE):
+    return _executar_lote(
+        """
+        DELETE FROM medicamento m USING (VALUES %s) AS v(cod_anvisa_med)
+        WHERE m.cod_anvisa_med = v.cod_anvisa_med
+        RETURNING m.cod_anvisa_med
+        """,
+        [(cod_anvisa,) for cod_anvisa in cods_anvisa],
+        [(cod_anvisa,) for cod_anvisa in cods_anvisa],
+        'Medicamento deletado com sucesso.',
+        'Medicamento não encontrado.',
+        tamanho_lote,
+        tabela_cache='medicamento')
+
+# POST /unidades/lote
+def post_unidades(unidades: list[UnidadeSaude], tamanho_lote=TAMANHO_LOTE):
+    return _executar_lote(
+        f"""
+        INSERT INTO unidadesaude ({UnidadeSaude.COLUNAS}) VALUES %s
+        ON CONFLICT DO NOTHING
+        RETURNING cod_unidade
+        """,
+        [(un.cod,) for un in unidades],
+        [(un.cod, un.nome, un.telefone, un.tipo, un.rua, un.numero, un.bairro, un.cep) for un in unidades],
+        'Unidade de saúde adicionada com sucesso.',
+        'Unidade de saúde já cadastrada.',
+        tamanho_lote)
+
+# UPDATE /unidades/lote
+def update_unidades(unidades: list[UnidadeSaude], tamanho_lote=TAMANHO_LOTE):
+    return _executar_lote(
+        """
+        UPDATE unidadesaude u
+        SET nome_unidade = v.nome_unidade, tel_unidade = v.tel_unidade, tipo_unidade = v.tipo_unidade,
+            rua_end_unidade = v.rua_end_unidade, num_end_unidade = v.num_end_unidade,
+            bairro_end_unidade = v.bairro_end_unidade, cep_end_unidade = v.cep_end_unidade
+        FROM (VALUES %s) AS v(cod_unidade, nome_unidade, tel_unidade, tipo_unidade, rua_end_unidade, num_end_unidade, bairro_end_unidade, cep_end_unidade)
+        WHERE u.cod_unidade = v.cod_unidade
+        RETURNING u.cod_unidade
+        """,
+        [(un.cod,) for un in unidades],
+        [(un.cod, un.nome, un.telefone, un.tipo, un.rua, un.numero, un.bairro, un.cep) for un in unidades],
+        'Unidade de saúde atualizada com sucesso.',
+        'Unidade de saúde não encontrada.',
+        tamanho_lote,
+        template='(%s::integer, %s, %s, %s, %s, %s::integer, %s, %s)',
+        tabela_cache='unidadesaude')
+
+# DELETE /unidades/lote
+def delete_unidades(cods_unidade: list[int], tamanho_lote=TAMANHO_LOTE):
+    return _executar_lote(
+        """
+        DELETE FROM unidadesaude u USING (VALUES %s) AS v(cod_unidade)
+        WHERE u.cod_unidade = v.cod_unidade
+        RETURNING u.cod_unidade
+        """,
+        [(cod_unidade,) for cod_unidade in cods_unidade],
+        [(cod_unidade,) for cod_unidade in cods_unidade],
+        'Unidade de saúde deletada com sucesso.',
+        'Unidade de saúde não encontrada.',
+        tamanho_lote,
+        template='(%s::integer)',
+        tabela_cache='unidadesaude')
+
+# POST /unidades/medicamentos/lote
+def post_estoques(estoques: list[EstoqueMedicamento], tamanho_lote=TAMANHO_LOTE):
+    return _executar_lote(
+        f"""
+        INSERT INTO medicamentoestocado ({EstoqueMedicamento.COLUNAS}) VALUES %s
+        ON CONFLICT DO NOTHING
+        RETURNING lote_med, cod_anvisa_med, cod_unidade
+        """,
+        [(item.lote, item.cod_anvisa, item.cod_unidade) for item in estoques],
+        [(item.lote, item.cod_anvisa, item.cod_unidade, item.validade, item.quantidade) for item in estoques],
+        'Medicamento adicionado ao estoque com sucesso.',
+        'Lote já cadastrado no estoque desta unidade.',
+        tamanho_lote,
+        template="(%s, %s, %s, to_date(%s, 'DD/MM/YYYY'), %s)")
+
+# PUT /unidades/medicamentos/lote
+def update_estoques(estoques: list[EstoqueMedicamento], tamanho_lote=TAMANHO_LOTE):
+    return _executar_lote(
+        """
+        UPDATE medicamentoestocado e
+        SET quantidade_med_estoque = v.quantidade_med_estoque
+        FROM (VALUES %s) AS v(lote_med, cod_anvisa_med, cod_unidade, quantidade_med_estoque)
+        WHERE e.lote_med = v.lote_med AND e.cod_anvisa_med = v.cod_anvisa_med AND e.cod_unidade = v.cod_unidade
+        RETURNING e.lote_med, e.cod_anvisa_med, e.cod_unidade
+        """,
+        [(item.lote, item.cod_anvisa, item.cod_unidade) for item in estoques],
+        [(item.lote, item.cod_anvisa, item.cod_unidade, item.quantidade) for item in estoques],
+        'Medicamento no estoque atualizado com sucesso.',
+        'Medicamento não encontrado no estoque desta unidade.',
+        tamanho_lote,
+        template='(%s, %s, %s::integer, %s::integer)')
+
+# ==== Importação em massa (COPY FROM STDIN)
+def _texto(tamanho, obrigatorio=False):
+    def converter(valor):
+        if valor is None or str(valor).strip() == '':
+            if obrigatorio:
+                raise ValueError('valor obrigatório ausente')
+            return None
+        valor = str(valor).strip()
+        if len(valor) > tamanho:
+            raise ValueError(f'valor excede {tamanho} caracteres')
+        return valor
+    return converter
+
+def _inteiro(obrigatorio=False):
+    def converter(valor):
+        if valor is None or str(valor).strip() == '':
+            if obrigatorio:
+                raise ValueError('valor obrigatório ausente')
+            return None
+        return int(valor)
+    return converter
+
+def _data(obrigatorio=False):
+    def converter(valor):
+        if valor is None or str(valor).strip() == '':
+            if obrigatorio:
+                raise ValueError('valor obrigatório ausente')
+            return None
+        if isinstance(valor, (datetime.date, datetime.datetime)):
+            return valor.strftime('%Y-%m-%d')
+        valor = str(valor).strip()
+        for formato in ('%Y-%m-%d', '%d/%m/%Y'):
+            try:
+                return datetime.datetime.strptime(valor, formato).strftime('%Y-%m-%d')
+            except ValueError:
+                pass
+        raise ValueError(f'data inválida: {valor}')
+    return converter
+
+_ESQUEMAS_IMPORTACAO = {
+    'medicamento': {
+        'colunas': [
+            ('cod_anvisa_med', _texto(13, obrigatorio=True)),
+            ('nome_comercial', _texto(100, obrigatorio=True)),
+            ('fabricante_med', _texto(50)),
+            ('apresentacao_med', _texto(100)),
+            ('forma_administracao_med', _texto(30)),
+            ('principio_ativo_med', _texto(50, obrigatorio=True)),
+        ],
+        'chave': ['cod_anvisa_med'],
+        'referencias': [],
+    },
+    'unidadesaude': {
+        'colunas': [
+            ('cod_unidade', _inteiro(obrigatorio=True)),
+            ('nome_unidade', _texto(100, obrigatorio=True)),
+            ('tel_unidade', _texto(11)),
+            ('tipo_unidade', _texto(40)),
+            ('rua_end_unidade', _texto(100)),
+            ('num_end_unidade', _inteiro()),
+            ('bairro_end_unidade', _texto(40)),
+            ('cep_end_unidade', _texto(8)),
+        ],
+        'chave': ['cod_unidade'],
+        'referencias': [],
+    },
+    'medicamentoestocado': {
+        'colunas': [
+            ('lote_med', _texto(7, obrigatorio=True)),
+            ('cod_anvisa_med', _texto(13, obrigatorio=True)),
+            ('cod_unidade', _inteiro(obrigatorio=True)),
+            ('validade_med_estoque', _data()),
+            ('quantidade_med_estoque', _inteiro(obrigatorio=True)),
+        ],
+        'chave': ['lote_med', 'cod_anvisa_med', 'cod_unidade'],
+        'referencias': [
+            ('medicamento', 'cod_anvisa_med'),
+            ('unidadesaude', 'cod_unidade'),
+        ],
+    },
+}
+
+class _LeitorCopy:
+    # Adapta um gerador de linhas CSV para a interface de arquivo usada pelo copy_expert
+    def __init__(self, linhas):
+        self.linhas = linhas
+        self.buffer = ''
+
+    def read(self, tamanho=-1):
+        while tamanho < 0 or len(self.buffer) < tamanho:
+            try:
+                self.buffer += next(self.linhas)
+            except StopIteration:
+                break
+        if tamanho < 0:
+            tamanho = len(self.buffer)
+        dados, self.buffer = self.buffer[:tamanho], self.buffer[tamanho:]
+        return dados
+
+def _ler_linhas(origem, colunas):
+    # Aceita o caminho de um arquivo CSV (com ou sem cabeçalho) ou um iterável de tuplas/dicts
+    if isinstance(origem, str):
+        with open(origem, newline='', encoding='utf-8') as arquivo:
+            leitor = csv.reader(arquivo)
+            for numero, linha in enumerate(leitor, start=1):
+                if numero == 1 and [c.strip() for c in linha] == colunas:
+                    continue
+                yield numero, linha
+        return
+
+    for numero, linha in enumerate(origem, start=1):
+        if isinstance(linha, dict):
+            linha = [linha.get(coluna) for coluna in colunas]
+        yield numero, linha
+
+def _importar(tabela, origem, upsert=False):
+    esquema = _ESQUEMAS_IMPORTACAO[tabela]
+    colunas = [coluna for coluna, _ in esquema['colunas']]
+    chave = esquema['chave']
+    rejeitadas = []
+    lidas = 0
+
+    def linhas_validas():
+        nonlocal lidas
+        saida = io.StringIO()
+        escritor = csv.writer(saida)
+        for numero, linha in _ler_linhas(origem, colunas):
+            lidas += 1
+            if len(linha) != len(colunas):
+                rejeitadas.append((numero, f'esperadas {len(colunas)} colunas, recebidas {len(linha)}'))
+                continue
+            try:
+                valores = [converter(valor) for (_, converter), valor in zip(esquema['colunas'], linha)]
+            except (ValueError, TypeError) as e:
+                rejeitadas.append((numero, str(e)))
+                continue
+            escritor.writerow(valores + [numero])
+            yield saida.getvalue()
+            saida.seek(0)
+            saida.truncate()
+
+    inicio = time.perf_counter()
+    staging = sql.Identifier(f'_import_{tabela}')
+    lista_colunas = sql.SQL(', ').join(map(sql.Identifier, colunas))
+    lista_chave = sql.SQL(', ').join(map(sql.Identifier, chave))
+    try:
+        with conexao() as conn, conn.cursor() as cursor:
+            cursor.execute(sql.SQL(
+                "CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS, _linha INTEGER) ON COMMIT DROP"
+            ).format(staging, sql.Identifier(tabela)))
+            cursor.copy_expert(sql.SQL(
+                "COPY {} ({}, _linha) FROM STDIN WITH (FORMAT csv)"
+            ).format(staging, lista_colunas).as_string(cursor), _LeitorCopy(linhas_validas()))
+
+            # Linhas sem medicamento/unidade correspondente seriam rejeitadas pela FK
+            for tabela_ref, coluna in esquema['referencias']:
+                cursor.execute(sql.SQL(
+                    "DELETE FROM {staging} s WHERE NOT EXISTS "
+                    "(SELECT 1 FROM {ref} r WHERE r.{col} = s.{col}) RETURNING s._linha, s.{col}"
+                ).format(staging=staging, ref=sql.Identifier(tabela_ref), col=sql.Identifier(coluna)))
+                rejeitadas.extend((linha, f'{coluna} {valor} inexistente em {tabela_ref}')
+                                  for linha, valor in cursor.fetchall())
+
+            # Chaves repetidas dentro do próprio lote: prevalece a última ocorrência
+            cursor.execute(sql.SQL(
+                "DELETE FROM {staging} s USING {staging} t "
+                "WHERE ({chave_s}) = ({chave_t}) AND s._linha < t._linha RETURNING s._linha"
+            ).format(
+                staging=staging,
+                chave_s=sql.SQL(', ').join(sql.SQL('s.{}').format(sql.Identifier(c)) for c in chave),
+                chave_t=sql.SQL(', ').join(sql.SQL('t.{}').format(sql.Identifier(c)) for c in chave)))
+            rejeitadas.extend((linha, 'chave repetida no arquivo') for linha, in cursor.fetchall())
+
+            if upsert:
+                atualizacao = sql.SQL('DO UPDATE SET {}').format(sql.SQL(', ').join(
+                    sql.SQL('{0} = EXCLUDED.{0}').format(sql.Identifier(c)) for c in colunas if c not in chave))
+            else:
+                # Sem upsert, linhas com chave já existente são ignoradas pelo DO NOTHING; são levantadas
+                # antes do INSERT, enquanto a junção ainda não enxerga as linhas deste arquivo
+                atualizacao = sql.SQL('DO NOTHING')
+                cursor.execute(sql.SQL(
+                    "SELECT s._linha, ({colunas_s}) IS NOT DISTINCT FROM ({colunas_t}) "
+                    "FROM {staging} s JOIN {tabela} t USING ({chave})"
+                ).format(
+                    staging=staging, tabela=sql.Identifier(tabela), chave=lista_chave,
+                    colunas_s=sql.SQL(', ').join(sql.SQL('s.{}').format(sql.Identifier(c)) for c in colunas),
+                    colunas_t=sql.SQL(', ').join(sql.SQL('t.{}').format(sql.Identifier(c)) for c in colunas)))
+                rejeitadas.extend((linha, 'chave já cadastrada (idêntica)' if identica else 'chave já cadastrada')
+                                  for linha, identica in cursor.fetchall())
+            cursor.execute(sql.SQL(
+                "INSERT INTO {tabela} ({colunas}) SELECT {colunas} FROM {staging} "
+                "ON CONFLICT ({chave}) {atualizacao} RETURNING {chave}"
+            ).format(tabela=sql.Identifier(tabela), colunas=lista_colunas, staging=staging,
+                     chave=lista_chave, atualizacao=atualizacao))
+            importadas = cursor.rowcount
+            if upsert:
+                _notificar_cache(cursor, tabela)
+            conn.commit()
+        if upsert:
+            _invalidar_cache(tabela)
+    except Exception as e:
+        return {'status': 'error', 'message': str(e)}
+
+    duracao = time.perf_counter() - inicio
+    rejeitadas.sort()
+    return {
+        'status': 'success',
+        'message': f'{importadas} de {lidas} linhas importadas em {tabela}.',
+        'linhas_lidas': lidas,
+        'linhas_importadas': importadas,
+        'rejeitadas': rejeitadas,
+        'linhas_por_segundo': importadas / duracao if duracao else 0.0,
+        'linhas_lidas_por_segundo': lidas / duracao if duracao else 0.0,
+    }
+
+# POST /medicamentos/importacao
+def import_medicamentos(origem, upsert=False):
+    return _importar('medicamento', origem, upsert)
+
+# POST /unidades/importacao
+def import_unidades(origem, upsert=False):
+    return _importar('unidadesaude', origem, upsert)
+
+# POST /unidades/medicamentos/importacao
+def import_estoque_medicamentos(origem, upsert=False):
+    return _importar('medicamentoestocado', origem, upsert)
+
+# ==== Exportação colunar (Parquet/Arrow)
+# Linhas por row group (Parquet) ou record batch (Arrow); também é o máximo mantido em memória
+TAMANHO_GRUPO_EXPORTACAO = 100_000
+
+_CONSULTA_EXPORTACAO = """
+SELECT e.cod_unidade, u.nome_unidade, u.tipo_unidade, u.bairro_end_unidade,
+       e.cod_anvisa_med, m.nome_comercial, m.fabricante_med, m.principio_ativo_med,
+       e.lote_med, e.validade_med_estoque, e.quantidade_med_estoque
+FROM medicamentoestocado e
+JOIN unidadesaude u ON u.cod_unidade = e.cod_unidade
+JOIN medicamento m ON m.cod_anvisa_med = e.cod_anvisa_med
+ORDER BY e.cod_unidade
+"""
+
+def _esquema_exportacao(pa):
+    return pa.schema([
+        ('cod_unidade', pa.int32()),
+        ('nome_unidade', pa.string()),
+        ('tipo_unidade', pa.string()),
+        ('bairro_end_unidade', pa.string()),
+        ('cod_anvisa_med', pa.string()),
+        ('nome_comercial', pa.string()),
+        ('fabricante_med', pa.string()),
+        ('principio_ativo_med', pa.string()),
+        ('lote_med', pa.string()),
+        ('validade_med_estoque', pa.date32()),
+        ('quantidade_med_estoque', pa.int32()),
+    ])
+
+def _abrir_escritor(pa, caminho, esquema, formato):
+    if formato == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.ParquetWriter(caminho, esquema, compression='zstd')
+    return pa.ipc.new_file(caminho, esquema)
+
+def exportar_estoque(destino, formato='parquet', particionar=False, tamanho_grupo=TAMANHO_GRUPO_EXPORTACAO):
+    # Lê o join estoque + medicamento + unidade por um cursor nomeado e grava um grupo
+    # de linhas por vez; com particionar=True gera destino/cod_unidade=<n>/dados.<formato>
+    if formato not in ('parquet', 'arrow'):
+        return {'status': 'error', 'message': f'Formato desconhecido: {formato}. Use parquet ou arrow.'}
+    try:
+        import pyarrow as pa
+        if formato == 'arrow':
+            import pyarrow.ipc
+    except ImportError:
+        return {'status': 'error', 'message': 'A exportação precisa do pyarrow (pip install pyarrow).'}
+
+    esquema = _esquema_exportacao(pa)
+    extensao = 'parquet' if formato == 'parquet' else 'arrow'
+    arquivos = []
+    linhas = 0
+    escritor = None
+    particao_atual = None
+    inicio = time.perf_counter()
+    try:
+        if not particionar:
+            os.makedirs(os.path.dirname(os.path.abspath(destino)), exist_ok=True)
+            escritor = _abrir_escritor(pa, destino, esquema, formato)
+            arquivos.append(destino)
+        with conexao() as conn, conn.cursor(name='cursor_exportacao') as cursor:
+            cursor.execute(_CONSULTA_EXPORTACAO)
+            while True:
+                bloco = cursor.fetchmany(tamanho_grupo)
+                if not bloco:
+                    break
+                # Como a consulta vem ordenada por unidade, só uma partição fica aberta por vez
+                inicio_grupo = 0
+                while inicio_grupo < len(bloco):
+                    fim_grupo = len(bloco)
+                    if particionar:
+                        cod_unidade = bloco[inicio_grupo][0]
+                        fim_grupo = inicio_grupo
+                        while fim_grupo < len(bloco) and bloco[fim_grupo][0] == cod_unidade:
+                            fim_grupo += 1
+                        if cod_unidade != particao_atual:
+                            if escritor is not None:
+                                escritor.close()
+                            pasta = os.path.join(destino, f'cod_unidade={cod_unidade}')
+                            os.makedirs(pasta, exist_ok=True)
+                            caminho = os.path.join(pasta, f'dados.{extensao}')
+                            escritor = _abrir_escritor(pa, caminho, esquema, formato)
+                            arquivos.append(caminho)
+                            particao_atual = cod_unidade
+                    colunas = list(zip(*bloco[inicio_grupo:fim_grupo]))
+                    lote = pa.record_batch(
+                        [pa.array(valores, type=campo.type) for valores, campo in zip(colunas, esquema)],
+                        schema=esquema)
+                    escritor.write_batch(lote)
+                    linhas += lote.num_rows
+                    inicio_grupo = fim_grupo
     except Exception as e:
-        conn.rollback()
         return {'status': 'error', 'message': str(e)}
+    finally:
+        if escritor is not None:
+            escritor.close()
+
+    duracao = time.perf_counter() - inicio
+    return {
+        'status': 'success',
+        'message': f'{linhas} linhas exportadas em {len(arquivos)} arquivo(s).',
+        'linhas': linhas,
+        'arquivos': arquivos,
+        'linhas_por_segundo': linhas / duracao if duracao else 0.0,
+    }
+
+# ==== Instrumentação
+INSTRUMENTACAO_ATIVA = True
+# Chamadas mais lentas que isso (em segundos) vão para o log de consultas lentas
+LIMIAR_CONSULTA_LENTA = 0.5
+# Com True, o log de consultas lentas inclui o EXPLAIN ANALYZE dos SELECTs da chamada
+CAPTURAR_EXPLAIN = False
+# Limites superiores (em segundos) das faixas do histograma de latência
+FAIXAS_LATENCIA = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Quantas consultas de uma mesma chamada são guardadas para o log de consultas lentas
+MAX_CONSULTAS_REGISTRADAS = 20
+PREFIXOS_INSTRUMENTADOS = ('get_', 'post_', 'update_', 'delete_', 'import_', 'dispensar_', 'transferir_', 'buscar_', 'relatorio_')
+
+log_consultas_lentas = logging.getLogger('tp4.consultas_lentas')
+
+_contexto = threading.local()
+_estatisticas = {}
+_estatisticas_lock = threading.Lock()
+
+class _Medicao:
+    __slots__ = ('tempo_banco', 'linhas', 'consultas')
+
+    def __init__(self):
+        self.tempo_banco = 0.0
+        self.linhas = 0
+        self.consultas = []
+
+class _CursorInstrumentado(psycopg2.extensions.cursor):
+    # Soma o tempo gasto no banco e as linhas afetadas em todas as medições abertas na thread
+    def _medir(self, chamada, registrar_consulta):
+        medicoes = getattr(_contexto, 'medicoes', None)
+        if not medicoes:
+            return chamada()
+        inicio = time.perf_counter()
+        try:
+            return chamada()
+        finally:
+            duracao = time.perf_counter() - inicio
+            texto = self.query.decode(errors='replace') if registrar_consulta and self.query else None
+            for medicao in medicoes:
+                medicao.tempo_banco += duracao
+                if registrar_consulta:
+                    medicao.linhas += max(self.rowcount, 0)
+                    if len(medicao.consultas) < MAX_CONSULTAS_REGISTRADAS:
+                        medicao.consultas.append((texto, duracao))
+
+    def execute(self, query, vars=None):
+        return self._medir(lambda: super(_CursorInstrumentado, self).execute(query, vars), True)
+
+    def executemany(self, query, vars_list):
+        return self._medir(lambda: super(_CursorInstrumentado, self).executemany(query, vars_list), True)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._medir(lambda: super(_CursorInstrumentado, self).copy_expert(sql, file, size), True)
+
+    def fetchall(self):
+        return self._medir(lambda: super(_CursorInstrumentado, self).fetchall(), False)
+
+    def fetchmany(self, size=None):
+        return self._medir(lambda: super(_CursorInstrumentado, self).fetchmany(size or self.arraysize), False)
+
+    def fetchone(self):
+        return self._medir(lambda: super(_CursorInstrumentado, self).fetchone(), False)
+
+    # Num cursor nomeado cada FETCH FORWARD acontece dentro do __next__ de quem itera (_iterar)
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self._medir(lambda: super(_CursorInstrumentado, self).__next__(), False)
+
+class _EstatisticaFuncao:
+    __slots__ = ('chamadas', 'erros', 'tempo_total', 'tempo_banco', 'tempo_maximo', 'linhas', 'faixas')
+
+    def __init__(self):
+        self.chamadas = 0
+        self.erros = 0
+        self.tempo_total = 0.0
+        self.tempo_banco = 0.0
+        self.tempo_maximo = 0.0
+        self.linhas = 0
+        self.faixas = [0] * (len(FAIXAS_LATENCIA) + 1)
+
+def _linhas_resultado(resultado, medicao):
+    if resultado is None:
+        return 0
+    if isinstance(resultado, list):
+        return len(resultado)
+    if isinstance(resultado, dict):
+        return medicao.linhas
+    return 1
+
+def _explain(consultas):
+    # ANALYZE executa o comando de verdade, por isso só SELECTs e sempre com rollback
+    planos = []
+    with conexao() as conn, conn.cursor() as cursor:
+        for texto, _ in consultas:
+            if texto and texto.lstrip().upper().startswith('SELECT'):
+                cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + texto)
+                planos.append('\n'.join(f'    {linha}' for linha, in cursor.fetchall()))
+        conn.rollback()
+    return planos
+
+_repr_argumento = reprlib.Repr()
+_repr_argumento.maxstring = 80
+_repr_argumento.maxother = 80
+
+def _resumir_argumento(valor):
+    # Funções de lote recebem listas com até centenas de milhares de objetos; no log basta o tamanho
+    if isinstance(valor, (list, tuple, set, frozenset, dict)) and len(valor) > 3:
+        return f'<{type(valor).__name__} com {len(valor)} itens>'
+    return _repr_argumento.repr(valor)
+
+def _resumir_chamada(nome, args, kwargs):
+    argumentos = [_resumir_argumento(valor) for valor in args]
+    argumentos.extend(f'{chave}={_resumir_argumento(valor)}' for chave, valor in kwargs.items())
+    return f'{nome}({", ".join(argumentos)})'
+
+def _registrar(nome, duracao, medicao, linhas, erro, args, kwargs):
+    with _estatisticas_lock:
+        estatistica = _estatisticas.get(nome)
+        if estatistica is None:
+            estatistica = _estatisticas[nome] = _EstatisticaFuncao()
+        estatistica.chamadas += 1
+        estatistica.erros += erro
+        estatistica.tempo_total += duracao
+        estatistica.tempo_banco += medicao.tempo_banco
+        estatistica.tempo_maximo = max(estatistica.tempo_maximo, duracao)
+        estatistica.linhas += linhas
+        estatistica.faixas[bisect.bisect_left(FAIXAS_LATENCIA, duracao)] += 1
+
+    if duracao < LIMIAR_CONSULTA_LENTA:
+        return
+    consultas = sorted(medicao.consultas, key=lambda consulta: consulta[1], reverse=True)
+    mensagem = [f'{_resumir_chamada(nome, args, kwargs)}: {duracao * 1000:.1f} ms '
+                f'(banco {medicao.tempo_banco * 1000:.1f} ms, python {(duracao - medicao.tempo_banco) * 1000:.1f} ms, {linhas} linhas)']
+    mensagem.extend(f'  {tempo * 1000:.1f} ms: {" ".join(texto.split())}' for texto, tempo in consultas if texto)
+    if CAPTURAR_EXPLAIN:
+        try:
+            mensagem.extend(_explain(consultas))
+        except Exception as e:
+            mensagem.append(f'  EXPLAIN falhou: {e}')
+    log_consultas_lentas.warning('\n'.join(mensagem))
+
+def instrumentar(funcao):
+    @functools.wraps(funcao)
+    def medir(*args, **kwargs):
+        if not INSTRUMENTACAO_ATIVA:
+            return funcao(*args, **kwargs)
+        medicoes = getattr(_contexto, 'medicoes', None)
+        if medicoes is None:
+            medicoes = _contexto.medicoes = []
+        medicao = _Medicao()
+        medicoes.append(medicao)
+        resultado = None
+        erro = True
+        inicio = time.perf_counter()
+        try:
+            resultado = funcao(*args, **kwargs)
+            erro = isinstance(resultado, dict) and resultado.get('status') == 'error'
+            return resultado
+        finally:
+            duracao = time.perf_counter() - inicio
+            medicoes.remove(medicao)
+            linhas = 0 if erro else _linhas_resultado(resultado, medicao)
+            _registrar(funcao.__name__, duracao, medicao, linhas, erro, args, kwargs)
+    return medir
+
+def _instrumentar_funcoes():
+    modulo = globals()
+    for nome, funcao in list(modulo.items()):
+        if nome.startswith(PREFIXOS_INSTRUMENTADOS) and callable(funcao) and not hasattr(funcao, '__wrapped__'):
+            modulo[nome] = instrumentar(funcao)
+
+def estatisticas():
+    with _estatisticas_lock:
+        return {
+            nome: {
+                'chamadas': e.chamadas,
+                'erros': e.erros,
+                'tempo_total': e.tempo_total,
+                'tempo_banco': e.tempo_banco,
+                'tempo_python': e.tempo_total - e.tempo_banco,
+                'tempo_medio': e.tempo_total / e.chamadas if e.chamadas else 0.0,
+                'tempo_maximo': e.tempo_maximo,
+                'linhas': e.linhas,
+                'histograma': dict(zip([str(faixa) for faixa in FAIXAS_LATENCIA] + ['+Inf'], e.faixas)),
+            }
+            for nome, e in sorted(_estatisticas.items())
+        }
+
+def estatisticas_json():
+    return json.dumps(estatisticas(), indent=2)
+
+def estatisticas_prometheus():
+    linhas = [
+        '# HELP tp4_funcao_duracao_segundos Latência das funções de acesso ao banco.',
+        '# TYPE tp4_funcao_duracao_segundos histogram',
+    ]
+    dados = estatisticas()
+    for nome, e in dados.items():
+        acumulado = 0
+        for faixa, quantidade in e['histograma'].items():
+            acumulado += quantidade
+            linhas.append(f'tp4_funcao_duracao_segundos_bucket{{funcao="{nome}",le="{faixa}"}} {acumulado}')
+        linhas.append(f'tp4_funcao_duracao_segundos_sum{{funcao="{nome}"}} {e["tempo_total"]}')
+        linhas.append(f'tp4_funcao_duracao_segundos_count{{funcao="{nome}"}} {e["chamadas"]}')
+    for metrica, campo, descricao in (
+            ('tp4_funcao_banco_segundos_total', 'tempo_banco', 'Tempo gasto esperando o banco.'),
+            ('tp4_funcao_linhas_total', 'linhas', 'Linhas retornadas ou afetadas.'),
+            ('tp4_funcao_erros_total', 'erros', 'Chamadas que falharam.')):
+        linhas.append(f'# HELP {metrica} {descricao}')
+        linhas.append(f'# TYPE {metrica} counter')
+        linhas.extend(f'{metrica}{{funcao="{nome}"}} {e[campo]}' for nome, e in dados.items())
+    return '\n'.join(linhas) + '\n'
+
+def zerar_estatisticas():
+    with _estatisticas_lock:
+        _estatisticas.clear()
+
+_instrumentar_funcoes()
 
 # ==== Functions de renderização
-def render_unidades(unidades: list[UnidadeSaude]):
-    # Print header
-    print(f"{'Código':<10} {'Nome':<30} {'Telefone':<15} {'Tipo':<25} {'Rua':<30} {'Número':<10} {'Bairro':<20} {'CEP':<10}")
-    print("="*150)
-    # Print each unidade
-    for un in unidades:
-        print(f"{un.cod:<10} {un.nome:<30} {un.telefone:<15} {un.tipo:<25} {un.rua:<30} {un.numero:<10} {un.bairro:<20} {un.cep:<10}")
-
-def render_medicamentos(medicamentos: list[Medicamento]):
-    # Print header
-    print(f"{'Código ANVISA':<15} {'Nome Comercial':<30} {'Fabricante':<20} {'Apresentação':<30} {'Forma de Administração':<30} {'Princípio Ativo':<30}")
-    print("="*150)
-    # Print each medicamento
-    for med in medicamentos:
-        print(f"{med.cod_anvisa:<15} {med.nome_comercial:<30} {med.fabricante:<20} {med.apresentacao:<30} {med.forma_administracao:<30} {med.principio_ativo:<30}")
-
-def render_estoque_medicamentos(estoque: list[EstoqueMedicamento]):
-    # Print header
-    print(f"{'Lote':<10} {'Código ANVISA':<15} {'Código Unidade':<15} {'Validade':<15} {'Quantidade':<10}")
-    print("="*70)
-    # Print each estoque medicamento
-    for item in estoque:
-        print(f"{item.lote:<10} {item.cod_anvisa:<15} {item.cod_unidade:<15} {item.validade:<15} {item.quantidade:<10}")
+# Linhas formatadas acumuladas antes de cada escrita na saída
+LINHAS_POR_ESCRITA = 1000
+
+class _Tabela:
+    # colunas: (título, campo, largura). O formato das linhas é montado uma única vez e as
+    # linhas são escritas em blocos à medida que a origem (lista ou gerador) as produz
+    def __init__(self, colunas, largura_separador):
+        self.titulos = [titulo for titulo, _, _ in colunas]
+        self.campos = [campo for _, campo, _ in colunas]
+        self.formato = ' '.join(f'{{:<{largura}}}' for _, _, largura in colunas).format
+        self.separador = '=' * largura_separador
+
+    def _valores(self, item):
+        valores = [item[campo] if isinstance(item, dict) else getattr(item, campo) for campo in self.campos]
+        for i, valor in enumerate(valores):
+            if valor is None:
+                valores[i] = ''
+            elif isinstance(valor, datetime.date):
+                valores[i] = valor.strftime('%d/%m/%Y')
+        return valores
+
+    def render(self, itens, saida=None, formato='tabela'):
+        # formato 'csv' ou 'tsv' escreve os nomes dos campos e os valores sem alinhamento
+        saida = saida or sys.stdout
+        itens = iter(itens)
+        if formato in ('csv', 'tsv'):
+            escritor = csv.writer(saida, delimiter=',' if formato == 'csv' else '\t', lineterminator='\n')
+            escritor.writerow(self.campos)
+            while bloco := [self._valores(item) for item in itertools.islice(itens, LINHAS_POR_ESCRITA)]:
+                escritor.writerows(bloco)
+                saida.flush()
+            return
+        if formato != 'tabela':
+            raise ValueError(f'Formato desconhecido: {formato}')
+        saida.write(f"{self.formato(*self.titulos)}\n{self.separador}\n")
+        while bloco := [self.formato(*self._valores(item)) for item in itertools.islice(itens, LINHAS_POR_ESCRITA)]:
+            saida.write('\n'.join(bloco))
+            saida.write('\n')
+            saida.flush()
+
+_TABELA_UNIDADES = _Tabela([
+    ('Código', 'cod', 10), ('Nome', 'nome', 30), ('Telefone', 'telefone', 15), ('Tipo', 'tipo', 25),
+    ('Rua', 'rua', 30), ('Número', 'numero', 10), ('Bairro', 'bairro', 20), ('CEP', 'cep', 10),
+], 150)
+_TABELA_MEDICAMENTOS = _Tabela([
+    ('Código ANVISA', 'cod_anvisa', 15), ('Nome Comercial', 'nome_comercial', 30), ('Fabricante', 'fabricante', 20),
+    ('Apresentação', 'apresentacao', 30), ('Forma de Administração', 'forma_administracao', 30),
+    ('Princípio Ativo', 'principio_ativo', 30),
+], 150)
+_TABELA_ESTOQUE = _Tabela([
+    ('Lote', 'lote', 10), ('Código ANVISA', 'cod_anvisa', 15), ('Código Unidade', 'cod_unidade', 15),
+    ('Validade', 'validade', 15), ('Quantidade', 'quantidade', 10),
+], 70)
+_TABELA_ESTOQUE_DETALHADO = _Tabela([
+    ('Lote', 'lote', 10), ('Código ANVISA', 'cod_anvisa', 15), ('Nome Comercial', 'nome_comercial', 30),
+    ('Princípio Ativo', 'principio_ativo', 30), ('Fabricante', 'fabricante', 20), ('Unidade', 'nome_unidade', 30),
+    ('Validade', 'validade', 12), ('Quantidade', 'quantidade', 10),
+], 165)
+_TABELA_VENCENDO = _Tabela([
+    ('Validade', 'validade_med_estoque', 12), ('Unidade', 'nome_unidade', 30), ('Medicamento', 'nome_comercial', 30),
+    ('Lote', 'lote_med', 10), ('Quantidade', 'quantidade_med_estoque', 10),
+], 96)
+
+def render_unidades(unidades: list[UnidadeSaude], saida=None, formato='tabela'):
+    _TABELA_UNIDADES.render(unidades, saida, formato)
+
+def render_medicamentos(medicamentos: list[Medicamento], saida=None, formato='tabela'):
+    _TABELA_MEDICAMENTOS.render(medicamentos, saida, formato)
+
+def render_estoque_medicamentos(estoque: list[EstoqueMedicamento], saida=None, formato='tabela'):
+    _TABELA_ESTOQUE.render(estoque, saida, formato)
+
+def render_estoque_detalhado(estoque: list[EstoqueDetalhado], saida=None, formato='tabela'):
+    _TABELA_ESTOQUE_DETALHADO.render(estoque, saida, formato)
+
+def render_relatorio_vencendo(linhas: list[dict], saida=None, formato='tabela'):
+    _TABELA_VENCENDO.render(linhas, saida, formato)
+
+@contextlib.contextmanager
+def saida_paginada():
+    # Manda a saída para o $PAGER (less por padrão) quando o stdout é um terminal;
+    # sair do pager antes do fim só interrompe a escrita
+    comando = shlex.split(os.environ.get('PAGER') or 'less -FRX')
+    if not sys.stdout.isatty() or not comando or not shutil.which(comando[0]):
+        yield sys.stdout
+        return
+    processo = subprocess.Popen(comando, stdin=subprocess.PIPE, text=True, encoding='utf-8')
+    try:
+        yield processo.stdin
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            processo.stdin.close()
+        except BrokenPipeError:
+            pass
+        processo.wait()
 
 # ==== Console menu functions
+def _paginar(buscar_pagina, chave, render):
+    # Exibe uma página por vez usando a chave do último item como cursor (keyset);
+    # retorna False se não houver nenhum item
+    apos = None
+    while True:
+        pagina = buscar_pagina(apos)
+        if not pagina:
+            return apos is not None
+        render(pagina)
+        if len(pagina) < TAMANHO_PAGINA:
+            return True
+        if input("Enter para a próxima página, 'q' para voltar: ").lower() == 'q':
+            return True
+        apos = chave(pagina[-1])
+
 def menu_unidades_get():
-    unidades = get_unidades()
-    if not unidades:
+    if not _paginar(get_unidades_pagina, lambda un: un.cod, render_unidades):
         print("Nenhuma unidade de saúde encontrada.")
-        return
-    
-    render_unidades(unidades)
 
 def menu_unidades_add():
     print("==== Adicionar nova Unidade de Saúde ====")
@@ -412,6 +2778,9 @@ def menu_unidades_update():
     else:
         print(f"Erro ao atualizar unidade de saúde: {result['message']}")
 
+def _mostrar_progresso_exclusao(removidas, total):
+    print(f"\rRemovendo estoque: {removidas}/{total} lote(s)", end='', flush=True)
+
 def menu_unidades_delete():
     cod_unidade = input("Código da unidade de saúde a ser deletada: ")
     unidade = get_unidade(cod_unidade)
@@ -424,7 +2793,8 @@ def menu_unidades_delete():
         print("Operação cancelada.")
         return
     
-    result = delete_unidade(cod_unidade)
+    result = delete_unidade_em_etapas(cod_unidade, progresso=_mostrar_progresso_exclusao)
+    print()
     
     if result['status'] == 'error':
         print(f"Erro ao deletar unidade de saúde: {result['message']}")
@@ -440,13 +2810,13 @@ def menu_medicamentos_estoque_get():
         return
     
     print(f"Unidade encontrada: {unidade.nome} - {unidade.tipo}")
-    estoque = get_estoque_medicamentos(cod_unidade)
+    encontrou = _paginar(
+        lambda apos: get_estoque_detalhado_pagina(cod_unidade, apos=apos),
+        lambda item: (item.cod_unidade, item.lote, item.cod_anvisa),
+        render_estoque_detalhado)
     
-    if not estoque:
+    if not encontrou:
         print("Nenhum medicamento encontrado no estoque desta unidade.")
-        return
-    
-    render_estoque_medicamentos(estoque)
 
 def menu_medicamentos_estoque_add():
     cod_unidade = input("Código da unidade de saúde: ")
@@ -459,7 +2829,11 @@ def menu_medicamentos_estoque_add():
     cod_anvisa = input("Código ANVISA do medicamento: ")
     validade = input("Validade do medicamento (YYYY-MM-DD): ")
     quantidade = int(input("Quantidade no estoque: "))
-    validate_datetime = pd.to_datetime(validade, format='%Y-%m-%d', errors='coerce')
+    try:
+        validate_datetime = datetime.datetime.strptime(validade, '%Y-%m-%d').date()
+    except ValueError:
+        print("Data de validade inválida.")
+        return
     novo_estoque = EstoqueMedicamento(lote, cod_anvisa, cod_unidade, validate_datetime, quantidade)
     result = post_estoque_medicamento(novo_estoque)
     
@@ -469,7 +2843,12 @@ def menu_medicamentos_estoque_add():
         print(f"Erro ao adicionar medicamento ao estoque: {result['message']}")
 
 def menu_medicamentos_get():
-    medicamentos = get_medicamentos()
+    if not _paginar(get_medicamentos_pagina, lambda med: med.cod_anvisa, render_medicamentos):
+        print("Nenhum medicamento encontrado.")
+
+def menu_medicamentos_buscar():
+    termo = input("Nome comercial ou princípio ativo: ")
+    medicamentos = buscar_medicamentos(termo)
     if not medicamentos:
         print("Nenhum medicamento encontrado.")
         return
@@ -529,7 +2908,8 @@ def menu_medicamentos_delete():
         print("Operação cancelada.")
         return
     
-    result = delete_medicamento(cod_anvisa)
+    result = delete_medicamento_em_etapas(cod_anvisa, progresso=_mostrar_progresso_exclusao)
+    print()
     
     if result['status'] == 'error':
         print(f"Erro ao deletar medicamento: {result['message']}")
@@ -544,28 +2924,63 @@ def menu_medicamentos_estoque_subtract():
         print("Unidade não encontrada.")
         return
     
-    lote = input("Lote do medicamento: ")
+    lote = input("Lote do medicamento (deixe em branco para retirar dos lotes que vencem primeiro): ")
     cod_anvisa = input("Código ANVISA do medicamento: ")
-    quantidade = int(input("Quantidade a ser diminuída do estoque: "))
+    quantidade = input("Quantidade a ser diminuída do estoque: ")
     
-    estoque = get_estoque_medicamento(cod_unidade, lote, cod_anvisa)
-    if not estoque:
-        print("Medicamento não encontrado no estoque desta unidade.")
+    if not lote:
+        result = dispensar_medicamento_fefo(cod_unidade, cod_anvisa, quantidade)
+        if result['status'] == 'success':
+            for lote, _, retirada, saldo in result['retiradas']:
+                print(f"Lote {lote}: {retirada} retirado(s), saldo {saldo}.")
+            print(result['message'])
+        else:
+            print(f"Erro ao diminuir medicamento do estoque: {result['message']}")
         return
     
-    if estoque.quantidade < quantidade:
-        print("Quantidade a ser diminuída é maior que a quantidade disponível no estoque.")
-        return
+    result = dispensar_medicamento(cod_unidade, lote, cod_anvisa, quantidade)
     
-    estoque.quantidade -= quantidade
+    if result['status'] == 'success':
+        _, _, saldo = result['saldos'][0]
+        print(f"Medicamento dispensado com sucesso. Saldo do lote: {saldo}.")
+        
+    else:
+        print(f"Erro ao diminuir medicamento do estoque: {result['message']}")
+
+def menu_medicamentos_transferir():
+    cod_unidade_origem = input("Código da unidade de origem: ")
+    cod_unidade_destino = input("Código da unidade de destino: ")
+    itens = []
+    while True:
+        lote = input("Lote do medicamento (deixe em branco para concluir): ")
+        if not lote:
+            break
+        cod_anvisa = input("Código ANVISA do medicamento: ")
+        quantidade = input("Quantidade a ser transferida: ")
+        itens.append((lote, cod_anvisa, quantidade))
+    if not itens:
+        return
     
-    result = update_estoque_medicamento(estoque)
+    result = transferir_medicamentos(cod_unidade_origem, cod_unidade_destino, itens)
     
     if result['status'] == 'success':
+        for lote, cod_anvisa, quantidade, saldo_origem, saldo_destino in result['transferencias']:
+            print(f"Lote {lote} ({cod_anvisa}): {quantidade} transferido(s), saldo na origem {saldo_origem}, no destino {saldo_destino}.")
         print(result['message'])
-        
     else:
-        print(f"Erro ao diminuir medicamento do estoque: {result['message']}")
+        print(f"Erro ao transferir medicamentos: {result['message']}")
+
+def menu_relatorio_vencendo():
+    dias = _quantidade_valida(input("Vencendo nos próximos quantos dias (padrão 30)? ") or '30', minimo=0)
+    if dias is None:
+        print("Número de dias inválido.")
+        return
+    linhas = relatorio_vencendo(dias)
+    if not linhas:
+        print("Nenhum lote vencendo neste período.")
+        return
+    
+    render_relatorio_vencendo(linhas)
 
 cases = {
     '1': menu_unidades_get,
@@ -579,6 +2994,9 @@ cases = {
     '9': menu_medicamentos_estoque_get,
     '10': menu_medicamentos_estoque_add,
     '11': menu_medicamentos_estoque_subtract,
+    '12': menu_relatorio_vencendo,
+    '13': menu_medicamentos_buscar,
+    '14': menu_medicamentos_transferir,
 }
 
 # Console menu interface
@@ -596,6 +3014,9 @@ def main_menu():
         print("9. Listar Estoque de Medicamento por Unidade")
         print("10. Adicionar novo Medicamento ao Estoque de uma Unidade")
         print("11. Diminuir Medicamento do Estoque de uma Unidade")
+        print("12. Relatório de Medicamentos Próximos do Vencimento")
+        print("13. Buscar Medicamento por Nome ou Princípio Ativo")
+        print("14. Transferir Medicamentos entre Unidades")
         print("0. Sair")
         
         print("")
@@ -612,6 +3033,50 @@ def main_menu():
             print("Opção inválida. Tente novamente.")
             
 if __name__ == "__main__":
-    main_menu()
-    
-conn.close()
+    parser = argparse.ArgumentParser(description='Sistema de estoque de medicamentos.')
+    comandos = parser.add_subparsers(dest='comando')
+    exportar = comandos.add_parser('exportar', help='Exporta o estoque completo em Parquet/Arrow.')
+    exportar.add_argument('destino', help='Arquivo de saída, ou diretório quando --particionar')
+    exportar.add_argument('--formato', choices=['parquet', 'arrow'], default='parquet')
+    exportar.add_argument('--particionar', action='store_true', help='Um arquivo por cod_unidade')
+    exportar.add_argument('--tamanho-grupo', type=int, default=TAMANHO_GRUPO_EXPORTACAO)
+    comandos.add_parser('compactar', help='Consolida as movimentações dos meses fechados em saldos mensais.')
+    comandos.add_parser('atualizar-relatorios', help='Recalcula os saldos usados pelos relatórios (para rodar no cron).')
+    listar = comandos.add_parser('listar', help='Lista unidades, medicamentos ou o estoque de uma unidade.')
+    listar.add_argument('tipo', choices=['unidades', 'medicamentos', 'estoque'])
+    listar.add_argument('--unidade', type=int, help='Código da unidade (obrigatório para estoque)')
+    listar.add_argument('--formato', choices=['tabela', 'csv', 'tsv'], default='tabela')
+    listar.add_argument('--paginar', action='store_true', help='Abre a listagem no $PAGER')
+    args = parser.parse_args()
+
+    init()
+    try:
+        if args.comando == 'exportar':
+            result = exportar_estoque(args.destino, args.formato, args.particionar, args.tamanho_grupo)
+            print(result['message'])
+            if result['status'] == 'success':
+                print(f"{result['linhas_por_segundo']:.0f} linhas/s")
+        elif args.comando == 'compactar':
+            print(compactar_movimentacoes()['message'])
+        elif args.comando == 'atualizar-relatorios':
+            print(atualizar_relatorios()['message'])
+        elif args.comando == 'listar':
+            if args.tipo == 'estoque' and args.unidade is None:
+                parser.error('--unidade é obrigatório para listar o estoque')
+            itens, render = {
+                'unidades': (iter_unidades, render_unidades),
+                'medicamentos': (iter_medicamentos, render_medicamentos),
+                'estoque': (lambda: iter_estoque_medicamentos(args.unidade), render_estoque_medicamentos),
+            }[args.tipo]
+            try:
+                with saida_paginada() if args.paginar else contextlib.nullcontext(sys.stdout) as saida:
+                    render(itens(), saida, args.formato)
+            except BrokenPipeError:
+                # Saída ligada a um comando como head que parou de ler
+                os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        else:
+            iniciar_invalidacao_remota()
+            main_menu()
+    finally:
+        parar_invalidacao_remota()
+        fechar_pool()